@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""Client for sending actions to IntfDaemon"""
+
+import threading
+import time
+from typing import *
+import zmq
+from . import LustreCommon
+from .ascar_logging import logger
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+_local = threading.local()
+
+
+class ActionClient:
+    """A long-lived connection to IntfDaemon for sending actions
+
+    The socket is connected once and reused by all send() calls, so sending an action costs no
+    more than queueing a message. A client must only be used by one thread; use
+    get_action_client() to get the client of the current thread.
+
+    Attributes:
+        intf_daemon_loc: the ZMQ endpoint of IntfDaemon
+        ack_timeout: seconds send() waits for the acknowledgement of IntfDaemon
+        dropped_actions: number of actions dropped because IntfDaemon has not been reachable
+                         for long enough to fill the send queue
+    """
+    ack_timeout = 1
+    send_hwm = 1000
+
+    def __init__(self, intf_daemon_loc: str = 'tcp://127.0.0.1:9123', ack_timeout: float = None):
+        self.intf_daemon_loc = intf_daemon_loc
+        if ack_timeout is not None:
+            self.ack_timeout = ack_timeout
+        self.dropped_actions = 0
+        self._seq = 0
+        # IntfDaemon replies to the identity that ZMQ assigns to the socket
+        self._socket = zmq.Context.instance().socket(zmq.DEALER)
+        self._socket.set_hwm(self.send_hwm)
+        self._socket.connect(intf_daemon_loc)
+
+    def send(self, action: List, ack: bool = False) -> Optional[float]:
+        """Send an action to IntfDaemon, which stores it and broadcasts it to all MAs
+
+        :param action: The first element is the action that will be saved to DB. The rest of the
+                       list is complementary data that will be sent to CAs but not stored in DB.
+        :param ack: wait for IntfDaemon to acknowledge that the action has been broadcast
+        :return: if ack is True, the seconds IntfDaemon spent on broadcasting the action, or
+                 None if no acknowledgement came within ack_timeout
+        """
+        assert isinstance(action[0], int)
+        frames = LustreCommon.encode_action_message(action, int(time.time()))
+        if ack:
+            self._seq += 1
+            frames.append(str(self._seq).encode('ascii'))
+        try:
+            self._socket.send_multipart(frames, zmq.NOBLOCK)
+        except zmq.Again:
+            self.dropped_actions += 1
+            logger.warning('IntfDaemon is not reachable, dropped {0} actions so far'.format(self.dropped_actions))
+            return None
+        if ack:
+            return self._wait_for_ack(frames[-1])
+
+    def _wait_for_ack(self, token: bytes) -> Optional[float]:
+        deadline = time.time() + self.ack_timeout
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0 or not self._socket.poll(timeout * 1000):
+                logger.warning('No acknowledgement of action {0} from IntfDaemon'.format(token.decode()))
+                return None
+            reply = self._socket.recv_multipart()
+            # Acknowledgements that came after their send() timed out are skipped
+            if len(reply) == 3 and reply[0] == b'ACK' and reply[1] == token:
+                return float(reply[2])
+
+    def close(self):
+        self._socket.close(linger=0)
+
+
+def get_action_client(intf_daemon_loc: str = 'tcp://127.0.0.1:9123') -> ActionClient:
+    """Return the ActionClient of the current thread for intf_daemon_loc, which is created on first use"""
+    clients = getattr(_local, 'clients', None)
+    if clients is None:
+        clients = _local.clients = dict()
+    if intf_daemon_loc not in clients:
+        clients[intf_daemon_loc] = ActionClient(intf_daemon_loc)
+    return clients[intf_daemon_loc]
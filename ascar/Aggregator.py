@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""Aggregation tier between the MAs of a rack and IntfDaemon"""
+
+import socket
+import threading
+import time
+from typing import *
+import numpy as np
+import zmq
+from . import LustreCommon
+from .TickAssembler import AssembledTick, TickAssembler
+from .ascar_logging import *
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+
+class Aggregator:
+    """Collect the PIs of a group of MAs and relay actions to them
+
+    An Aggregator runs per rack or subnet and looks like IntfDaemon to its MAs: they use
+    aggregator_loc as their intf_daemon_loc. The PIs of a tick are buffered by a TickAssembler
+    until all MAs of the aggregator have reported or max_delay seconds have passed since the first
+    of them, and are then sent upstream to IntfDaemon in one KIND_BATCH message. So IntfDaemon receives one
+    message per rack per tick instead of one per MA. PIs that arrive after their tick has been
+    sent are sent in a batch of their own.
+
+    Heartbeats and actions published by IntfDaemon are published again to the MAs unchanged. The
+    latest action is kept for MAs that ask for it again. If the aggregator itself has missed an
+    action, it asks IntfDaemon for it and publishes it again.
+
+    Aggregators can be stacked: the batches and actions an aggregator receives are passed on as
+    they are.
+
+    This class's public methods are thread-safe.
+
+    Attributes:
+        port: the port the MAs send to
+        pub_port: the port the MAs subscribe to. It defaults to the port they derive from
+                  aggregator_loc with LustreCommon.get_pub_port(). opt['aggregator_pub_port']
+                  overrides it, and the MAs must then set it as their intf_daemon_pub_port.
+        expected_mas: IDs of the MAs of this aggregator from opt['aggregator_mas']. If it isn't
+                      set, all MAs that have reported so far are expected.
+        max_delay: the longest time in seconds the PIs of a tick are held back
+    """
+    _abort_inproc_addr = 'inproc://#aggregatorabrt'
+    max_delay = 0.5
+    socket = None
+
+    def __init__(self, opt: dict):
+        self.opt = opt
+        self.port = int(opt['aggregator_loc'].split(':')[1])
+        self.pub_port = opt.get('aggregator_pub_port', LustreCommon.get_pub_port(opt, opt['aggregator_loc']))
+        self.upstream_loc = opt['intf_daemon_loc']
+        self.upstream_pub_loc = 'tcp://{host}:{port}'.format(host=self.upstream_loc.split(':')[0],
+                                                             port=LustreCommon.get_pub_port(opt))
+        self.id = opt.get('aggregator_id', socket.gethostname())
+        self.max_delay = opt.get('aggregator_max_delay', self.max_delay)
+        self.expected_mas = set(opt['aggregator_mas']) if 'aggregator_mas' in opt else None
+        self._assembler = TickAssembler(self.expected_mas, self.max_delay, on_tick=self._send_tick,
+                                        on_late=self._send_late_pi)
+        # The latest action published by IntfDaemon with its sequence number frame, and the
+        # sequence number of the latest one requested again
+        self._last_action = None
+        self._action_seq = None
+        self._resend_seq = None
+        self.received_pis = 0
+        self.sent_batches = 0
+        self.dropped_batches = 0
+        self.relayed_broadcasts = 0
+        self.rejected_messages = 0
+        self.abort_publisher_socket = None
+        self._stop_lock = threading.Lock()
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            'received_pis': self.received_pis,
+            'sent_batches': self.sent_batches,
+            'dropped_batches': self.dropped_batches,
+            'relayed_broadcasts': self.relayed_broadcasts,
+            'rejected_messages': self.rejected_messages,
+            'pending_ticks': self._assembler.get_status()['pending_ticks'],
+            'late_pis': self._assembler.late_rows,
+        }
+
+    def _send_batch(self, entries: Iterable[Tuple[int, float, bytes]]):
+        frames = LustreCommon.encode_batch_message(entries)
+        try:
+            self.upstream.send_multipart(frames, zmq.NOBLOCK)
+            self.sent_batches += 1
+        except zmq.Again:
+            self.dropped_batches += 1
+            logger.warning('IntfDaemon is not reachable, dropped {0} batches so far'.format(self.dropped_batches))
+
+    def _send_tick(self, tick: AssembledTick):
+        self._send_batch((ma_id, tick.ts, pis.tobytes()) for ma_id, pis in tick.rows())
+
+    def _send_late_pi(self, ma_id: int, ts: int, pis: np.ndarray):
+        self._send_batch([(ma_id, ts, pis.tobytes())])
+
+    def _handle_ma(self, frames: List[bytes]):
+        """Handle a message from an MA"""
+        identity = frames[0]
+        try:
+            msg = LustreCommon.decode_message(frames[1:])
+            if msg.kind == LustreCommon.KIND_PI:
+                ma_id = LustreCommon.decode_ma_id(identity)
+        except LustreCommon.ProtocolError as e:
+            self.rejected_messages += 1
+            logger.warning('Dropped a message from {ma_id}: {msg}; {n} dropped so far'.format(
+                ma_id=identity, msg=str(e), n=self.rejected_messages))
+            return
+        if msg.kind == LustreCommon.KIND_PI:
+            self.received_pis += 1
+            self._assembler.add(ma_id, int(msg.ts), msg.body)
+        elif msg.kind == LustreCommon.KIND_RESEND:
+            if self._last_action:
+                self.socket.send_multipart([identity] + self._last_action)
+        elif msg.kind == LustreCommon.KIND_STATUS:
+            status = '; '.join('{0}: {1}'.format(k, v) for k, v in sorted(self.get_status().items()))
+            self.socket.send_multipart([identity, ('Aggregator {0}: {1}'.format(self.id, status)).encode()])
+        elif msg.kind in (LustreCommon.KIND_ACTION, LustreCommon.KIND_BATCH):
+            try:
+                self.upstream.send_multipart(frames[1:1 + msg.frames], zmq.NOBLOCK)
+            except zmq.Again:
+                logger.warning('IntfDaemon is not reachable, dropped a message of kind {0}'.format(msg.kind))
+        else:
+            logger.warning('Unexpected message of kind {0} received'.format(msg.kind))
+
+    def _relay(self, frames: List[bytes], resent: bool = False):
+        """Publish a heartbeat or an action of IntfDaemon to the MAs
+
+        :param resent: the action has been sent again by IntfDaemon on request
+        """
+        seq = LustreCommon.BROADCAST_SEQ.unpack(frames[0])[0]
+        # The second byte of the header is the kind
+        kind = frames[1][1]
+        if kind == LustreCommon.KIND_ACTION:
+            if resent and self._action_seq is not None and seq <= self._action_seq:
+                return
+            self._last_action = frames
+            self._action_seq = seq
+        elif kind == LustreCommon.KIND_HB:
+            if self._action_seq is not None and seq < self._action_seq:
+                # IntfDaemon has been restarted
+                self._last_action = self._action_seq = None
+            if seq > (self._action_seq or 0) and seq != self._resend_seq:
+                logger.warning('Missed action {0}, asking for it again'.format(seq))
+                self._resend_seq = seq
+                try:
+                    self.upstream.send_multipart(LustreCommon.encode_message(LustreCommon.KIND_RESEND), zmq.NOBLOCK)
+                except zmq.Again:
+                    pass
+        self.publisher.send_multipart(frames)
+        self.relayed_broadcasts += 1
+
+    def start(self):
+        """Start the aggregator, which returns after stop() has been called"""
+        assert not self.socket, 'Aggregator already started.'
+        context = zmq.Context()
+        self.socket = context.socket(zmq.ROUTER)
+        self.socket.set_hwm(5000)
+        self.socket.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        self.socket.bind('tcp://*:{port}'.format(port=self.port))
+        self.publisher = context.socket(zmq.PUB)
+        self.publisher.set_hwm(1000)
+        self.publisher.bind('tcp://*:{port}'.format(port=self.pub_port))
+        self.upstream = context.socket(zmq.DEALER)
+        self.upstream.setsockopt(zmq.IDENTITY, 'aggregator-{0}'.format(self.id).encode())
+        self.upstream.set_hwm(1000)
+        self.upstream.connect('tcp://{0}'.format(self.upstream_loc))
+        self.subscriber = context.socket(zmq.SUB)
+        self.subscriber.setsockopt(zmq.SUBSCRIBE, b'')
+        self.subscriber.connect(self.upstream_pub_loc)
+        logger.info('Aggregator {id} listening on port {port}, sending to {upstream}'.format(
+            id=self.id, port=self.port, upstream=self.upstream_loc))
+
+        self.abort_publisher_socket = context.socket(zmq.PUSH)
+        self.abort_publisher_socket.bind(self._abort_inproc_addr)
+        abort_subscriber_socket = context.socket(zmq.PULL)
+        abort_subscriber_socket.connect(self._abort_inproc_addr)
+
+        poller = zmq.Poller()
+        for s in (self.socket, self.subscriber, self.upstream, abort_subscriber_socket):
+            poller.register(s, zmq.POLLIN)
+        try:
+            while True:
+                flush_log()
+                now = time.time()
+                timeout = min(self._assembler.next_deadline() or now + 1, now + 1) - now
+                p = dict(poller.poll(max(timeout, 0) * 1000))
+                if self.socket in p:
+                    self._handle_ma(self.socket.recv_multipart())
+                if self.subscriber in p:
+                    self._relay(self.subscriber.recv_multipart())
+                if self.upstream in p:
+                    # Actions sent again on request. Other replies are not expected.
+                    frames = self.upstream.recv_multipart()
+                    if len(frames) == 3:
+                        self._relay(frames, resent=True)
+                if abort_subscriber_socket in p:
+                    break
+                self._assembler.check()
+        finally:
+            self._assembler.flush()
+            with self._stop_lock:
+                for s in (abort_subscriber_socket, self.abort_publisher_socket, self.socket, self.publisher,
+                          self.subscriber):
+                    s.close(linger=0)
+                self.abort_publisher_socket = None
+            # Give the last batches a chance to go out
+            self.upstream.close(linger=1000)
+            context.term()
+            logger.info('Aggregator {0} stopped'.format(self.id))
+
+    def stop(self):
+        """Stop the aggregator
+
+        This function is thread-safe. Nothing is done if the aggregator has already stopped.
+        """
+        assert self.socket, 'Aggregator not started.'
+        with self._stop_lock:
+            if self.abort_publisher_socket:
+                self.abort_publisher_socket.send(b'STOP')
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""Health tracking of the MAs of IntfDaemon"""
+
+from collections import deque
+import heapq
+import time
+from typing import *
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+MA_NOT_SEEN = 'not seen'
+MA_OK = 'ok'
+MA_UNRESPONSIVE = 'unresponsive'
+
+
+class HealthEvent(NamedTuple):
+    """A change of the health of an MA
+
+    Attributes:
+        ma_id: ID of the MA
+        old_state: one of the MA_* states
+        new_state: one of the MA_* states
+        ts: when the change was detected
+        last_seen: when the last message of the MA was received, or None if it has never been seen
+    """
+    ma_id: int
+    old_state: str
+    new_state: str
+    ts: float
+    last_seen: Optional[float]
+
+
+class HealthTracker:
+    """Track which MAs are alive
+
+    seen() is called for every message of an MA and only updates a dict entry. Each MA that is
+    ok has one deadline in a heap, which check() pops when it expires: if the MA has been seen
+    since, the deadline is pushed again, otherwise the MA becomes unresponsive. So the heap work
+    is one push and pop per MA every timeout seconds no matter how many messages arrive.
+
+    An MA that comes back after being unresponsive is ok again. Every change of state is
+    reported as a HealthEvent to on_event and kept in events.
+
+    This class is not thread-safe.
+
+    Attributes:
+        timeout: an MA that hasn't been seen for this many seconds is unresponsive
+        events: the latest HealthEvents, oldest first
+    """
+    timeout = 20
+    max_events = 1000
+
+    def __init__(self, expected_mas: Iterable[int] = None, timeout: float = None,
+                 on_event: Callable[[HealthEvent], None] = None):
+        """
+        :param expected_mas: the MAs that should report, which are 'not seen' until they do. MAs
+                             that are not in it are tracked from their first message.
+        """
+        if timeout is not None:
+            self.timeout = timeout
+        self.events = deque(maxlen=self.max_events)
+        self._on_event = on_event
+        self._last_seen = dict()               # type: Dict[int, float]
+        self._states = {ma_id: MA_NOT_SEEN for ma_id in expected_mas or ()}
+        self._counts = {MA_NOT_SEEN: len(self._states), MA_OK: 0, MA_UNRESPONSIVE: 0}
+        # (deadline, ma_id) of the MAs that are ok
+        self._deadlines = []                   # type: List[Tuple[float, int]]
+
+    def seen(self, ma_id: int, now: float = None):
+        """Record that a message of an MA has been received"""
+        now = time.time() if now is None else now
+        self._last_seen[ma_id] = now
+        if self._states.get(ma_id) != MA_OK:
+            self._change_state(ma_id, MA_OK, now)
+            heapq.heappush(self._deadlines, (now + self.timeout, ma_id))
+
+    def check(self, now: float = None) -> List[HealthEvent]:
+        """Mark the MAs whose deadline has passed unresponsive
+
+        :return: the events of the MAs that became unresponsive
+        """
+        now = time.time() if now is None else now
+        result = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, ma_id = heapq.heappop(self._deadlines)
+            last_seen = self._last_seen[ma_id]
+            if now - last_seen < self.timeout:
+                heapq.heappush(self._deadlines, (last_seen + self.timeout, ma_id))
+            else:
+                result.append(self._change_state(ma_id, MA_UNRESPONSIVE, now))
+        return result
+
+    def state(self, ma_id: int) -> Optional[str]:
+        """The state of an MA, or None if it is neither expected nor has been seen"""
+        return self._states.get(ma_id)
+
+    def last_seen(self, ma_id: int) -> Optional[float]:
+        return self._last_seen.get(ma_id)
+
+    def mas(self, state: str) -> List[int]:
+        """The MAs that are in state, which takes time linear to the number of MAs"""
+        return sorted(ma_id for ma_id, s in self._states.items() if s == state)
+
+    def all_healthy(self) -> bool:
+        return self._counts[MA_OK] == len(self._states)
+
+    def get_status(self) -> Dict[str, int]:
+        return {
+            'ma_ok': self._counts[MA_OK],
+            'ma_unresponsive': self._counts[MA_UNRESPONSIVE],
+            'ma_not_seen': self._counts[MA_NOT_SEEN],
+        }
+
+    def summary(self, max_listed: int = 20) -> str:
+        """A one line summary, which lists up to max_listed MAs of each unhealthy state"""
+        if self.all_healthy():
+            return 'All {0} MAs healthy. '.format(self._counts[MA_OK])
+        result = '{0} MAs ok. '.format(self._counts[MA_OK])
+        for state in (MA_UNRESPONSIVE, MA_NOT_SEEN):
+            if self._counts[state]:
+                mas = self.mas(state)
+                listed = ', '.join(str(ma_id) for ma_id in mas[:max_listed])
+                if len(mas) > max_listed:
+                    listed += ', ...'
+                result += '{0} MAs {1}: {2}. '.format(len(mas), state, listed)
+        return result
+
+    def _change_state(self, ma_id: int, new_state: str, now: float) -> HealthEvent:
+        old_state = self._states.get(ma_id)
+        if old_state is not None:
+            self._counts[old_state] -= 1
+        self._counts[new_state] += 1
+        self._states[ma_id] = new_state
+        event = HealthEvent(ma_id, old_state or MA_NOT_SEEN, new_state, now, self._last_seen.get(ma_id))
+        self.events.append(event)
+        if self._on_event:
+            self._on_event(event)
+        return event
@@ -4,37 +4,76 @@
 
 # Import system modules
 from copy import *
-import pickle
+import threading
 import time
-from typing import List
-import zlib
+from typing import *
 import zmq
 # Import local modules
+from .ActionClient import get_action_client
+from .HealthTracker import HealthEvent, HealthTracker, MA_UNRESPONSIVE
+from .PipelineStage import PipelineStage, StageMetrics
 from .ReplayDB import *
+from .ReplayDBWriter import ReplayDBWriter
+from .TickAssembler import AssembledTick, TickAssembler
+from .TickRing import open_tick_ring
 from .ascar_logging import *
 from . import LustreCommon
 
 __author__ = 'Yan Li'
 __copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
 
+# Passed to the broadcast stage to resend the latest action to an MA
+_LAST_ACTION = object()
 
 class IntfDaemon:
     """The Interface Daemon
 
+    Messages go through a pipeline of stages, each of which runs in its own thread:
+
+        receive:   the thread that calls start(). It owns the ROUTER socket, receives messages and
+                   sends out the replies queued by the broadcast stage.
+        decode:    decodes messages of protocol v1 and v2, keeps track of the MAs and handles commands
+        persist:   the ReplayDBWriter, which writes PIs and actions to the ReplayDB
+        broadcast: publishes heartbeats and actions on the PUB socket, and sends replies to MAs
+
+    Heartbeats and actions are published once on a PUB socket, to which every MA subscribes, so
+    libzmq does the fan-out no matter how many MAs there are. They are prefixed by the sequence
+    number of the latest action, from which MAs find out about missed actions (see LustreCommon).
+
+    Each time the receive stage wakes up it drains up to recv_batch_size pending messages without
+    blocking and passes them to the decode stage as one batch, so the per-message cost of queueing
+    and housekeeping is paid once per batch. get_status() reports the messages received per second
+    (receive_throughput) and the number, size and processing time of the batches.
+
+    A ZMQ socket can only be used by one thread, so the broadcast stage passes its replies to the
+    receive stage through an inproc socket. get_status() reports the throughput and queue latency
+    of every stage. Messages of an unknown protocol version are dropped and counted in
+    rejected_messages.
+
+    The health of the MAs is kept by a HealthTracker, which logs every change. MAs that go
+    unresponsive are reported but don't stop the daemon.
+
+    The decode stage assembles the PIs of each tick with a TickAssembler, which waits for all
+    MAs of nodeid_map (or all MAs seen so far) for up to tick_max_delay seconds. Each assembled
+    tick goes to the ReplayDB, the tick ring and the callables in tick_listeners, which are called
+    by the decode stage and must return quickly. PIs that arrive after their tick has been
+    assembled are stored one by one.
+
     This daemon's public methods are thread-safe.
 
     :type nodeid_map: dict
     :type opt: dict
     """
     _abort_inproc_addr = 'inproc://#intfdaemonabrt'
+    _outbox_inproc_addr = 'inproc://#intfdaemonoutbox'
     abort_publisher_socket = None
     abort_subscriber_socket = None
-    ma_status = dict()
     nodeid_map = None
     opt = None
-    prev_health_status = ''
     started = False
     socket = None
+    stage_queue_size = 10000
+    recv_batch_size = 1000
 
     def __init__(self, opt: dict, store_action=True):
         """
@@ -48,163 +87,338 @@ class IntfDaemon:
             self.port = int(opt['intf_daemon_loc'].split(':')[1])
         else:
             self.port = 9123
+        self.pub_port = LustreCommon.get_pub_port(opt)
         self.store_action = store_action
-
-    def _health_check(self) -> str:
-        if not self.nodeid_map:
-            result = 'nodeid_map is missing; '
-            # just return the known MAs
-            for ma in self.ma_status:
-                result += '{ma}: ok; '.format(ma=ma)
-            return result
-
-        result = ''
-        ok_nodes = 0
-        unresponsive_nodes = 0
-        for ma in self.nodeid_map.values():
-            if ma not in self.ma_status:
-                result += '{ma}: not seen; '.format(ma=ma)
-            elif abs(time.time() - self.ma_status[ma]) < 20:
-                result += '{ma}: ok; '.format(ma=ma)
-                ok_nodes += 1
-            else:
-                result += '{ma}: unresponsive, last seen at {time}; '.format(ma=ma, time=self.ma_status[ma])
-                unresponsive_nodes += 1
-        if unresponsive_nodes != 0:
-            err = 'MA went unresponsive: ' + result
-            logger.error(err)
-            raise RuntimeError(err)
-        if ok_nodes == len(self.nodeid_map):
-            result = 'All MA healthy. ' + result
+        self.stage_queue_size = opt.get('intf_daemon_queue_size', self.stage_queue_size)
+        self.recv_batch_size = opt.get('intf_daemon_recv_batch', self.recv_batch_size)
+        # Maps MA ID to the ts of its last PI message. Updated by the decode stage.
+        self.ma_status = dict()
+        self.receive_metrics = StageMetrics()
+        # Number of batches received and the time the receive stage spent on them
+        self.receive_batches = 0
+        self._receive_batch_time = 0.0
+        self._receive_max_batch_time = 0.0
+        self.health = HealthTracker(self.nodeid_map.values() if self.nodeid_map else None,
+                                    opt.get('ma_timeout'), on_event=self._log_health_event)
+        self.rejected_messages = 0
+        self.tick_listeners = []      # type: List[Callable[[AssembledTick], None]]
+        self._assembler = None        # type: TickAssembler
+        self._db_writer = None        # type: ReplayDBWriter
+        self._tick_ring = None
+        self._decode_stage = None     # type: PipelineStage
+        self._broadcast_stage = None  # type: PipelineStage
+        self._outbox = None
+        self._publisher = None
+        # Sequence number and frames of the latest action published. Only used by the broadcast stage.
+        self.action_seq = 0
+        self._last_action = None
+        self._heartbeat_ts = 0
+        self._error = None
+        # Guards abort_publisher_socket, which stop() uses from other threads
+        self._stop_lock = threading.Lock()
+
+    def _log_health_event(self, event: HealthEvent):
+        """Log a change of the health of an MA. An unresponsive MA is reported but doesn't stop the daemon."""
+        msg = 'MA {ma} went from {old} to {new}'.format(ma=event.ma_id, old=event.old_state, new=event.new_state)
+        if event.new_state == MA_UNRESPONSIVE:
+            logger.error(msg + ', last seen at {0}'.format(event.last_seen))
+        else:
+            logger.info(msg)
+
+    def _on_decode_idle(self):
+        """Emit the ticks whose deadline has passed and find MAs that have gone unresponsive.
+        Called by the decode stage when it is idle."""
+        self._assembler.check()
+        self.health.check()
+
+    def get_status(self) -> Dict[str, Any]:
+        """Return the metrics of all stages of the pipeline and the status of the ReplayDB"""
+        result = self.receive_metrics.get_status('receive')
+        batches = max(self.receive_batches, 1)
+        result['receive_batches'] = self.receive_batches
+        result['receive_avg_batch_size'] = self.receive_metrics.processed / batches
+        result['receive_avg_batch_time'] = self._receive_batch_time / batches
+        result['receive_max_batch_time'] = self._receive_max_batch_time
+        result['rejected_messages'] = self.rejected_messages
+        result['action_seq'] = self.action_seq
+        result.update(self.health.get_status())
+        if self._assembler:
+            result.update(self._assembler.get_status())
+        for stage in (self._decode_stage, self._broadcast_stage):
+            if stage:
+                result.update(stage.get_status())
+        if self._db_writer:
+            result.update(self._db_writer.get_status())
         return result
 
-    def _handle_status(self, caller):
+    def _handle_status(self, caller: bytes):
         """Handle the status query command
 
-        Check if all MAs are alive
+        Report the health of the MAs and the status of the pipeline, the ReplayDB and its writer
 
         :param caller: identity of the caller
         """
-        self.socket.send(caller, zmq.SNDMORE)
-        self.socket.send(self._health_check())
-
-    def _broadcast(self, req: List):
-        """Broadcast actions or heartbeats to all MAs
-
-        This function should only be called internally and is not thread-safe
-
-        :return:
+        status = '; '.join('{0}: {1}'.format(k, v) for k, v in sorted(self.get_status().items()))
+        self._broadcast_stage.put((caller, [(self.health.summary() + 'ReplayDB: ' + status).encode()], None))
+
+    def _decode_batch(self, batch: List[List[bytes]]):
+        """Handle a batch of messages received from the ROUTER socket. This is the decode stage."""
+        # All messages of a batch were received at about the same time
+        now = time.time()
+        for frames in batch:
+            self._decode(frames, now)
+
+    def _decode(self, frames: List[bytes], now: float):
+        """Handle a message received from the ROUTER socket
+
+        :param frames: the identity of the sender, the frames of the message, and the token of an
+                       action whose sender wants an acknowledgement
+        :param now: when the message was received
         """
-        for ma in self.ma_status:
-            logger.debug('Sending to MA {ma}'.format(ma=ma))
-            self._send_to_ma(ma, req)
-
-    def _send_to_ma(self, ma, obj):
-        """Send pickled obj to MA
-
-        self.socket must NOT be busy.
+        identity = frames[0]
+        try:
+            msg = LustreCommon.decode_message(frames[1:])
+            if msg.kind == LustreCommon.KIND_PI:
+                ma_id = LustreCommon.decode_ma_id(identity)
+            elif msg.kind == LustreCommon.KIND_BATCH:
+                # Decoded in full so that a truncated batch is dropped as a whole
+                entries = list(LustreCommon.decode_batch(msg.body))
+        except LustreCommon.ProtocolError as e:
+            self.rejected_messages += 1
+            logger.warning('Dropped a message from {ma_id}: {msg}; {n} dropped so far'.format(
+                ma_id=identity, msg=str(e), n=self.rejected_messages))
+            return
+        logger.debug('From {ma_id} received a message of kind {kind}'.format(ma_id=identity, kind=msg.kind))
+        if msg.kind == LustreCommon.KIND_PI:
+            self._insert_pi(ma_id, msg.ts, msg.body, now)
+        elif msg.kind == LustreCommon.KIND_BATCH:
+            # PIs of the MAs of an Aggregator
+            for ma_id, ts, pis in entries:
+                self._insert_pi(ma_id, ts, pis, now)
+        elif msg.kind == LustreCommon.KIND_STATUS:
+            self._handle_status(identity)
+        elif msg.kind == LustreCommon.KIND_RESEND:
+            logger.info('MA {0} missed an action'.format(identity))
+            self._broadcast_stage.put((identity, _LAST_ACTION, None))
+        elif msg.kind == LustreCommon.KIND_ACTION:
+            action = msg.body
+            if self.store_action:
+                self._db_writer.insert_action(int(time.time()), action[0])
+            logger.info('Broadcasting action {0}'.format(action[0]))
+            # MAs get the same message so one in protocol v2 is passed on as is
+            if msg.ver == LustreCommon.PROTOCOL_V2:
+                payload = frames[1:1 + msg.frames]
+            else:
+                payload = LustreCommon.encode_action_message(action, msg.ts)
+            token = frames[1 + msg.frames:]
+            ack = (identity, token[0], time.time()) if token else None
+            self._broadcast_stage.put((None, payload, ack))
+            # Sending action is also a kind of heartbeat
+            self._heartbeat_ts = time.time()
+        else:
+            logger.warning('Unexpected message of kind {0} received'.format(msg.kind))
+
+    def _insert_pi(self, ma_id: int, ts: float, pis: bytes, now: float):
+        """Add the PIs of an MA, given as a float64 buffer, to their tick"""
+        self.ma_status[ma_id] = ts
+        self.health.seen(ma_id, now)
+        self._assembler.add(ma_id, int(ts), pis)
+
+    def _emit_tick(self, tick: AssembledTick):
+        """Pass an assembled tick on to the ReplayDB, the tick ring and the listeners"""
+        self._db_writer.insert_tick(tick)
+        if self._tick_ring:
+            self._tick_ring.put_tick(tick)
+        for listener in self.tick_listeners:
+            listener(tick)
+
+    def _insert_late_pi(self, ma_id: int, ts: int, pis: np.ndarray):
+        """Store PIs that arrived after their tick had been assembled"""
+        self._db_writer.insert_pi(ma_id, ts, pis)
+        if self._tick_ring:
+            self._tick_ring.put(ma_id, ts, pis)
+
+    def _send(self, item: Tuple[Optional[bytes], List[bytes], Optional[Tuple[bytes, bytes, float]]]):
+        """Send a message to an MA, or publish it to all MAs if the identity is None. This is the
+        broadcast stage.
+
+        Messages to an MA are passed to the receive stage, which owns the ROUTER socket.
+
+        :param item: (identity, frames of the message, ack). The message is _LAST_ACTION to resend
+                     the latest action. If ack is not None, it's the identity of the sender of an
+                     action, its token and the time the action was received, and the sender is told
+                     how long the broadcast took.
         """
-        self.socket.send(str(ma).encode('ascii'), zmq.SNDMORE)
-        self.socket.send(zlib.compress(pickle.dumps(obj)))
+        identity, payload, ack = item
+        if identity is None:
+            # The second byte of the header is the kind
+            if payload[0][1] == LustreCommon.KIND_ACTION:
+                self.action_seq += 1
+                self._last_action = [LustreCommon.BROADCAST_SEQ.pack(self.action_seq)] + payload
+                frames = self._last_action
+            else:
+                frames = [LustreCommon.BROADCAST_SEQ.pack(self.action_seq)] + payload
+            self._publisher.send_multipart(frames)
+        elif payload is _LAST_ACTION:
+            if self._last_action:
+                self._post([identity] + self._last_action)
+        else:
+            logger.debug('Sending to MA {ma}'.format(ma=identity))
+            self._post([identity] + payload)
+        if ack:
+            self._post([ack[0], b'ACK', ack[1], repr(time.time() - ack[2]).encode('ascii')])
+
+    def _post(self, frames: List[bytes]):
+        """Pass a message to the receive stage for sending"""
+        try:
+            self._outbox.send_multipart(frames, zmq.NOBLOCK)
+        except zmq.Again:
+            self._broadcast_stage.metrics.dropped += 1
+
+    def _heartbeat_if_due(self):
+        """Broadcast a heartbeat. Called by the broadcast stage when it is idle."""
+        # Use 0.9 here so we would still send out heartbeat if poll took something like 0.98 seconds
+        if time.time() - self._heartbeat_ts > 0.9:
+            logger.debug('Broadcasting heartbeat')
+            self._send((None, LustreCommon.encode_message(LustreCommon.KIND_HB), None))
+            self._heartbeat_ts = time.time()
+
+    def _recv_batch(self, s: zmq.Socket) -> List[List[bytes]]:
+        """Receive up to recv_batch_size messages that are pending on a socket without blocking"""
+        batch = []
+        try:
+            while len(batch) < self.recv_batch_size:
+                batch.append(s.recv_multipart(zmq.NOBLOCK))
+        except zmq.Again:
+            pass
+        return batch
+
+    def _stop_on_error(self, e: BaseException):
+        """Called by a stage that has failed. The receive stage stops the daemon within a second."""
+        if self._error is None:
+            self._error = e
 
     # Anecdotal evidence suggests that 127.0.0.1 works but localhost doesn't:
     # https://stackoverflow.com/questions/21759094/pyzmq-push-socket-does-not-block-on-send#comment33001703_21766554
     @staticmethod
-    def broadcast_action(action, intf_daemon_loc: str = 'tcp://127.0.0.1:9123'):
+    def broadcast_action(action, intf_daemon_loc: str = 'tcp://127.0.0.1:9123', ack: bool = False) -> Optional[float]:
         """Broadcast action to all connected MAs
 
-        This function is thread-safe
+        This function is thread-safe. Each thread reuses its own connection to IntfDaemon, see
+        ActionClient.
 
         :param action: The action to broadcast. The first element should be the action that
                        will be saved to DB. The rest of the list is complementary data that
                        will be sent to CAs but not stored in DB.
         :param intf_daemon_loc:
+        :param ack: wait for IntfDaemon to acknowledge the broadcast
+        :return: if ack is True, the seconds IntfDaemon spent on the broadcast, or None if it
+                 didn't acknowledge in time
         """
-        assert isinstance(action[0], int)
-        context = zmq.Context()
-        s = context.socket(zmq.DEALER)
-        s.setsockopt(zmq.IDENTITY, '-1'.encode('ascii'))
-        s.connect(intf_daemon_loc)
-        data = [LustreCommon.protocol_ver, int(time.time()), b'ACTION'] + action
-        s.send(zlib.compress(pickle.dumps(data)))
+        return get_action_client(intf_daemon_loc).send(action, ack)
 
     def start(self):
         """Starts the Interface Daemon and listens on the port
+
+        The calling thread becomes the receive stage. Returns after stop() has been called, or
+        raises the error that stopped a stage.
         """
         assert not self.socket, 'Server already started.'
-        # ReplayDB must be created in start(), which may be run in a separate thread.
-        # SQLite doesn't like the DBConn be created in different threads.
-        db = ReplayDB(self.opt)
+        self._error = None
+        # All DB writes are done by the writer thread so a slow DB never blocks the message loop
+        self._db_writer = ReplayDBWriter(self.opt)
+        self._db_writer.start()
+        # Fresh ticks are also published in shared memory for DQLDaemon
+        self._tick_ring = open_tick_ring(self.opt, create=True)
+        self._assembler = TickAssembler(self.nodeid_map.values() if self.nodeid_map else None,
+                                        self.opt.get('tick_max_delay'), on_tick=self._emit_tick,
+                                        on_late=self._insert_late_pi)
 
         context = zmq.Context()
         self.socket = context.socket(zmq.ROUTER)
         self.socket.set_hwm(5000)
+        # An MA that reconnects with the same identity takes over from its old connection
+        self.socket.setsockopt(zmq.ROUTER_HANDOVER, 1)
         self.socket.bind('tcp://*:{port}'.format(port=self.port))
         logger.info('Listening on port {port}'.format(port=self.port))
 
+        # Only used by the broadcast stage. Slow subscribers lose messages instead of blocking it.
+        self._publisher = context.socket(zmq.PUB)
+        self._publisher.set_hwm(1000)
+        self._publisher.bind('tcp://*:{port}'.format(port=self.pub_port))
+
         self.abort_publisher_socket = context.socket(zmq.PUSH)
         self.abort_publisher_socket.bind(self._abort_inproc_addr)
 
         self.abort_subscriber_socket = context.socket(zmq.PULL)
         self.abort_subscriber_socket.connect(self._abort_inproc_addr)
 
+        outbox_receiver = context.socket(zmq.PULL)
+        outbox_receiver.bind(self._outbox_inproc_addr)
+        # Only used by the broadcast stage
+        self._outbox = context.socket(zmq.PUSH)
+        self._outbox.connect(self._outbox_inproc_addr)
+
+        self._broadcast_stage = PipelineStage('broadcast', self._send, self.stage_queue_size,
+                                              on_idle=self._heartbeat_if_due, idle_interval=0.1,
+                                              on_error=self._stop_on_error)
+        self._decode_stage = PipelineStage('decode', self._decode_batch, self.stage_queue_size,
+                                           on_idle=self._on_decode_idle, idle_interval=0.1,
+                                           on_error=self._stop_on_error, item_size=len)
+        self._broadcast_stage.start()
+        self._decode_stage.start()
+
         poller = zmq.Poller()
         poller.register(self.socket, zmq.POLLIN)
+        poller.register(outbox_receiver, zmq.POLLIN)
         poller.register(self.abort_subscriber_socket, zmq.POLLIN)
 
-        heartbeat_ts = time.time()
-        while True:
-            flush_log()
-            p = dict(poller.poll(1000))
-            if self.socket in p:
-                ma_id = int(self.socket.recv())
-                req = pickle.loads(zlib.decompress(self.socket.recv()))
-                logger.debug('From {ma_id} received {data}'.format(ma_id=ma_id, data=str(req)))
-                assert req[0] == LustreCommon.protocol_ver
-                ts = req[1]
-                # the data payload maybe an empty list
-                if len(req) >= 3 and isinstance(req[2], bytes):
-                    # this is a command, not data
-                    cmd = req[2]
-                    if cmd == b'STATUS':
-                        self._handle_status(ma_id)
-                    elif cmd == b'ACTION':
-                        action = req[3:]
-                        if self.store_action:
-                            db.insert_action(int(time.time()), action[0])
-                        logger.info('Broadcasting action {0}'.format(action[0]))
-                        self._broadcast(req)
-                        # Sending action is also a kind of heartbeat
-                        heartbeat_ts = time.time()
-                    else:
-                        logger.warning('Unknown command received: ' + cmd)
-                else:
-                    self.ma_status[ma_id] = ts
-                    db.insert_pi(ma_id, int(ts), req[2:])
-            elif self.abort_subscriber_socket in p:
-                logger.debug('IntfDaemon stopped')
-                self.socket.close()
-                break
-
-            # Use 0.9 here so we would still send out heartbeat if poll took something like 0.98 seconds
-            if time.time() - heartbeat_ts > 0.9:
-                logger.debug('Broadcasting heartbeat')
-                self._broadcast([LustreCommon.protocol_ver, time.time(), b'HB'])
-                heartbeat_ts = time.time()
-
-            # health check
-            health_status = self._health_check()
-            if health_status != self.prev_health_status:
-                logger.info(health_status)
-                self.prev_health_status = health_status
+        # The stages, the writer and the ring must be shut down however the loop ends, e.g. by an
+        # error of a bad message. Otherwise queued rows are lost and readers keep using a stale ring.
+        try:
+            while self._error is None:
+                flush_log()
+                p = dict(poller.poll(1000))
+                if self.socket in p:
+                    start_time = time.time()
+                    batch = self._recv_batch(self.socket)
+                    if batch:
+                        self._decode_stage.put(batch)
+                        batch_time = time.time() - start_time
+                        self.receive_batches += 1
+                        self._receive_batch_time += batch_time
+                        self._receive_max_batch_time = max(self._receive_max_batch_time, batch_time)
+                        self.receive_metrics.record(0, batch_time, len(batch))
+                if outbox_receiver in p:
+                    for frames in self._recv_batch(outbox_receiver):
+                        self.socket.send_multipart(frames)
+                if self.abort_subscriber_socket in p:
+                    break
+        finally:
+            # In the order of the pipeline so queued messages are passed on
+            self._decode_stage.stop()
+            self._broadcast_stage.stop()
+            # The decode stage has stopped, so the ticks it has been assembling can be passed on here
+            self._assembler.flush()
+            self._db_writer.stop()
+            if self._tick_ring:
+                self._tick_ring.close()
+            with self._stop_lock:
+                for s in (self._outbox, outbox_receiver, self.abort_subscriber_socket,
+                          self.abort_publisher_socket, self._publisher, self.socket):
+                    s.close(linger=0)
+                self.abort_publisher_socket = None
+            context.term()
+            logger.debug('IntfDaemon stopped')
+        if self._error is not None:
+            raise self._error
 
     def stop(self):
         """Stop the daemon
 
-        This function is thread-safe
+        This function is thread-safe. Nothing is done if the daemon has already stopped.
         """
-        assert self.socket
-        assert self.abort_publisher_socket
-        assert self.abort_subscriber_socket
-
-        self.abort_publisher_socket.send(b'STOP')
+        assert self.socket, 'Server not started.'
+        with self._stop_lock:
+            if self.abort_publisher_socket:
+                self.abort_publisher_socket.send(b'STOP')
@@ -37,14 +37,231 @@ OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from .ascar_logging import *
 import glob
+import math
+import numbers
 import os
+import pickle
 import re
-from typing import Dict
+import struct
+import time
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Tuple, Union
+import zlib
 
 __author__ = 'Yan Li'
 __copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
 
-protocol_ver = 1
+# Protocol v1 messages are a single frame of zlib.compress(pickle.dumps([ver, ts, ...])), where
+# the rest of the list is either the PIs or a command followed by its arguments.
+#
+# Protocol v2 messages have two frames: a header of MESSAGE_HEADER and a body. The body of a PI
+# message is the PIs as a raw little-endian float64 buffer, which IntfDaemon stores as is. The
+# body of an action is the pickled action list, and heartbeats and status queries have an empty
+# body. The sender deflates a body only if it is at least compress_threshold bytes long and
+# shrinks enough, and sets FLAG_DEFLATED in the header if it did.
+#
+# IntfDaemon publishes heartbeats and actions on a PUB socket, prefixed by a frame of
+# BROADCAST_SEQ: the sequence number of the action, or of the latest action for a heartbeat.
+# An MA that sees a gap has missed an action and may ask for the latest one with KIND_RESEND.
+#
+# An Aggregator sends the PIs of all its MAs for a tick in one KIND_BATCH message, whose body is
+# a BATCH_ENTRY followed by the float64 PIs for each MA.
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+protocol_ver = PROTOCOL_V2
+MESSAGE_HEADER = struct.Struct('<BBBd')    # ver, kind, flags, ts
+KIND_PI = 0
+KIND_HB = 1
+KIND_ACTION = 2
+KIND_STATUS = 3
+KIND_RESEND = 4
+KIND_BATCH = 5
+# Commands of protocol v1 and the message kinds they correspond to
+COMMAND_KINDS = {b'HB': KIND_HB, b'ACTION': KIND_ACTION, b'STATUS': KIND_STATUS, b'RESEND': KIND_RESEND}
+BROADCAST_SEQ = struct.Struct('<Q')
+BATCH_ENTRY = struct.Struct('<IdI')        # ma_id, ts, number of PIs
+FLAG_DEFLATED = 1
+compress_threshold = 1024
+# The first byte of a zlib stream, with which every v1 message starts
+_V1_FIRST_BYTE = 0x78
+
+
+class ProtocolError(ValueError):
+    """A message of an unknown protocol version, or a malformed header or body"""
+    pass
+
+
+class Message(NamedTuple):
+    """A decoded message
+
+    Attributes:
+        ver: protocol version the message was sent in
+        kind: one of the KIND_* constants
+        ts: timestamp set by the sender
+        body: for KIND_PI, the PIs as a little-endian float64 buffer; for KIND_ACTION, the
+              action list; otherwise empty
+        frames: number of frames the message took up. Frames after them belong to the caller.
+    """
+    ver: int
+    kind: int
+    ts: float
+    body: Union[bytes, List]
+    frames: int
+
+
+def encode_message(kind: int, body: bytes = b'', ts: float = None) -> List[bytes]:
+    """Encode a protocol v2 message
+
+    :param ts: defaults to now
+    :return: the frames of the message
+    """
+    flags = 0
+    if len(body) >= compress_threshold:
+        deflated = zlib.compress(body, 1)
+        # Not worth the decompression if it saves less than 1/8
+        if len(deflated) < len(body) - len(body) // 8:
+            body = deflated
+            flags |= FLAG_DEFLATED
+    return [MESSAGE_HEADER.pack(PROTOCOL_V2, kind, flags, time.time() if ts is None else ts), body]
+
+
+def encode_pi_message(pis: List[float], ts: float = None) -> List[bytes]:
+    return encode_message(KIND_PI, struct.pack('<{0}d'.format(len(pis)), *pis), ts)
+
+
+def encode_action_message(action: List, ts: float = None) -> List[bytes]:
+    return encode_message(KIND_ACTION, pickle.dumps(list(action)), ts)
+
+
+def _decompress(data: bytes) -> bytes:
+    try:
+        return zlib.decompress(data)
+    except zlib.error as e:
+        raise ProtocolError('Corrupted body: {0}'.format(e)) from e
+
+
+def _loads(data: bytes, deflated: bool):
+    """Unpickle data, which is deflated if deflated is True"""
+    if deflated:
+        data = _decompress(data)
+    try:
+        return pickle.loads(data)
+    except Exception as e:
+        # A corrupted pickle can raise almost any exception
+        raise ProtocolError('Corrupted body: {0}'.format(e)) from e
+
+
+def _check_ts(ts) -> float:
+    """Return ts if it's a finite number, otherwise raise ProtocolError"""
+    if not isinstance(ts, numbers.Real) or isinstance(ts, bool) or not math.isfinite(ts):
+        raise ProtocolError('Malformed ts {0!r}'.format(ts))
+    return ts
+
+
+def _check_action(action) -> List:
+    """Return action if it's a list that starts with the action ID, otherwise raise ProtocolError"""
+    if not isinstance(action, list) or not action or not isinstance(action[0], int):
+        raise ProtocolError('Malformed action')
+    return action
+
+
+def decode_message(frames: List[bytes]) -> Message:
+    """Decode a message of protocol v1 or v2 that starts at frames[0]
+
+    Raises ProtocolError for an unknown protocol version or message kind, a ts that is not a
+    finite number, or a body that can't be decoded.
+    """
+    first = frames[0]
+    if first[:1] == bytes([_V1_FIRST_BYTE]):
+        req = _loads(first, True)
+        if not isinstance(req, list) or len(req) < 2:
+            raise ProtocolError('Malformed message')
+        if req[0] != PROTOCOL_V1:
+            raise ProtocolError('Unknown protocol version {0}'.format(req[0]))
+        if len(req) >= 3 and isinstance(req[2], bytes):
+            if req[2] not in COMMAND_KINDS:
+                raise ProtocolError('Unknown command {0}'.format(req[2]))
+            kind = COMMAND_KINDS[req[2]]
+            body = _check_action(req[3:]) if kind == KIND_ACTION else b''
+        else:
+            kind = KIND_PI
+            try:
+                body = struct.pack('<{0}d'.format(len(req) - 2), *req[2:])
+            except struct.error as e:
+                raise ProtocolError('Malformed PIs: {0}'.format(e)) from e
+        return Message(PROTOCOL_V1, kind, _check_ts(req[1]), body, 1)
+
+    if len(first) != MESSAGE_HEADER.size or first[0] != PROTOCOL_V2:
+        raise ProtocolError('Unknown protocol version {0}'.format(first[0] if first else None))
+    if len(frames) < 2:
+        raise ProtocolError('Message body is missing')
+    ver, kind, flags, ts = MESSAGE_HEADER.unpack(first)
+    body = frames[1]
+    if kind == KIND_ACTION:
+        body = _check_action(_loads(body, flags & FLAG_DEFLATED))
+    elif kind not in (KIND_PI, KIND_HB, KIND_STATUS, KIND_RESEND, KIND_BATCH):
+        raise ProtocolError('Unknown message kind {0}'.format(kind))
+    elif flags & FLAG_DEFLATED:
+        body = _decompress(body)
+    return Message(ver, kind, _check_ts(ts), body, 2)
+
+
+def encode_batch_message(entries: Iterable[Tuple[int, float, bytes]], ts: float = None) -> List[bytes]:
+    """Encode the PIs of several MAs in one message
+
+    :param entries: (ma_id, ts, PIs as a float64 buffer) of each MA
+    """
+    parts = []
+    for ma_id, pi_ts, pis in entries:
+        parts.append(BATCH_ENTRY.pack(ma_id, pi_ts, len(pis) // 8))
+        parts.append(pis)
+    return encode_message(KIND_BATCH, b''.join(parts), ts)
+
+
+def decode_batch(body: bytes) -> Iterator[Tuple[int, float, bytes]]:
+    """Iterate over (ma_id, ts, PIs as a float64 buffer) of the body of a KIND_BATCH message
+
+    Raises ProtocolError when it reaches a truncated entry or a ts that is not a finite number.
+    """
+    offset = 0
+    while offset < len(body):
+        if offset + BATCH_ENTRY.size > len(body):
+            raise ProtocolError('Truncated batch')
+        ma_id, ts, n = BATCH_ENTRY.unpack_from(body, offset)
+        offset += BATCH_ENTRY.size
+        if offset + n * 8 > len(body):
+            raise ProtocolError('Truncated batch')
+        yield ma_id, _check_ts(ts), body[offset:offset + n * 8]
+        offset += n * 8
+
+
+def decode_ma_id(identity: bytes) -> int:
+    """Return the ID of the MA whose socket has identity, which is the ID as a decimal string
+
+    Raises ProtocolError if identity is not an MA ID.
+    """
+    try:
+        return int(identity)
+    except ValueError:
+        raise ProtocolError('Identity {0} is not an MA ID'.format(identity)) from None
+
+
+def get_pub_port(opt: dict, loc: str = None) -> int:
+    """Return the port of the PUB socket of the daemon at loc, which defaults to intf_daemon_loc
+
+    This is the same for IntfDaemon and an Aggregator, so an MA finds it the same way whichever
+    of them its intf_daemon_loc points at: opt['intf_daemon_pub_port'] if it's set, otherwise
+    the port after the ROUTER port of loc.
+    """
+    if 'intf_daemon_pub_port' in opt:
+        return opt['intf_daemon_pub_port']
+    if loc is None:
+        loc = opt.get('intf_daemon_loc', 'localhost:9123')
+    return int(loc.split(':')[1]) + 1
+
+
+def decode_pis(body: bytes) -> List[float]:
+    """Return the PIs of the body of a KIND_PI message as a list"""
+    return list(struct.unpack('<{0}d'.format(len(body) // 8), body))
 
 
 def extract_ack_ewma_from_import(import_data: str) -> float:
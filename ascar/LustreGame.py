@@ -57,6 +57,7 @@ import resource
 import time
 from .ReplayDB import *
 from .IntfDaemon import IntfDaemon
+from .TickRing import TickRing, open_tick_ring
 from .ascar_logging import logger
 
 __author__ = 'Yan Li'
@@ -71,16 +72,21 @@ class Lustre(object):
     """ The Lustre Game Class
 
     :type cpvs: List[float]
-    :type db: ReplayDB
+    :type db: ReplayDBBackend
     :type memcache: List[MemcacheEntry]
+    :type memcache_cursor: TailCursor
     :type opt: dict
     :type pi_per_client_obd: int
+    :type tick_ring: TickRing
     """
+    action_ack = False
+    action_loc = None
     cpvs = None
     db = None
+    tick_ring = None
     memcache = None
     memcache_bad_idx = set()
-    memcache_last_rowid = 0
+    memcache_cursor = None
     num_actions = None
     ticks_per_observation = 4
 
@@ -101,16 +107,30 @@ class Lustre(object):
         self.pi_per_client_obd = opt['pi_per_client_obd']
         self.observation_size = opt['tick_data_size'] * self.ticks_per_observation
         self.minibatch_size = opt.get('minibatch_size', 32)
+        # IntfDaemon runs on the same host as the game
+        port = opt['intf_daemon_loc'].split(':')[1] if 'intf_daemon_loc' in opt else '9123'
+        self.action_loc = 'tcp://127.0.0.1:' + port
+        self.action_ack = opt.get('action_ack', False)
         if not lazy_db_init:
             self.connect_db()
         self.num_actions = opt['num_actions']
 
     def connect_db(self):
         if not self.db:
-            self.db = ReplayDB(self.opt)
+            # The game only reads; the IntfDaemon is the writer
+            self.db = open_replay_db(dict(self.opt, replaydb_read_only=True))
+        self._attach_tick_ring()
 
         self.refresh_memcache()
 
+    def _attach_tick_ring(self):
+        """Attach to IntfDaemon's tick ring, or the new one if IntfDaemon has been restarted"""
+        if self.tick_ring and self.tick_ring.closed:
+            self.tick_ring.close()
+            self.tick_ring = None
+        if not self.tick_ring:
+            self.tick_ring = open_tick_ring(self.opt)
+
     @staticmethod
     def is_over():
         return False
@@ -119,8 +139,11 @@ class Lustre(object):
     def store(*unused):
         pass
 
-    def perform_action(self, action_id: int):
+    def perform_action(self, action_id: int) -> Optional[float]:
         """Send the new action to IntfDaemon
+
+        :return: if opt['action_ack'] is set, the seconds IntfDaemon spent on broadcasting the
+                 action, or None if it didn't acknowledge in time
         """
         assert 0 <= action_id < self.num_actions
 
@@ -150,11 +173,18 @@ class Lustre(object):
 
         # Broadcast action must begin with action_id, which will be saved by
         # IntfDaemon to the DB.
-        IntfDaemon.broadcast_action([action_id] + self.cpvs)
+        return IntfDaemon.broadcast_action([action_id] + self.cpvs, self.action_loc, self.action_ack)
 
     def observe(self) -> np.ndarray:
-        """Return observation vector using memcache.
+        """Return observation vector using the tick ring, or memcache if the ring has no valid one.
         """
+        self._attach_tick_ring()
+        if self.tick_ring:
+            try:
+                return self.tick_ring.get_last_observation(self.ticks_per_observation,
+                                                           self.db.missing_entry_tolerance)
+            except NotEnoughDataError:
+                pass
         err_msg = 'No valid observation in the past two seconds'
         if len(self.memcache) < self.ticks_per_observation:
             raise NotEnoughDataError(err_msg)
@@ -214,29 +244,46 @@ class Lustre(object):
         return result
 
     def refresh_memcache(self):
+        """Append the ticks stored since the last refresh to memcache
+
+        The DB is followed by a TailCursor so only new rows are read, in bounded chunks.
+        """
         logger.info('Loading cache')
-        c = self.db.conn.cursor()
-        # Use a large arraysize to increase read speed; we don't care about memory usage
-        c.arraysize = 1000000
         if not self.memcache:
             self.memcache = list()
+            # Maps ts to its index in memcache, and actions of the ticks that are not in memcache yet
+            self._memcache_idx = dict()
+            self._memcache_actions = dict()
+        if not self.memcache_cursor:
+            self.memcache_cursor = self.db.tail()
         preloading_cache_size = len(self.memcache)
-        c.execute('''SELECT pis.rowid, pis.ma_id, pis.ts, pi_data, action
-                     FROM pis LEFT JOIN actions ON pis.ts=actions.ts
-                     WHERE pis.rowid > ? ORDER BY pis.ts, pis.ma_id''',
-                  (self.memcache_last_rowid,))
-        f = c.fetchall()
-        for row in f:
-            self.memcache_last_rowid = max(self.memcache_last_rowid, row[0])
-            ma_id, ts, pi_data = row[1], row[2], pickle.loads(row[3])
-            action = row[4] if row[4] else 0
-            if ma_id not in self.db.ordered_client_list:
-                continue
-            assert len(pi_data) == self.db.tick_data_size // len(self.db.ordered_client_list)
-
-            if len(self.memcache) == 0 or self.memcache[-1][0] != ts:
-                self.memcache.append((ts, action, [None] * len(self.db.ordered_client_list)))
-            self.memcache[-1][2][self.db.ordered_client_list.index(ma_id)] = np.array(pi_data)
+        client_idx = {ma_id: i for i, ma_id in enumerate(self.db.ordered_client_list)}
+        for chunk in self.memcache_cursor:
+            for i in np.flatnonzero(chunk.has_pi):
+                ts = int(chunk.ts[i])
+                ma_idx = client_idx.get(int(chunk.ma_id[i]))
+                if ma_idx is None:
+                    continue
+                idx = self._memcache_idx.get(ts)
+                if idx is None:
+                    if self.memcache and ts < self.memcache[-1][0]:
+                        # memcache is ordered by ts so ticks that arrive late are left out
+                        logger.debug('Dropped the late PI of ts {0} from memcache'.format(ts))
+                        continue
+                    idx = self._memcache_idx[ts] = len(self.memcache)
+                    self.memcache.append((ts, self._memcache_actions.pop(ts, 0),
+                                          [None] * len(self.db.ordered_client_list)))
+                self.memcache[idx][2][ma_idx] = chunk.pis[i]
+            for ts, action in zip(chunk.action_ts.tolist(), chunk.actions.tolist()):
+                idx = self._memcache_idx.get(ts)
+                if idx is None:
+                    self._memcache_actions[ts] = action
+                else:
+                    self.memcache[idx] = (ts, action, self.memcache[idx][2])
+            if self.memcache:
+                # Actions of ticks older than the last one can no longer be used
+                last_ts = self.memcache[-1][0]
+                self._memcache_actions = {ts: a for ts, a in self._memcache_actions.items() if ts > last_ts}
 
         # Peak memory usage (bytes on OS X, kilobytes on Linux)
         # https://stackoverflow.com/a/7669482
@@ -245,6 +292,11 @@ class Lustre(object):
             size=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
 
     def get_minibatch_from_db(self):
+        # All samples are taken from one snapshot so the ranges and the observations agree
+        with self.db.snapshot():
+            return self._get_minibatch_from_db()
+
+    def _get_minibatch_from_db(self):
         good_ts = set()
         bad_ts = set()
         result = []
@@ -268,24 +320,26 @@ class Lustre(object):
             if total_sample_size <= len(result):
                 return result
             required_samples = min(total_sample_size, required_samples)
-            samples = random.sample(range(min_ts, max_ts), required_samples - len(result))
-            for ts in samples:
-                if ts in good_ts or ts in bad_ts:
-                    continue
-                try:
-                    observ = self.db.get_observation(ts)
-                    observ_next = self.db.get_observation(ts + 1)
-                    reward = self._calc_total_throughput(observ_next) - self._calc_total_throughput(observ)
-                    # The final ts is only used in test cases
-                    result.append((observ, self.db.get_action(ts), reward, observ_next, ts))
-
-                    good_ts.add(ts)
-                    if len(result) == required_samples:
-                        self.TestSample = list(good_ts)
-                        return result
-                except NotEnoughDataError:
+            samples = [ts for ts in random.sample(range(min_ts, max_ts), required_samples - len(result))
+                       if ts not in good_ts and ts not in bad_ts]
+            # Fetch the observations of ts and ts+1 of all samples in one go
+            observs, valid = self.db.get_observations(samples + [ts + 1 for ts in samples])
+            n = len(samples)
+            for i, ts in enumerate(samples):
+                if not (valid[i] and valid[n + i]):
                     logger.warning('NotEnoughDataError for ts {0}'.format(ts))
                     bad_ts.add(ts)
+                    continue
+                observ = observs[i]
+                observ_next = observs[n + i]
+                reward = self._calc_total_throughput(observ_next) - self._calc_total_throughput(observ)
+                # The final ts is only used in test cases
+                result.append((observ, self.db.get_action(ts), reward, observ_next, ts))
+
+                good_ts.add(ts)
+                if len(result) == required_samples:
+                    self.TestSample = list(good_ts)
+                    return result
 
     def get_observation_by_cache_idx(self, idx: int) -> np.ndarray:
         assert 0 <= idx < len(self.memcache)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+
+"""ASCAR ReplayDB memory-mapped columnar backend"""
+
+import numpy as np
+import os
+import time
+from typing import *
+from .ReplayDB import ReplayDBBackend, NotEnoughDataError, TailChunk, PI_DTYPE, pi_array
+from .ascar_logging import logger
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+NO_ACTION = np.iinfo(np.int64).min
+NO_TS = -1
+
+# Layout of the sidecar index. The slot table follows the header.
+IDX_VERSION = 0
+IDX_BASE_TS = 1
+IDX_CAPACITY = 2
+IDX_NUM_SLOTS = 3
+IDX_PI_LEN = 4
+IDX_PI_MIN_TS = 5
+IDX_PI_MAX_TS = 6
+IDX_ACTION_MIN_TS = 7
+IDX_ACTION_MAX_TS = 8
+IDX_PI_ROWS = 9
+IDX_ACTION_ROWS = 10
+IDX_SLOT_TABLE = 16
+MEMMAP_FORMAT_VERSION = 1
+
+
+class MemmapReplayDB(ReplayDBBackend):
+    """The memory-mapped columnar backend of ReplayDB
+
+    Ticks are stored in append-only files next to opt['dbfile']:
+        dbfile.pis:     float64 array of [ts, ma_idx, pi]
+        dbfile.present: uint8 array of [ts, ma_idx], 1 if the PI of that MA at that ts has been received
+        dbfile.actions: int64 array of [ts], NO_ACTION if no action was taken at that ts
+        dbfile.idx:     the sidecar index, an int64 array holding the header and the slot table
+
+    ts is counted from the first ts that has been stored (base_ts). ma_idx is the slot of an MA in the
+    slot table, which maps slots to MA IDs. The files grow by memmap_grow_ticks ticks at a time.
+    Observation windows are slices of the arrays so no query is needed.
+
+    The files can't grow backwards, so data older than the first stored ts minus memmap_backfill_ticks
+    are dropped.
+
+    Only one process can write to a DB. Other processes can read it at the same time.
+    """
+    backfill_ticks = 60
+    grow_ticks = 3600
+
+    def __init__(self, opt: dict):
+        ReplayDBBackend.__init__(self, opt)
+        self.backfill_ticks = opt.get('memmap_backfill_ticks', self.backfill_ticks)
+        self.grow_ticks = opt.get('memmap_grow_ticks', self.grow_ticks)
+        self.dbfile = opt['dbfile']
+        self._unflushed_rows = 0
+        self._last_flush_time = time.time()
+        if not os.path.exists(self.dbfile + '.idx'):
+            self._create()
+        self._idx = np.memmap(self.dbfile + '.idx', dtype=np.int64, mode='r+')
+        if self._idx[IDX_VERSION] != MEMMAP_FORMAT_VERSION:
+            raise ValueError('Unknown memmap ReplayDB version {0}'.format(self._idx[IDX_VERSION]))
+        if self._idx[IDX_NUM_SLOTS] != self.num_ma or self._idx[IDX_PI_LEN] != self.pi_per_ma:
+            raise ValueError('{0} has {1} slots and {2} PIs per MA, which don\'t match opt'.format(
+                self.dbfile, self._idx[IDX_NUM_SLOTS], self._idx[IDX_PI_LEN]))
+        self._slot_table = self._idx[IDX_SLOT_TABLE:IDX_SLOT_TABLE + self.num_ma]
+        self._slots = dict()
+        self._capacity = 0
+        self._refresh()
+        logger.info('Opened memmap database %s' % self.dbfile)
+
+    def _create(self):
+        idx = np.full(IDX_SLOT_TABLE + self.num_ma, NO_TS, dtype=np.int64)
+        idx[IDX_VERSION] = MEMMAP_FORMAT_VERSION
+        idx[IDX_CAPACITY] = 0
+        idx[IDX_NUM_SLOTS] = self.num_ma
+        idx[IDX_PI_LEN] = self.pi_per_ma
+        idx[IDX_PI_ROWS] = 0
+        idx[IDX_ACTION_ROWS] = 0
+        if self.nodeid_map:
+            # Pre-assign the slots so they are sorted by MA ID
+            idx[IDX_SLOT_TABLE:] = sorted(self.nodeid_map.values())
+        for ext in ('.pis', '.present', '.actions'):
+            open(self.dbfile + ext, 'wb').close()
+        # The index is created last so other processes won't see a half created DB
+        idx.tofile(self.dbfile + '.idx.tmp')
+        os.replace(self.dbfile + '.idx.tmp', self.dbfile + '.idx')
+
+    def _map(self, capacity: int):
+        """(Re)map the data files to capacity ticks"""
+        self._capacity = capacity
+        if capacity == 0:
+            self._pis = np.zeros((0, self.num_ma, self.pi_per_ma), dtype=PI_DTYPE)
+            self._present = np.zeros((0, self.num_ma), dtype=np.uint8)
+            self._actions = np.zeros((0,), dtype=np.int64)
+            return
+        self._pis = np.memmap(self.dbfile + '.pis', dtype=PI_DTYPE, mode='r+',
+                              shape=(capacity, self.num_ma, self.pi_per_ma))
+        self._present = np.memmap(self.dbfile + '.present', dtype=np.uint8, mode='r+',
+                                  shape=(capacity, self.num_ma))
+        self._actions = np.memmap(self.dbfile + '.actions', dtype=np.int64, mode='r+', shape=(capacity,))
+
+    def _refresh(self):
+        """Pick up the changes made by the writer"""
+        capacity = int(self._idx[IDX_CAPACITY])
+        if capacity != self._capacity:
+            self._map(capacity)
+
+    def _grow(self, capacity: int):
+        old_capacity = self._capacity
+        capacity = (capacity + self.grow_ticks - 1) // self.grow_ticks * self.grow_ticks
+        # Grow the files before publishing the new capacity to readers
+        for ext, row_size in (('.pis', self.num_ma * self.pi_per_ma * PI_DTYPE.itemsize),
+                              ('.present', self.num_ma),
+                              ('.actions', np.dtype(np.int64).itemsize)):
+            with open(self.dbfile + ext, 'r+b') as f:
+                f.truncate(capacity * row_size)
+        self._map(capacity)
+        self._actions[old_capacity:] = NO_ACTION
+        self._idx[IDX_CAPACITY] = capacity
+
+    def _slot(self, ma_id: int, assign: bool = False) -> Optional[int]:
+        if ma_id not in self._slots:
+            # The slot table may have been changed by the writer
+            self._slots = {int(x): i for i, x in enumerate(self._slot_table) if x != NO_TS}
+        if ma_id not in self._slots and assign:
+            free = np.flatnonzero(self._slot_table == NO_TS)
+            if len(free) == 0:
+                raise ValueError('No free slot for MA {0}. Is num_ma correct?'.format(ma_id))
+            self._slot_table[free[0]] = ma_id
+            self._slots[ma_id] = int(free[0])
+        return self._slots.get(ma_id)
+
+    def _row(self, ts: int) -> int:
+        """Get the row of ts for writing. The base ts is set on the first write."""
+        if self._idx[IDX_BASE_TS] == NO_TS:
+            # Leave some room for data that arrive out of order at the beginning
+            self._idx[IDX_BASE_TS] = ts - self.backfill_ticks
+        row = ts - int(self._idx[IDX_BASE_TS])
+        if row < 0:
+            raise ValueError('ts {0} is before the first ts of the DB'.format(ts))
+        if row >= self._capacity:
+            self._grow(row + 1)
+        return row
+
+    def _is_present(self, ma_slot: int, ts: int) -> bool:
+        row = ts - int(self._idx[IDX_BASE_TS])
+        return 0 <= row < self._capacity and self._present[row, ma_slot] != 0
+
+    def _update_ts_range(self, min_field: int, max_field: int, rows_field: int, ts: int):
+        if self._idx[min_field] == NO_TS or ts < self._idx[min_field]:
+            self._idx[min_field] = ts
+        if ts > self._idx[max_field]:
+            self._idx[max_field] = ts
+        self._idx[rows_field] += 1
+
+    def insert_pi(self, ma_id: int, ts: int, data):
+        ma_slot = self._slot(ma_id, assign=True)
+        # If there's a missing entry before ts, insert ts as ts-1
+        if self._idx[IDX_BASE_TS] != NO_TS and self._is_present(ma_slot, ts-2) and \
+           not self._is_present(ma_slot, ts-1):
+            ts -= 1
+            logger.debug("A previous missing entry detected, storing PI for ma_id " +
+                         str(ma_id) + " at ts-1 " + str(ts))
+        else:
+            logger.debug("Storing PI for ma_id " + str(ma_id) + ", ts " + str(ts))
+
+        try:
+            row = self._row(ts)
+        except ValueError as e:
+            logger.warning('{type}: {msg}'.format(type=type(e).__name__, msg=str(e)))
+            return
+        if self._present[row, ma_slot]:
+            logger.warning('PI of ma_id {0} at ts {1} already exists'.format(ma_id, ts))
+            return
+        data = pi_array(data)
+        # Non client MAs send in zero length data, for which we only record the presence
+        if len(data) != 0:
+            if len(data) != self.pi_per_ma:
+                raise ValueError('Expecting {0} PIs from ma_id {1}, got {2}'.format(self.pi_per_ma, ma_id,
+                                                                                    len(data)))
+            self._pis[row, ma_slot] = data
+        # Readers check the presence after the data has been written
+        self._present[row, ma_slot] = 1
+        self._update_ts_range(IDX_PI_MIN_TS, IDX_PI_MAX_TS, IDX_PI_ROWS, ts)
+        self._flush_if_needed()
+
+    def insert_action(self, ts: int, action: int):
+        assert isinstance(action, int)
+        try:
+            row = self._row(ts)
+        except ValueError as e:
+            logger.warning('{type}: {msg}'.format(type=type(e).__name__, msg=str(e)))
+            return
+        if self._actions[row] != NO_ACTION:
+            logger.warning('Action at ts {0} already exists'.format(ts))
+            return
+        self._actions[row] = action
+        self._update_ts_range(IDX_ACTION_MIN_TS, IDX_ACTION_MAX_TS, IDX_ACTION_ROWS, ts)
+        logger.debug('Stored action {action} at {ts}'.format(action=action, ts=ts))
+        self._flush_if_needed()
+
+    def _flush_if_needed(self):
+        self._unflushed_rows += 1
+        if self._unflushed_rows >= self.write_batch_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        if self._unflushed_rows > 0 and self.write_batch_interval > 0 and \
+           time.time() - self._last_flush_time >= self.write_batch_interval:
+            self.flush()
+
+    def flush(self):
+        """Sync the memory maps to disk
+
+        Readers in other processes see new data immediately; flushing only matters for durability.
+        """
+        start_time = time.time()
+        for mm in (self._pis, self._present, self._actions, self._idx):
+            if isinstance(mm, np.memmap):
+                mm.flush()
+        self.last_flush_latency = time.time() - start_time
+        self.last_flush_size = self._unflushed_rows
+        self._unflushed_rows = 0
+        self._last_flush_time = time.time()
+
+    def close(self):
+        self.flush()
+        del self._pis, self._present, self._actions, self._slot_table, self._idx
+
+    def _read_ticks(self, start_ts: int, end_ts: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Copy the data of all slots in [start_ts, end_ts] out
+
+        Ticks outside of the DB are returned as missing.
+
+        :return: PIs of shape (ticks, num_ma, pi_per_ma), and presence of shape (ticks, num_ma)
+        """
+        self._refresh()
+        n = end_ts - start_ts + 1
+        pis = np.zeros((n, self.num_ma, self.pi_per_ma), dtype=PI_DTYPE)
+        present = np.zeros((n, self.num_ma), dtype=np.uint8)
+        if self._idx[IDX_BASE_TS] == NO_TS:
+            return pis, present
+        lo = start_ts - int(self._idx[IDX_BASE_TS])
+        hi = lo + n
+        src_lo, src_hi = max(lo, 0), min(hi, self._capacity)
+        if src_lo < src_hi:
+            present[src_lo - lo:src_hi - lo] = self._present[src_lo:src_hi]
+            pis[src_lo - lo:src_hi - lo] = self._pis[src_lo:src_hi]
+        return pis, present
+
+    def get_pi(self, ma_id: int, ts: float) -> []:
+        self._refresh()
+        ma_slot = self._slot(ma_id)
+        if ma_slot is None or self._idx[IDX_BASE_TS] == NO_TS or not self._is_present(ma_slot, int(ts)):
+            raise ValueError
+        if self.ordered_client_list and ma_id not in self.ordered_client_list:
+            return []
+        return self._pis[int(ts) - int(self._idx[IDX_BASE_TS]), ma_slot].tolist()
+
+    def get_action(self, ts: int) -> int:
+        self._refresh()
+        row = ts - int(self._idx[IDX_BASE_TS])
+        if self._idx[IDX_BASE_TS] == NO_TS or not 0 <= row < self._capacity or self._actions[row] == NO_ACTION:
+            return 0     # 0 is no action
+        return int(self._actions[row])
+
+    def get_action_row_count(self):
+        return int(self._idx[IDX_ACTION_ROWS])
+
+    def get_last_ts(self) -> int:
+        min_ts, max_ts = self.get_pi_ts_range()
+        # Search backwards in chunks
+        chunk = 1024
+        while max_ts >= min_ts:
+            start_ts = max(min_ts, max_ts - chunk + 1)
+            complete = np.flatnonzero(self.get_tick_entries(start_ts, max_ts) == self.num_ma)
+            if len(complete) > 0:
+                return start_ts + int(complete[-1])
+            max_ts = start_ts - 1
+        raise NotEnoughDataError
+
+    def get_tick_entries(self, start_ts: int, end_ts: int) -> np.ndarray:
+        self._refresh()
+        entries = np.zeros((end_ts - start_ts + 1,), dtype=int)
+        if self._idx[IDX_BASE_TS] == NO_TS:
+            return entries
+        lo = start_ts - int(self._idx[IDX_BASE_TS])
+        src_lo, src_hi = max(lo, 0), min(lo + len(entries), self._capacity)
+        if src_lo < src_hi:
+            entries[src_lo - lo:src_hi - lo] = self._present[src_lo:src_hi].sum(axis=1, dtype=int)
+        return entries
+
+    def _client_slots(self) -> np.ndarray:
+        """Slots of the clients, -1 for clients that haven't sent in any data"""
+        clients = self.ordered_client_list if self.ordered_client_list else \
+            sorted(int(x) for x in self._slot_table if x != NO_TS)
+        slots = [self._slot(ma_id) for ma_id in clients]
+        return np.array([-1 if x is None else x for x in slots], dtype=int)
+
+    def _read_block(self, start_ts: int, end_ts: int) -> Tuple[np.ndarray, np.ndarray]:
+        pis, present = self._read_ticks(start_ts, end_ts)
+        slots = self._client_slots()
+        result = np.zeros((len(pis), len(slots), self.pi_per_ma), dtype=float)
+        seen = slots >= 0
+        result[:, seen] = pis[:, slots[seen]] * present[:, slots[seen], np.newaxis]
+        return result, present.sum(axis=1, dtype=int)
+
+    def get_pi_ts_range(self) -> Tuple[int, int]:
+        if self._idx[IDX_PI_MIN_TS] == NO_TS:
+            raise NotEnoughDataError('Not enough data')
+        return int(self._idx[IDX_PI_MIN_TS]), int(self._idx[IDX_PI_MAX_TS])
+
+    def get_action_ts_range(self) -> Tuple[int, int]:
+        if self._idx[IDX_ACTION_MIN_TS] == NO_TS:
+            raise NotEnoughDataError('Not enough data')
+        return int(self._idx[IDX_ACTION_MIN_TS]), int(self._idx[IDX_ACTION_MAX_TS])
+
+    def read_pis_since(self, position) -> Tuple[List[Tuple[int, int, np.ndarray, int]], object]:
+        # position is the last ts that has been read. We read from that ts again because
+        # more PIs of that ts may have come in.
+        try:
+            min_ts, max_ts = self.get_pi_ts_range()
+        except NotEnoughDataError:
+            return [], position
+        start_ts = max(min_ts, position)
+        pis, present = self._read_ticks(start_ts, max_ts)
+        base_ts = int(self._idx[IDX_BASE_TS])
+        # Order the rows by MA ID
+        ma_ids = np.array(self._slot_table)
+        order = [i for i in np.argsort(ma_ids) if ma_ids[i] != NO_TS]
+        empty = np.zeros((0,), dtype=PI_DTYPE)
+        result = []
+        for i, j in zip(*np.nonzero(present[:, order])):
+            ts = start_ts + int(i)
+            ma_id = int(ma_ids[order[j]])
+            action = self._actions[ts - base_ts]
+            pi = pis[i, order[j]] if not self.ordered_client_list or ma_id in self.ordered_client_list else empty
+            result.append((ts, ma_id, pi, 0 if action == NO_ACTION else int(action)))
+        return result, max_ts
+
+    def read_tail(self, position, max_rows: int) -> Tuple[TailChunk, object]:
+        # position is (the last ts of PIs that has been read, the MA IDs read at that ts, the last ts of
+        # actions that has been read). Ticks are read in order, so PIs that arrive for a ts older than
+        # the last one read are not returned.
+        self._refresh()
+        last_ts, seen, last_action_ts = position if position else (None, (), None)
+        tss, ma_ids, pis, action_ts, actions = [], [], dict(), [], []
+        if self._idx[IDX_PI_MIN_TS] != NO_TS:
+            min_ts, max_ts = self.get_pi_ts_range()
+            start_ts = min_ts if last_ts is None else max(min_ts, last_ts)
+            # Skip the ticks that have no new PIs so an empty chunk always means there is nothing new
+            while start_ts <= max_ts:
+                end_ts = min(max_ts, start_ts + max(1, max_rows // self.num_ma) - 1)
+                data, present = self._read_ticks(start_ts, end_ts)
+                slot_ma_ids = np.array(self._slot_table)
+                if start_ts == last_ts:
+                    present[0, np.isin(slot_ma_ids, seen)] = 0
+                for i, j in zip(*np.nonzero(present)):
+                    ma_id = int(slot_ma_ids[j])
+                    if not self.ordered_client_list or ma_id in self.ordered_client_list:
+                        pis[len(tss)] = data[i, j]
+                    tss.append(start_ts + int(i))
+                    ma_ids.append(ma_id)
+                if end_ts == last_ts:
+                    seen = tuple(seen) + tuple(ma_id for ts, ma_id in zip(tss, ma_ids) if ts == end_ts)
+                else:
+                    seen = tuple(ma_id for ts, ma_id in zip(tss, ma_ids) if ts == end_ts)
+                last_ts = end_ts
+                if tss:
+                    break
+                start_ts = end_ts + 1
+        if self._idx[IDX_ACTION_MIN_TS] != NO_TS:
+            min_ts, max_ts = self.get_action_ts_range()
+            start_ts = min_ts if last_action_ts is None else max(min_ts, last_action_ts + 1)
+            base_ts = int(self._idx[IDX_BASE_TS])
+            while start_ts <= max_ts and len(action_ts) == 0:
+                end_ts = min(max_ts, start_ts + max_rows - 1)
+                rows = np.array(self._actions[start_ts - base_ts:end_ts - base_ts + 1])
+                taken = np.flatnonzero(rows != NO_ACTION)
+                action_ts = taken + start_ts
+                actions = rows[taken]
+                last_action_ts = end_ts
+                start_ts = end_ts + 1
+        return self._make_tail_chunk(tss, ma_ids, pis, action_ts, actions), (last_ts, seen, last_action_ts)
@@ -36,10 +36,9 @@ OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import gc
-import pickle
 import socket
+import struct
 import time
-import zlib
 import zmq
 from . import LustreCommon
 from .ascar_logging import *
@@ -52,6 +51,11 @@ class MonitorAgent:
     """
     This agent samples system performance indicators and reports them back to an :doc:`intf-daemon`
 
+    Heartbeats and actions come from the PUB socket of IntfDaemon. A heartbeat that carries a
+    newer action sequence number than the last action performed means the latest action has been
+    missed, which is then requested again. Actions set absolute values, so only the latest one
+    needs to be performed. missed_actions counts the actions that have never been performed.
+
     :type collect_time_decimal: float
     :type context: zmq.Context
     """
@@ -62,6 +66,7 @@ class MonitorAgent:
     collect_time_decimal = 0.5       # we always collect at the middle of a second
     poller = None
     socket = None
+    subscriber = None
     stopped = False
     controller = None
     context = None
@@ -77,21 +82,34 @@ class MonitorAgent:
             self.id = opt['nodeid_map'][socket.gethostname()]
         logger.info('MA on {hostname} created with ID {id}'.format(hostname=socket.gethostname(), id=self.id))
         self.parent_intf_daemon = opt['intf_daemon_loc']
+        self.pub_loc = 'tcp://{host}:{port}'.format(host=self.parent_intf_daemon.split(':')[0],
+                                                     port=LustreCommon.get_pub_port(opt))
         self.collectors = opt.get('collectors')
         self.tick_len = opt['tick_len'] if 'tick_len' in opt else 1
         self.controller = opt.get('controller')
+        self.missed_actions = 0
+        # Sequence number of the latest action performed, and of the latest one requested again
+        self._action_seq = None
+        self._resend_seq = None
 
         # don't create zmq context here because start() may be called in a different process/thread
 
     def send_obj(self, data):
+        """Send [ts, PIs...] or [ts, command, arguments...] to IntfDaemon"""
         assert isinstance(data, list), 'Wrong data type for send_obj'
 
-        # prefix it with the protocol version
-        data = [LustreCommon.protocol_ver] + data
+        ts = data[0]
+        if len(data) >= 2 and isinstance(data[1], bytes):
+            if data[1] == b'ACTION':
+                frames = LustreCommon.encode_action_message(data[2:], ts)
+            else:
+                frames = LustreCommon.encode_message(LustreCommon.COMMAND_KINDS[data[1]], ts=ts)
+        else:
+            frames = LustreCommon.encode_pi_message(data[1:], ts)
 
         if not self.socket:
             self.connect()
-        self.socket.send(zlib.compress(pickle.dumps(data)))
+        self.socket.send_multipart(frames)
         logger.debug('Message sent at {ts}'.format(ts=time.time()))
 
     def timestamp_and_send_obj(self, data, ts=None):
@@ -103,23 +121,34 @@ class MonitorAgent:
         self.send_obj([ts] + data)
 
     def connect(self):
+        # A second socket with our identity would be refused by IntfDaemon while the first one is connected
+        if self.socket:
+            self.disconnect()
         if not self.context:
             self.context = zmq.Context()
         self.socket = self.context.socket(zmq.DEALER)
         self.socket.setsockopt(zmq.IDENTITY, str(self.id).encode('ascii'))
         self.socket.connect('tcp://{parent}'.format(parent=self.parent_intf_daemon))
+        self.subscriber = self.context.socket(zmq.SUB)
+        self.subscriber.setsockopt(zmq.SUBSCRIBE, b'')
+        self.subscriber.connect(self.pub_loc)
 
         self.poller = zmq.Poller()
         self.poller.register(self.socket, zmq.POLLIN)
+        self.poller.register(self.subscriber, zmq.POLLIN)
 
     def disconnect(self):
         if not self.socket or not self.context or not self.poller:
             raise RuntimeError('Trying to disconnect an uninitialized socket')
         self.poller.unregister(self.socket)
-        del self.poller
-        self.socket.close()
-        del self.socket
-        del self.context
+        self.poller.unregister(self.subscriber)
+        self.poller = None
+        # Unsent messages would make terminating the context hang
+        self.socket.close(linger=0)
+        self.socket = None
+        self.subscriber.close(linger=0)
+        self.subscriber = None
+        self.context.term()
         self.context = None
 
     def start(self):
@@ -175,26 +204,12 @@ class MonitorAgent:
                 sleep_start_ts = time.time()
                 p = dict(self.poller.poll(sleep_second * 1000))
                 logger.debug('Slept {0} seconds'.format(time.time() - sleep_start_ts))
-                if self.socket in p:
-                    req = pickle.loads(zlib.decompress(self.socket.recv()))
-                    assert req[0] == LustreCommon.protocol_ver
+                if p:
+                    # Resent actions come from the DEALER socket
+                    for s in (self.subscriber, self.socket):
+                        if s in p:
+                            self.handle_broadcast(s.recv_multipart())
                     heartbeat_ts = time.time()
-                    if isinstance(req[2], bytes):
-                        # this is a command, not data
-                        cmd = req[2]
-                        if cmd == b'ACTION':
-                            action = req[3]
-                            if action == 0:
-                                logger.info('Received action 0, ignored')
-                            else:
-                                logger.info('Performing action {action}'.format(action=action))
-                                self.controller(req[3:])
-                        elif cmd == b'HB':
-                            logger.debug('Received heartbeat')
-                        else:
-                            logger.warning('Unknown command received: ' + cmd)
-                    else:
-                        logger.error('Corrupted message received: ' + req)
                 else:
                     if heartbeat_ts and time.time() - heartbeat_ts > 5:
                         # reconnect
@@ -207,6 +222,7 @@ class MonitorAgent:
             logger.info('MA stopped')
         finally:
             gc.enable()
+            self.disconnect()
 
             if self.debugging_level >= 1:
                 pr.disable()
@@ -216,6 +232,41 @@ class MonitorAgent:
                 ps.print_stats()
                 print(s.getvalue())
 
+    def handle_broadcast(self, frames):
+        """Handle a heartbeat or an action published by IntfDaemon, or an action it sent again"""
+        try:
+            seq = LustreCommon.BROADCAST_SEQ.unpack(frames[0])[0]
+            msg = LustreCommon.decode_message(frames[1:])
+        except (LustreCommon.ProtocolError, struct.error) as e:
+            logger.warning('Dropped a message from IntfDaemon: ' + str(e))
+            return
+        if msg.kind == LustreCommon.KIND_ACTION:
+            if seq == self._action_seq:
+                # Both the published and the resent copy have arrived
+                return
+            if self._action_seq is not None and seq > self._action_seq + 1:
+                self.missed_actions += seq - self._action_seq - 1
+                logger.warning('Missed {0} actions, {1} so far'.format(seq - self._action_seq - 1,
+                                                                     self.missed_actions))
+            self._action_seq = seq
+            action = msg.body[0]
+            if action == 0:
+                logger.info('Received action 0, ignored')
+            else:
+                logger.info('Performing action {action}'.format(action=action))
+                self.controller(msg.body)
+        elif msg.kind == LustreCommon.KIND_HB:
+            logger.debug('Received heartbeat')
+            if self._action_seq is None or seq < self._action_seq:
+                # Just started, or IntfDaemon has been restarted
+                self._action_seq = seq
+            elif seq > self._action_seq and seq != self._resend_seq:
+                logger.warning('Missed action {0}, asking for it again'.format(seq))
+                self._resend_seq = seq
+                self.socket.send_multipart(LustreCommon.encode_message(LustreCommon.KIND_RESEND))
+        else:
+            logger.error('Unexpected message of kind {0} received'.format(msg.kind))
+
     def stop(self):
         logger.info('Requesting MA to stop...')
         self.stopped = True
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""Stages of the IntfDaemon message pipeline"""
+
+import queue
+import threading
+import time
+from typing import *
+from .ascar_logging import logger
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+_STOP = object()
+
+
+class StageMetrics:
+    """Throughput and latency counters of a pipeline stage
+
+    The counters are only updated by the thread of the stage. Other threads may read slightly
+    stale values.
+
+    Attributes:
+        processed: number of items processed
+        dropped: number of items dropped because the queue of the stage was full
+        errors: number of items the stage failed to process
+        throughput: items processed per second, measured over windows of at least one second
+        max_queue_latency: the longest time in seconds an item has waited in the queue
+        max_queue_depth: the largest number of items that have been waiting in the queue
+    """
+    def __init__(self):
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.throughput = 0.0
+        self.max_queue_latency = 0.0
+        self.max_queue_depth = 0
+        self._total_queue_latency = 0.0
+        self._total_service_time = 0.0
+        self._window_start = time.time()
+        self._window_processed = 0
+
+    def record(self, queue_latency: float, service_time: float, items: int = 1):
+        """Count items that have been processed
+
+        :param queue_latency: seconds the items waited in the queue, in total
+        :param service_time: seconds spent on processing the items
+        """
+        self.processed += items
+        self._total_queue_latency += queue_latency
+        self._total_service_time += service_time
+        self.max_queue_latency = max(self.max_queue_latency, queue_latency / max(items, 1))
+        self._window_processed += items
+        now = time.time()
+        if now - self._window_start >= 1:
+            self.throughput = self._window_processed / (now - self._window_start)
+            self._window_start = now
+            self._window_processed = 0
+
+    def get_status(self, prefix: str) -> Dict[str, Any]:
+        """Return the metrics with their names prefixed by prefix_"""
+        processed = max(self.processed, 1)
+        return {
+            prefix + '_processed': self.processed,
+            prefix + '_dropped': self.dropped,
+            prefix + '_errors': self.errors,
+            prefix + '_throughput': round(self.throughput, 1),
+            prefix + '_avg_queue_latency': self._total_queue_latency / processed,
+            prefix + '_max_queue_latency': self.max_queue_latency,
+            prefix + '_avg_service_time': self._total_service_time / processed,
+            prefix + '_max_queue_depth': self.max_queue_depth,
+        }
+
+
+class PipelineStage:
+    """Process the items of a queue in a dedicated thread
+
+    Stages are connected by calling put() of the next stage from the handler of the previous
+    one. put() never blocks: when more than queue_size items are waiting the item is dropped
+    and counted, so a slow stage can't stall the ones before it.
+
+    If the handler raises an exception the stage stops, keeps the exception in error and calls
+    on_error, which lets the owner shut the pipeline down.
+
+    An item may be a batch of messages. item_size then returns the number of messages in an item,
+    which the metrics count instead of items.
+
+    Attributes:
+        name: name of the stage, used for the thread and the metrics
+        idle_interval: on_idle is called when the queue is empty, but at least this often in
+                       seconds even if the stage never catches up
+        metrics: the StageMetrics of the stage
+    """
+    def __init__(self, name: str, handler: Callable[[Any], None], queue_size: int = 10000,
+                 on_idle: Callable[[], None] = None, idle_interval: float = 1,
+                 on_error: Callable[[BaseException], None] = None, item_size: Callable[[Any], int] = None):
+        self.name = name
+        self.idle_interval = idle_interval
+        self.metrics = StageMetrics()
+        self.error = None
+        self._handler = handler
+        self._on_idle = on_idle
+        self._on_error = on_error
+        self._item_size = item_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+
+    def start(self):
+        assert not self._thread, 'Stage {0} already started.'.format(self.name)
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Process all queued items and wait for the thread to end"""
+        if not self._thread:
+            return
+        # Don't drop the stop request when the queue is full
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def put(self, item) -> bool:
+        """Queue an item for the stage
+
+        :return: False if the item has been dropped
+        """
+        try:
+            self._queue.put_nowait((time.time(), item))
+        except queue.Full:
+            self.metrics.dropped += self._item_size(item) if self._item_size else 1
+            logger.warning('Queue of {0} is full, dropped {1} items so far'.format(self.name, self.metrics.dropped))
+            return False
+        self.metrics.max_queue_depth = max(self.metrics.max_queue_depth, self._queue.qsize())
+        return True
+
+    def get_status(self) -> Dict[str, Any]:
+        result = self.metrics.get_status(self.name)
+        result[self.name + '_queue_depth'] = self._queue.qsize()
+        return result
+
+    def _run(self):
+        last_idle_time = time.time()
+        while True:
+            try:
+                entry = self._queue.get(timeout=self.idle_interval)
+            except queue.Empty:
+                entry = None
+            try:
+                if entry is not None:
+                    if entry is _STOP:
+                        return
+                    start_time = time.time()
+                    self._handler(entry[1])
+                    items = self._item_size(entry[1]) if self._item_size else 1
+                    self.metrics.record((start_time - entry[0]) * items, time.time() - start_time, items)
+                if self._on_idle and (self._queue.empty() or time.time() - last_idle_time >= self.idle_interval):
+                    self._on_idle()
+                    last_idle_time = time.time()
+            except Exception as e:
+                self.metrics.errors += 1
+                self.error = e
+                logger.error('{stage} stopped by {type}: {msg}'.format(stage=self.name, type=type(e).__name__,
+                                                                      msg=str(e)))
+                if self._on_error:
+                    self._on_error(e)
+                # Keep consuming the queue so stop() can be delivered, but don't process anything
+                while self._queue.get() is not _STOP:
+                    pass
+                return
@@ -2,9 +2,16 @@
 
 """ASCAR ReplayDB"""
 
+import glob
 import numpy as np
+import os
 import pickle
 import sqlite3
+import threading
+import time
+import urllib.parse
+import zlib
+from contextlib import contextmanager
 from typing import *
 from .ascar_logging import logger
 
@@ -12,32 +19,333 @@ __author__ = 'Yan Li'
 __copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
 
 
+# Formats of pis.pi_data. The format of a DB is stored as its user_version.
+PI_FORMAT_PICKLE = 0    # pickled Python lists, used by all DBs created before the format was versioned
+PI_FORMAT_F64LE = 1     # raw little-endian float64 buffer
+PI_FORMAT_DELTA = 2     # deflated float64 buffer, XORed with the previous tick of the same MA between keyframes
+PI_FORMAT_LATEST = PI_FORMAT_F64LE
+PI_FORMATS = (PI_FORMAT_PICKLE, PI_FORMAT_F64LE, PI_FORMAT_DELTA)
+PI_DTYPE = np.dtype('<f8')
+# In PI_FORMAT_DELTA, the PIs of ticks that are multiples of PI_DELTA_KEYFRAME_TICKS are always
+# stored as keyframes, so decoding any tick reads at most this many ticks
+PI_DELTA_KEYFRAME_TICKS = 16
+_PI_DELTA_KEYFRAME = b'K'
+_PI_DELTA_DELTA = b'D'
+
+
 class NotEnoughDataError(BaseException):
     def __init__(self, *args, **kwargs):
         BaseException.__init__(self, *args, **kwargs)
 
 
-class ReplayDB:
-    """A class for accessing ReplayDB
+class TailChunk(NamedTuple):
+    """A chunk of rows returned by ReplayDBBackend.read_tail()
+
+    PI rows are ordered by (ts, ma_id). pis has shape (rows, pi_per_ma); rows of non client MAs,
+    which have no PIs, are left as 0 and marked False in has_pi.
+    """
+    ts: np.ndarray
+    ma_id: np.ndarray
+    pis: np.ndarray
+    has_pi: np.ndarray
+    action_ts: np.ndarray
+    actions: np.ndarray
+
+    def num_rows(self) -> int:
+        """Return the number of PI rows and actions"""
+        return len(self.ts) + len(self.action_ts)
+
+
+class TailCursor:
+    """Follows the PIs and actions that are stored in a ReplayDB
+
+    Every read() returns the rows stored since the last one, at most max_rows PI rows and max_rows
+    actions at a time. position can be saved and passed to a new cursor to resume.
+
+    :type db: ReplayDBBackend
+    """
+    def __init__(self, db, position=None, max_rows: int = None):
+        self.db = db
+        self.position = position
+        self.max_rows = max_rows or db.tail_rows
+
+    def read(self) -> TailChunk:
+        """Read the next chunk, which is empty if there is nothing new"""
+        chunk, self.position = self.db.read_tail(self.position, self.max_rows)
+        return chunk
+
+    def __iter__(self) -> Iterator[TailChunk]:
+        """Read chunks until the cursor has caught up with the DB"""
+        while True:
+            chunk = self.read()
+            if chunk.num_rows() == 0:
+                return
+            yield chunk
+
+
+def pi_array(data) -> np.ndarray:
+    """Return PIs given as a sequence or a little-endian float64 buffer as an array
+
+    A buffer is not copied.
+    """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return np.frombuffer(data, dtype=PI_DTYPE)
+    return np.asarray(data, dtype=PI_DTYPE)
+
+
+def encode_pi(data, pi_format: int = PI_FORMAT_LATEST, prev: np.ndarray = None) -> bytes:
+    """Encode a PI vector for storing in pis.pi_data
+
+    :param data: the PIs as a sequence, or as a little-endian float64 buffer like the PI messages
+                 of protocol v2, which is stored as is in PI_FORMAT_F64LE
+    :param prev: for PI_FORMAT_DELTA, the PIs of the previous tick of the same MA to store data
+                 as a delta of. None stores a keyframe. Use PIEncoder to choose it.
+    """
+    if pi_format == PI_FORMAT_F64LE:
+        if isinstance(data, bytes):
+            return data
+        return np.asarray(data, dtype=PI_DTYPE).tobytes()
+    elif pi_format == PI_FORMAT_PICKLE:
+        return pickle.dumps(pi_array(data).tolist() if isinstance(data, bytes) else list(data))
+    elif pi_format == PI_FORMAT_DELTA:
+        data = pi_array(data)
+        if prev is None or len(prev) != len(data):
+            kind = _PI_DELTA_KEYFRAME
+        else:
+            kind = _PI_DELTA_DELTA
+            # Unchanged PIs become zeros, and slowly changing ones share their high bytes
+            data = data.view('<u8') ^ np.asarray(prev, dtype=PI_DTYPE).view('<u8')
+        # Raw deflate without the zlib header, which is a large part of a short row
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        return kind + compressor.compress(data.tobytes()) + compressor.flush()
+    raise ValueError('Unknown PI format {0}'.format(pi_format))
+
+
+def decode_pi(blob: bytes, pi_format: int = PI_FORMAT_LATEST, prev: np.ndarray = None) -> np.ndarray:
+    """Decode pis.pi_data
+
+    For PI_FORMAT_F64LE the returned array is a read-only view of blob.
+
+    :param prev: for PI_FORMAT_DELTA, the decoded PIs of the previous tick of the same MA, which
+                 are needed if blob is a delta
+    """
+    if pi_format == PI_FORMAT_F64LE:
+        return np.frombuffer(blob, dtype=PI_DTYPE)
+    elif pi_format == PI_FORMAT_PICKLE:
+        return np.array(pickle.loads(blob), dtype=float)
+    elif pi_format == PI_FORMAT_DELTA:
+        data = np.frombuffer(zlib.decompress(blob[1:], -15), dtype=PI_DTYPE)
+        if blob[:1] == _PI_DELTA_KEYFRAME:
+            return data
+        if prev is None:
+            raise ValueError('The PIs of the previous tick are needed to decode a delta')
+        return (data.view('<u8') ^ np.asarray(prev, dtype=PI_DTYPE).view('<u8')).view(PI_DTYPE)
+    raise ValueError('Unknown PI format {0}'.format(pi_format))
+
+
+def is_delta_pi(blob: bytes, pi_format: int) -> bool:
+    """Whether blob can only be decoded with the PIs of the previous tick"""
+    return pi_format == PI_FORMAT_DELTA and blob[:1] == _PI_DELTA_DELTA
+
+
+def decode_pi_rows(rows: Sequence[Sequence], pi_format: int,
+                   context: Dict[Tuple[int, int], np.ndarray] = None) -> List[Optional[np.ndarray]]:
+    """Decode rows that start with (ma_id, ts, pi_data) and are sorted by ma_id and ts
+
+    A delta of PI_FORMAT_DELTA whose previous tick is missing (e.g. the row has been lost or
+    deleted) can't be decoded, and neither can the deltas after it up to the next keyframe.
+    They are returned as None, and readers treat them as missing entries.
+
+    :param context: maps (ma_id, ts) to the decoded PIs of ticks before rows, which are needed
+                    for decoding the deltas of PI_FORMAT_DELTA that refer to them
+    """
+    if pi_format != PI_FORMAT_DELTA:
+        return [decode_pi(row[2], pi_format) for row in rows]
+    result = []
+    prev_key = prev = None
+    for row in rows:
+        ma_id, ts, blob = row[:3]
+        if is_delta_pi(blob, pi_format):
+            ref = prev if prev_key == (ma_id, ts - 1) else (context or {}).get((ma_id, ts - 1))
+            if ref is None:
+                logger.warning('PI of ma_id {0} at ts {1} is a delta of a missing tick'.format(ma_id, ts))
+                prev = None
+            else:
+                prev = decode_pi(blob, pi_format, ref)
+        else:
+            prev = decode_pi(blob, pi_format)
+        prev_key = (ma_id, ts)
+        result.append(prev)
+    return result
+
+
+class PIDecoder:
+    """Decode the PIs of each MA tick by tick, the counterpart of PIEncoder
+
+    The rows of different MAs can be interleaved, e.g. sorted by ts, as long as the ticks of
+    each MA come in order. The PIs of the previous tick of each MA are kept for decoding deltas.
+    """
+    def __init__(self, pi_format: int):
+        self.pi_format = pi_format
+        # ma_id -> (ts, PIs) of the newest tick decoded
+        self._prev = dict()
+
+    def decode(self, ma_id: int, ts: int, blob: bytes) -> Optional[np.ndarray]:
+        """:return: the PIs, or None if blob is a delta of a tick that has not been decoded"""
+        if self.pi_format != PI_FORMAT_DELTA:
+            return decode_pi(blob, self.pi_format)
+        if is_delta_pi(blob, self.pi_format):
+            prev = self._prev.get(ma_id)
+            if prev is None or prev[0] != ts - 1 or prev[1] is None:
+                logger.warning('PI of ma_id {0} at ts {1} is a delta of a missing tick'.format(ma_id, ts))
+                data = None
+            else:
+                data = decode_pi(blob, self.pi_format, prev[1])
+        else:
+            data = decode_pi(blob, self.pi_format)
+        self._prev[ma_id] = (ts, data)
+        return data
+
+
+class PIEncoder:
+    """Encode the PIs of each MA tick by tick
+
+    For PI_FORMAT_DELTA, the PIs of a tick are stored as a delta of the previous tick of the same
+    MA if that tick was encoded by this encoder and is not a keyframe tick. Everything else,
+    including late arrivals, is stored as a keyframe.
+    """
+    def __init__(self, pi_format: int):
+        self.pi_format = pi_format
+        # ma_id -> (ts, PIs) of the newest tick encoded
+        self._prev = dict()
+
+    def encode(self, ma_id: int, ts: int, data) -> bytes:
+        if self.pi_format != PI_FORMAT_DELTA:
+            return encode_pi(data, self.pi_format)
+        data = pi_array(data)
+        prev = self._prev.get(ma_id)
+        if prev is not None and prev[0] >= ts:
+            # A late arrival or a duplicate, which may never be stored
+            return encode_pi(data, self.pi_format)
+        self._prev[ma_id] = (ts, data)
+        if prev is None or prev[0] != ts - 1 or ts % PI_DELTA_KEYFRAME_TICKS == 0:
+            return encode_pi(data, self.pi_format)
+        return encode_pi(data, self.pi_format, prev[1])
+
+    def reset(self):
+        """Start over with keyframes, e.g. when the previous ticks may not be readable any more"""
+        self._prev = dict()
+
+
+def get_pi_format(conn: sqlite3.Connection) -> int:
+    pi_format = conn.execute('PRAGMA user_version').fetchone()[0]
+    if pi_format not in PI_FORMATS:
+        raise ValueError('Unknown PI format {0}'.format(pi_format))
+    return pi_format
+
+
+def migrate_pi_format(dbfile: str, pi_format: int = PI_FORMAT_LATEST, batch_size: int = 10000) -> int:
+    """Convert all PIs in a DB to pi_format in place
+
+    The conversion is done in one transaction so an interrupted migration leaves the DB untouched.
+    Rows are converted in the order of ma_id and ts so deltas of PI_FORMAT_DELTA can be decoded
+    and encoded.
+
+    :return: number of converted rows
+    """
+    conn = sqlite3.connect(dbfile, timeout=120)
+    try:
+        old_format = get_pi_format(conn)
+        if old_format == pi_format:
+            logger.info('{0} is already in PI format {1}'.format(dbfile, pi_format))
+            return 0
+        encoder = PIEncoder(pi_format)
+        rows = 0
+        last_key = (-1 << 63, -1 << 63)
+        context = dict()
+        with conn:
+            c = conn.cursor()
+            while True:
+                c.execute('SELECT ma_id, ts, pi_data, rowid FROM pis WHERE (ma_id, ts) > (?, ?) '
+                          'ORDER BY ma_id, ts LIMIT ?', last_key + (batch_size,))
+                data = c.fetchall()
+                if not data:
+                    break
+                pis = decode_pi_rows(data, old_format, context)
+                c.executemany('UPDATE pis SET pi_data = ? WHERE rowid = ?',
+                              [(encoder.encode(row[0], row[1], pi), row[3])
+                               for row, pi in zip(data, pis) if pi is not None])
+                # Deltas of missing ticks can't be read in any format
+                c.executemany('DELETE FROM pis WHERE rowid = ?',
+                              [(row[3],) for row, pi in zip(data, pis) if pi is None])
+                last_key = tuple(data[-1][:2])
+                # The next batch may start with a delta of the last row
+                context = {last_key: pis[-1]}
+                rows += len(data)
+            # PRAGMA doesn't accept parameters; pi_format is an int
+            c.execute('PRAGMA user_version = {0:d}'.format(pi_format))
+        logger.info('Converted {0} rows of {1} from PI format {2} to {3}'.format(rows, dbfile, old_format, pi_format))
+        return rows
+    finally:
+        conn.close()
+
+
+class ReplayDBBackend:
+    """The interface and common part of all ReplayDB backends
+
+    Use open_replay_db() to create a ReplayDB using the backend chosen by opt['replaydb_backend'].
 
     Attributes:
         ordered_client_list: a sorted list of all MA IDs. So far because only client MA sends in data, we store only
                              client IDs.
+        pi_per_ma: number of PIs sent in by each client MA per tick
+        write_batch_size: number of rows buffered before they are written to the DB in one transaction. The
+                          default of 1 commits every row immediately.
+        write_batch_interval: maximum number of seconds a row can stay in the write buffer. 0 means no time limit.
+        last_flush_latency: seconds spent on the last flush
+        last_flush_size: number of rows written by the last flush
+        retention_ticks: raw PIs older than this many ticks (counting back from the latest PI) are
+                         aged out by enforce_retention(). 0 keeps everything.
+        retention_downsample_ticks: size in ticks of the buckets aged out PIs are averaged into
+        retention_step_ticks: maximum number of ticks aged out by one enforce_retention() step
+        retention_step_rows: maximum number of PI rows aged out by one step, which is turned into
+                             ticks using num_ma so large clusters don't block the writer for long
+        retention_interval: seconds between two retention steps done by enforce_retention_if_due()
+        tail_rows: default maximum number of rows read by one read of a TailCursor
 
-    :type conn: sqlite3.Connection
     :type nodeid_map: Dict[str, int]
     :type ordered_client_list: List[int]
     """
-    conn = None
     nodeid_map = None
     ordered_client_list = None
     tick_len = 1
     ticks_per_observation = 4
+    write_batch_size = 1
+    write_batch_interval = 0
+    last_flush_latency = 0
+    last_flush_size = 0
+    retention_ticks = 0
+    retention_downsample_ticks = 60
+    retention_step_ticks = 600
+    retention_step_rows = 50000
+    retention_interval = 10
+    tail_rows = 10000
 
     def __init__(self, opt: dict):
         # Parsing options
         if 'tick_len' in opt:
             self.tick_len = opt['tick_len']
+        self.write_batch_size = max(1, opt.get('write_batch_size', self.write_batch_size))
+        self.write_batch_interval = opt.get('write_batch_interval', self.write_batch_interval)
+        self.retention_ticks = opt.get('retention_ticks', self.retention_ticks)
+        self.retention_downsample_ticks = max(1, opt.get('retention_downsample_ticks',
+                                                         self.retention_downsample_ticks))
+        # Steps cover whole buckets unless they are limited by retention_step_rows
+        step = max(opt.get('retention_step_ticks', self.retention_step_ticks), self.retention_downsample_ticks)
+        self.retention_step_ticks = step - step % self.retention_downsample_ticks
+        self.retention_step_rows = max(1, opt.get('retention_step_rows', self.retention_step_rows))
+        self.retention_interval = opt.get('retention_interval', self.retention_interval)
+        self.tail_rows = max(1, opt.get('replaydb_tail_rows', self.tail_rows))
         if 'nodeid_map' in opt:
             self.nodeid_map = opt['nodeid_map']
             self.num_ma = len(opt['nodeid_map'])
@@ -56,13 +364,434 @@ class ReplayDB:
             self.ordered_client_list.sort()
         else:
             self.ordered_client_list = None
+        self.pi_per_ma = self.tick_data_size // (len(self.ordered_client_list) if self.ordered_client_list
+                                                 else self.num_ma)
 
         # By default we tolerate 20% missing data tops
         self.missing_entry_tolerance = opt.get('missing_entry_tolerance',
                                                int(self.num_ma * self.ticks_per_observation * 0.2))
 
-        self.connect_db(opt)
+    def insert_pi(self, ma_id: int, ts: int, data):
+        raise NotImplementedError
+
+    def insert_tick(self, tick):
+        """Store the PIs of the MAs that are present in an AssembledTick"""
+        for ma_id, pis in tick.rows():
+            self.insert_pi(ma_id, tick.ts, pis)
+
+    def insert_action(self, ts: int, action: int):
+        raise NotImplementedError
+
+    def flush(self):
+        """Make sure all inserted data are written out
+        """
+        pass
+
+    def flush_if_due(self):
+        """Write out buffered data that have been waiting longer than write_batch_interval
+        """
+        pass
+
+    def enforce_retention(self) -> int:
+        """Age out one slice of PIs that are older than retention_ticks
+
+        :return: number of PI rows aged out
+        """
+        return 0
+
+    def enforce_retention_if_due(self):
+        """Call enforce_retention() if retention_interval seconds have passed since the last step
+
+        The owner of the DB should call this regularly.
+        """
+        pass
+
+    @contextmanager
+    def snapshot(self):
+        """Do the reads in the with block on one consistent snapshot of the DB"""
+        yield
+
+    def get_status(self) -> Dict[str, Any]:
+        """Return a dict of statistics for monitoring the DB"""
+        return {
+            'last_flush_latency': self.last_flush_latency,
+            'last_flush_size': self.last_flush_size,
+        }
+
+    def close(self):
+        raise NotImplementedError
+
+    def get_pi(self, ma_id: int, ts: float) -> []:
+        raise NotImplementedError
+
+    def get_action(self, ts: int) -> int:
+        raise NotImplementedError
+
+    def get_action_row_count(self):
+        raise NotImplementedError
+
+    def get_last_ts(self) -> int:
+        """Return the last ts that has all PIs received
+
+        :return: the last ts
+        """
+        raise NotImplementedError
+
+    def _read_block(self, start_ts: int, end_ts: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Read the PIs of all clients in [start_ts, end_ts]
+
+        :return: PIs of shape (ticks, clients, pi_per_ma) with missing entries filled with 0,
+                 and the number of entries of each tick (including non client MAs)
+        """
+        raise NotImplementedError
+
+    def get_observation(self, ts: int) -> np.ndarray:
+        """Retrieve the PIs and CPVs for all MAs and return an observation
+
+        We retrieve self.ticks_per_observe entries of data before ts from the DB
+        for each MA, concatenate them into a list and return
+
+        NotEnoughDataError will be raised if more than missing_entry_tolerance entries are missing.
+
+        :param ts: the timestamp
+        :return:
+        """
+        pis, entries = self._read_block(ts - self.ticks_per_observation + 1, ts)
+        missing = self.num_ma * self.ticks_per_observation - int(entries.sum())
+        if missing > self.missing_entry_tolerance:
+            raise NotEnoughDataError
+        elif missing != 0:
+            logger.debug('Observation at ts {0} has {1} missing entries'.format(ts, missing))
+        # (ticks, clients, pi) -> (clients, ticks, pi)
+        return pis.transpose((1, 0, 2)).reshape((self.observation_size,))
+
+    def get_observations(self, ts_array, max_block_rows: int = 1 << 18) -> Tuple[np.ndarray, np.ndarray]:
+        """Retrieve the observations of many timestamps at once
+
+        Only the ticks covered by the windows of the timestamps are read. Windows that overlap
+        or touch are merged into one range read, and each read is cut into observations
+        using a sliding window view.
+
+        :param ts_array: the timestamps, in any order and may contain duplicates
+        :param max_block_rows: maximum number of PI rows (ticks * num_ma) to load in one read. A
+                               read always covers at least one window.
+        :return: observations of shape (n, observation_size) and a boolean mask telling which
+                 of them have no more than missing_entry_tolerance missing entries. Observations
+                 that are not valid are returned with their missing entries filled with 0.
+        """
+        ts_array = np.asarray(ts_array, dtype=np.int64).reshape((-1,))
+        n = len(ts_array)
+        result = np.zeros((n, self.observation_size), dtype=float)
+        valid = np.zeros((n,), dtype=bool)
+        if n == 0:
+            return result, valid
+        tpo = self.ticks_per_observation
+        max_block_ticks = max(max_block_rows // max(self.num_ma, 1), tpo)
+        order = np.argsort(ts_array, kind='stable')
+        sorted_ts = ts_array[order]
+        group_start = 0
+        while group_start < n:
+            # A group is a run of windows that overlap or touch and fit in one read
+            first_ts = sorted_ts[group_start]
+            group_end = group_start + 1
+            while group_end < n and sorted_ts[group_end] - sorted_ts[group_end - 1] <= tpo and \
+                    sorted_ts[group_end] - first_ts + tpo <= max_block_ticks:
+                group_end += 1
+            start_ts = int(first_ts) - tpo + 1
+            end_ts = int(sorted_ts[group_end - 1])
+            pis, entries = self._read_block(start_ts, end_ts)
+            # windows[i] is the observation ending at start_ts + tpo - 1 + i, shape (clients, pi, tpo)
+            windows = np.lib.stride_tricks.sliding_window_view(pis, tpo, axis=0)
+            window_entries = np.convolve(entries, np.ones((tpo,), dtype=entries.dtype), mode='valid')
+            idx = sorted_ts[group_start:group_end] - (start_ts + tpo - 1)
+            dest = order[group_start:group_end]
+            # (samples, clients, pi, ticks) -> (samples, clients, ticks, pi)
+            result[dest] = windows[idx].transpose((0, 1, 3, 2)).reshape((len(idx), self.observation_size))
+            valid[dest] = self.num_ma * tpo - window_entries[idx] <= self.missing_entry_tolerance
+            group_start = group_end
+        return result, valid
+
+    def get_tick_entries(self, start_ts: int, end_ts: int) -> np.ndarray:
+        """Return the number of PI entries of each tick in [start_ts, end_ts] (including non client MAs)"""
+        return self._read_block(start_ts, end_ts)[1]
+
+    def get_last_n_observation(self, n: int=1) -> List[np.ndarray]:
+        """Return the last n valid observations, latest first
+
+        Validity is decided from the per tick entry counts so only the observations that
+        are returned are read.
+        """
+        tpo = self.ticks_per_observation
+        min_ts, max_ts = self.get_pi_ts_range()
+        result_ts = []
+        # Look at a little more than n ticks first, and widen the search if there are holes
+        chunk = n + 8
+        end_ts = max_ts
+        while len(result_ts) < n:
+            if end_ts < min_ts:
+                raise NotEnoughDataError
+            start_ts = max(min_ts, end_ts - chunk + 1)
+            # Include the tpo-1 ticks before start_ts that the first window needs
+            entries = self.get_tick_entries(start_ts - tpo + 1, end_ts)
+            window_entries = np.convolve(entries, np.ones((tpo,), dtype=entries.dtype), mode='valid')
+            valid = np.flatnonzero(self.num_ma * tpo - window_entries <= self.missing_entry_tolerance)
+            result_ts.extend(start_ts + int(i) for i in valid[::-1])
+            end_ts = start_ts - 1
+            chunk *= 2
+        observs, _ = self.get_observations(result_ts[:n])
+        return list(observs)
+
+    def get_pi_ts_range(self) -> Tuple[int, int]:
+        """Get the range of ts that has pi
+
+        NotEnoughDataError will be raised if there's not enough data.
+
+        :return: mints, maxts
+        """
+        raise NotImplementedError
+
+    def get_action_ts_range(self) -> Tuple[int, int]:
+        """Get the range of ts that has actions
+
+        NotEnoughDataError will be raised if there's not enough data.
+
+        :return: mints, maxts
+        """
+        raise NotImplementedError
+
+    def read_pis_since(self, position) -> Tuple[List[Tuple[int, int, np.ndarray, int]], object]:
+        """Read PIs that were stored after position
+
+        Used for incrementally loading the DB into memory. Rows are ordered by (ts, ma_id). Rows
+        of the last returned ts may be returned again by the next call if more PIs of that ts
+        come in.
+
+        :param position: 0 to read from the beginning, or the position returned by the last call
+        :return: a list of (ts, ma_id, pi_data, action), and the position for the next call
+        """
+        raise NotImplementedError
+
+    def tail(self, position=None, max_rows: int = None) -> TailCursor:
+        """Return a cursor that follows the rows stored after position
+
+        :param position: None to start from the beginning, or TailCursor.position of an earlier cursor
+        :param max_rows: maximum number of PI rows (and actions) of each chunk, defaults to tail_rows
+        """
+        return TailCursor(self, position, max_rows)
+
+    def read_tail(self, position, max_rows: int) -> Tuple[TailChunk, object]:
+        """Read up to max_rows PI rows and max_rows actions that were stored after position
+
+        Use tail() instead of calling this directly.
+
+        :return: the chunk, and the position for the next call
+        """
+        raise NotImplementedError
+
+    def _make_tail_chunk(self, tss, ma_ids, pis: Dict[int, np.ndarray], action_ts, actions) -> TailChunk:
+        """Build a TailChunk
+
+        :param pis: maps the index of a row to its decoded PIs. Rows without PIs are left out.
+        """
+        tss = np.array(tss, dtype=np.int64)
+        ma_ids = np.array(ma_ids, dtype=np.int64)
+        data = np.zeros((len(tss), self.pi_per_ma), dtype=float)
+        has_pi = np.zeros((len(tss),), dtype=bool)
+        if pis:
+            rows = np.fromiter(pis.keys(), dtype=int, count=len(pis))
+            # reshape() checks that all PIs are in the right shape
+            data[rows] = np.concatenate(list(pis.values())).reshape((len(rows), self.pi_per_ma))
+            has_pi[rows] = True
+        order = np.lexsort((ma_ids, tss))
+        return TailChunk(tss[order], ma_ids[order], data[order], has_pi[order],
+                         np.array(action_ts, dtype=np.int64), np.array(actions, dtype=np.int64))
+
+
+class ReplayDB(ReplayDBBackend):
+    """The SQLite backend of ReplayDB
+
+    Attributes:
+        pi_format: format of pis.pi_data, one of the PI_FORMAT_* constants. New DBs use
+                   opt['replaydb_pi_format'], which defaults to PI_FORMAT_LATEST. PI_FORMAT_DELTA
+                   makes long runs much smaller at the cost of decoding. Existing DBs can be
+                   converted using migrate_pi_format().
+        retention_status: progress of the retention policy, see enforce_retention()
+        vacuum_pages_per_step: maximum number of free pages returned to the file system by one
+                               retention step. Only DBs created with auto_vacuum=INCREMENTAL can
+                               return free pages; on other DBs they are reused by new rows.
+        partition_ticks: if larger than 0, data are written to a new partition file named
+                         dbfile.<start_ts> for every partition_ticks ticks. The newest partition
+                         is opened as the main DB and the older ones are attached read-only.
+                         Temporary views named pis, actions and tick_counts federate all of them
+                         for reading. A DB file created without partitioning is used as the oldest
+                         partition. Old partitions can be archived, copied or deleted as whole
+                         files, and the other ReplayDBs pick up the change within
+                         partition_check_interval seconds. SQLite can attach at most 10 old
+                         partitions (SQLITE_MAX_ATTACHED), and the data in the partitions older
+                         than them are not visible, so partition_ticks should be chosen to keep
+                         the live partitions within that limit.
+        read_only: open the DB with mode=ro and query_only. Each thread that uses the ReplayDB gets
+                   its own connection from a pool so readers never contend with each other or
+                   the writer. Use snapshot() to do several reads on one consistent snapshot.
+                   A read-only ReplayDB never creates or upgrades a DB. Until the writer has
+                   created the DB file it reads an empty DB. Tables that were added by later
+                   versions, such as tick_counts, are replaced by equivalent (slower) queries
+                   over pis if the writer hasn't upgraded the DB.
+        open_timeout: seconds a read-only ReplayDB waits for the tables of a new DB file to be created
+        mmap_size: if larger than 0, the PRAGMA mmap_size of every connection in bytes
+        cache_size: if larger than 0, the PRAGMA cache_size of every connection in KiB
+        synchronous: if set, the PRAGMA synchronous of the writer's connection, e.g. 'NORMAL', which
+                     in WAL mode only syncs at checkpoints and can't corrupt the DB on power loss
+                     (but may lose the most recent transactions)
+
+    :type conn: sqlite3.Connection
+    """
+    _conn = None
+    pi_format = PI_FORMAT_LATEST
+    vacuum_pages_per_step = 256
+    partition_ticks = 0
+    partition_check_interval = 1
+    read_only = False
+    open_timeout = 60
+    mmap_size = 0
+    cache_size = 0
+    synchronous = None
+
+    def __init__(self, opt: dict):
+        ReplayDBBackend.__init__(self, opt)
+        self.vacuum_pages_per_step = opt.get('vacuum_pages_per_step', self.vacuum_pages_per_step)
+        self.partition_ticks = opt.get('partition_ticks', self.partition_ticks)
+        self.partition_check_interval = opt.get('partition_check_interval', self.partition_check_interval)
+        self.read_only = opt.get('replaydb_read_only', self.read_only)
+        self.open_timeout = opt.get('replaydb_open_timeout', self.open_timeout)
+        self.mmap_size = opt.get('replaydb_mmap_size', self.mmap_size)
+        self.cache_size = opt.get('replaydb_cache_size', self.cache_size)
+        self.synchronous = opt.get('replaydb_synchronous', self.synchronous)
+        # Format of new DBs; replaced by the format of the DB once it's opened
+        self.pi_format = opt.get('replaydb_pi_format', self.pi_format)
+        self._pi_encoder = PIEncoder(self.pi_format)
+        self._opt = opt
+        # The connection pool of read-only mode. A thread's connection is remade when
+        # _generation changes, which happens when the partitions change.
+        self._local = threading.local()
+        self._pool = []
+        self._pool_lock = threading.Lock()
+        self._generation = 0
+        self.dbfile = opt['dbfile']
+        # (schema, file name) of all federated partitions, newest (main) first
+        self._partitions = []
+        # Start ts of the main partition, None if main is not a partition file
+        self._partition_start = None
+        # Files that lack tick_counts and ts_ranges, which a read-only ReplayDB can't add
+        self._legacy_files = set()
+        self._last_partition_check = 0
+        self._last_retention_time = 0
+        self.retention_status = {
+            'archived_until_ts': None,
+            'aged_out_rows': 0,
+            'archived_buckets': 0,
+            'vacuumed_pages': 0,
+            'last_step_latency': 0,
+        }
+        # Rows waiting to be written. _pending_pi_keys mirrors _pending_pis for quick lookups of (ma_id, ts).
+        self._pending_pis = []
+        self._pending_pi_keys = set()
+        self._pending_actions = []
+        self._first_pending_time = None
+        # The largest stored (or buffered) ts of each MA, used by insert_pi() to detect missing entries
+        # without querying the DB. It assumes this ReplayDB is the only writer of the DB.
+        self._last_pi_ts = {}
+        # Maps MA ID to its index in ordered_client_list, -1 for non client MAs
+        if self.ordered_client_list:
+            self._client_slot_map = np.full(max(self.ordered_client_list) + 1, -1, dtype=int)
+            self._client_slot_map[self.ordered_client_list] = np.arange(len(self.ordered_client_list))
+
+        if self.partition_ticks > 0:
+            self._open_partitions()
+        else:
+            # A reader that starts before the writer reads an empty DB until the file is created
+            main_file = self.dbfile if not self.read_only or os.path.exists(self.dbfile) else ':memory:'
+            self._partitions = [('main', main_file)]
+            self._open_main(main_file)
+        if not self.read_only:
+            self._load_last_pi_ts()
+
+    def _load_last_pi_ts(self):
+        """Rebuild the last ts of each MA from the DB"""
+        c = self.conn.execute('SELECT ma_id, MAX(ts) FROM pis GROUP BY ma_id')
+        self._last_pi_ts = dict(c.fetchall())
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """The connection to the DB
+
+        In read-only mode every thread gets its own connection from the pool.
+        """
+        if not self.read_only:
+            return self._conn
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        # Partitions have changed since this connection was made. Don't switch in the middle of a snapshot.
+        if conn is None or (local.generation != self._generation and not conn.in_transaction):
+            if conn is not None:
+                with self._pool_lock:
+                    # close() may have emptied the pool already
+                    if conn in self._pool:
+                        self._pool.remove(conn)
+                conn.close()
+            conn = self._connect(self._partitions[0][1])
+            self._attach_partitions(conn)
+            # After the temp views have been created
+            conn.execute('PRAGMA query_only = 1')
+            with self._pool_lock:
+                self._pool.append(conn)
+            local.conn = conn
+            local.generation = self._generation
+        return conn
+
+    @conn.setter
+    def conn(self, conn: sqlite3.Connection):
+        self._conn = conn
+
+    def _open_main(self, dbfile: str):
+        """Connect to dbfile and create the tables if needed
+
+        In read-only mode the connections are made by the pool when they are used.
+        """
+        if self.read_only:
+            if dbfile != ':memory:':
+                self._wait_for_schema(dbfile)
+            self._generation += 1
+            self.pi_format = get_pi_format(self.conn)
+            return
+        self.connect_db(self._opt, dbfile)
         c = self.conn.cursor()
+        self._create_schema(c, self.pi_format)
+        self.pi_format = get_pi_format(self.conn)
+        # A new partition starts with keyframes so it can be read without the older ones
+        self._pi_encoder = PIEncoder(self.pi_format)
+        self.conn.commit()
+        if dbfile == ':memory:':
+            return
+        c.execute('ANALYZE')
+        self.conn.commit()
+        # The results of an ANALYZE command are only available to database connections that
+        # are opened after the ANALYZE command completes.
+        # https://www.sqlite.org/optoverview.html#multi_index
+        self.conn.close()
+        self.connect_db(self._opt, dbfile)
+
+    @classmethod
+    def _create_schema(cls, c: sqlite3.Cursor, pi_format: int = PI_FORMAT_LATEST):
+        """Create the tables that don't exist yet
+
+        :param pi_format: the PI format of a new DB
+        """
+        c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'pis'")
+        if c.fetchone()[0] == 0:
+            # A new DB. auto_vacuum can only be changed before the first table is created.
+            c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            c.execute('PRAGMA user_version = {0:d}'.format(pi_format))
         # Enable WAL mode for better concurrent read/write
         c.execute('PRAGMA journal_mode=WAL;')
         # performance indicators
@@ -77,67 +806,580 @@ class ReplayDB:
         c.execute('''CREATE TABLE IF NOT EXISTS actions (
                         ts     INTEGER PRIMARY KEY CHECK (TYPEOF(ts) = 'integer'),
                         action INTEGER             CHECK (TYPEOF(action) = 'integer'))''')
-        self.conn.commit()
-        c.execute('ANALYZE')
-        self.conn.commit()
-        # The results of an ANALYZE command are only available to database connections that
-        # are opened after the ANALYZE command completes.
-        # https://www.sqlite.org/optoverview.html#multi_index
-        self.conn.close()
-        del self.conn
-        self.connect_db(opt)
-
-    def connect_db(self, opt):
-        dbfile = opt['dbfile']
-        # For supporting being created within DQLDaemon
-        if 'disable_same_thread_check' in opt and opt['disable_same_thread_check']:
-            self.conn = sqlite3.connect(dbfile, timeout=120, check_same_thread=False,
-                                        detect_types=sqlite3.PARSE_COLNAMES | sqlite3.PARSE_DECLTYPES)
-        else:
-            self.conn = sqlite3.connect(dbfile, timeout=120,
-                                        detect_types=sqlite3.PARSE_COLNAMES | sqlite3.PARSE_DECLTYPES)
+        cls._create_tick_counts(c)
+        cls._create_ts_ranges(c)
+        # Downsampled PIs that have been aged out of pis. ts is the first ts of the bucket, ticks is
+        # the number of raw entries averaged, and pi_data is always PI_FORMAT_F64LE.
+        c.execute('''CREATE TABLE IF NOT EXISTS pis_archive (
+                        ma_id   INTEGER,
+                        ts      INTEGER,
+                        ticks   INTEGER,
+                        pi_data BLOB,
+                        PRIMARY KEY (ma_id, ts))''')
+        # For merging rows into buckets that have been partly archived
+        c.execute('CREATE INDEX IF NOT EXISTS pis_archive_ts_index ON pis_archive (ts)')
+
+    def _partition_file(self, start_ts: int) -> str:
+        return '{0}.{1:d}'.format(self.dbfile, start_ts)
+
+    def _partition_files(self) -> List[str]:
+        """Return all partition files, oldest first"""
+        prefix = self.dbfile + '.'
+        starts = sorted(int(f[len(prefix):]) for f in glob.glob(glob.escape(prefix) + '*')
+                        if f[len(prefix):].isdigit())
+        files = [self._partition_file(x) for x in starts]
+        if os.path.exists(self.dbfile):
+            files.insert(0, self.dbfile)
+        return files
+
+    def _open_partitions(self, main_file: str = None):
+        """(Re)connect with main_file as the main DB and federate the older partitions
+
+        :param main_file: the partition to write to. Defaults to the newest partition, or an
+                          empty in-memory DB if there is none yet.
+        """
+        files = self._partition_files()
+        if main_file is None:
+            main_file = files[-1] if files else ':memory:'
+        if self._conn:
+            self.flush()
+            self._conn.close()
+        prefix = self.dbfile + '.'
+        self._partition_start = int(main_file[len(prefix):]) if main_file.startswith(prefix) else None
+
+        older = [f for f in reversed(files) if f != main_file]
+        conn = sqlite3.connect(':memory:')
+        try:
+            max_attached = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+        finally:
+            conn.close()
+        if len(older) > max_attached:
+            logger.warning('Only the newest {0} of {1} old partitions can be attached. The data in the '
+                           'others are not visible; archive or remove them.'.format(max_attached, len(older)))
+            older = older[:max_attached]
+        for filename in older:
+            if self.read_only:
+                self._wait_for_schema(filename)
+            else:
+                self._upgrade_schema(filename)
+        self._partitions = [('main', main_file)] + [('p{0:d}'.format(i), f) for i, f in enumerate(older)]
+        self._open_main(main_file)
+        if not self.read_only:
+            self._attach_partitions(self._conn)
+        logger.info('Opened partition {0} with {1} older partitions'.format(main_file, len(older)))
+
+    def _attach_partitions(self, conn: sqlite3.Connection):
+        """Attach the older partitions to conn read-only and create the federated views
+
+        A tick_counts view is also created for a single legacy file.
+        """
+        tables = ('pis', 'actions', 'tick_counts') if len(self._partitions) > 1 else \
+            ('tick_counts',) if self._legacy_files else ()
+        if not tables:
+            return
+        c = conn.cursor()
+        for schema, filename in self._partitions[1:]:
+            c.execute('ATTACH DATABASE ? AS ' + schema, ('file:{0}?mode=ro'.format(urllib.parse.quote(filename)),))
+            pi_format = c.execute('PRAGMA {0}.user_version'.format(schema)).fetchone()[0]
+            if pi_format != self.pi_format:
+                raise ValueError('Partition {0} uses PI format {1} but {2} is required. Convert it using '
+                                 'migrate_pi_format().'.format(filename, pi_format, self.pi_format))
+        for table in tables:
+            c.execute('CREATE TEMP VIEW {0} AS '.format(table) +
+                      ' UNION ALL '.join('SELECT * FROM ' + (self._tick_counts(schema) if table == 'tick_counts'
+                                                             else '{0}.{1}'.format(schema, table))
+                                         for schema, _ in self._partitions))
+
+    def _tick_counts(self, schema: str) -> str:
+        """The tick_counts table of a partition, or an equivalent query over pis for a legacy file"""
+        if dict(self._partitions)[schema] in self._legacy_files:
+            return '(SELECT ts, COUNT(*) AS entries FROM {0}.pis GROUP BY ts)'.format(schema)
+        return '{0}.tick_counts'.format(schema)
+
+    def _upgrade_schema(self, filename: str):
+        """Create the tables that are missing from an old partition created by an older version
+
+        Old partitions are attached read-only so they can't do this themselves.
+        """
+        conn = sqlite3.connect(filename, timeout=120)
+        try:
+            c = conn.cursor()
+            c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND "
+                      "name IN ('pis', 'actions', 'tick_counts', 'ts_ranges', 'pis_archive')")
+            if c.fetchone()[0] < 5:
+                logger.info('Upgrading the schema of ' + filename)
+                self._create_schema(c, self.pi_format)
+                conn.commit()
+        finally:
+            conn.close()
+
+    def _wait_for_schema(self, filename: str):
+        """Wait until filename has the pis and actions tables, which only the writer can create
+
+        A file without the tables added later is read as a legacy file. sqlite3.OperationalError
+        is raised if the tables are not created within open_timeout seconds.
+        """
+        deadline = time.time() + self.open_timeout
+        while True:
+            tables = set()
+            if os.path.exists(filename):
+                conn = sqlite3.connect('file:{0}?mode=ro'.format(urllib.parse.quote(filename)), uri=True)
+                try:
+                    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                finally:
+                    conn.close()
+            if {'pis', 'actions'} <= tables:
+                if {'tick_counts', 'ts_ranges'} <= tables:
+                    self._legacy_files.discard(filename)
+                else:
+                    logger.info('{0} has not been upgraded by its writer. Reading it without '
+                                'tick_counts and ts_ranges.'.format(filename))
+                    self._legacy_files.add(filename)
+                return
+            if time.time() >= deadline:
+                raise sqlite3.OperationalError('{0} has not been created by its writer'.format(filename))
+            time.sleep(min(1, self.open_timeout))
+
+    def _roll_over_if_needed(self, ts: int):
+        """Switch to a new partition if ts is beyond the current one"""
+        if self.partition_ticks <= 0:
+            return
+        start_ts = ts - ts % self.partition_ticks
+        if self._partition_start is None or start_ts > self._partition_start:
+            self._open_partitions(self._partition_file(start_ts))
+
+    def _in_older_partition(self, ts: int, sql: str, args: Sequence) -> bool:
+        """Whether sql finds the row at ts in one of the older partitions
+
+        Rows older than the main partition are written to it, but the older partitions are
+        attached read-only so their unique constraints don't cover the main partition.
+        """
+        if self._partition_start is None or ts >= self._partition_start or len(self._partitions) == 1:
+            return False
+        return self.conn.execute(sql, args).fetchone() is not None
+
+    def _refresh_partitions(self):
+        """Follow partitions that have been created or deleted by others
+
+        This is called by the methods that readers call first, such as get_pi_ts_range(), and
+        checks the file system at most once per partition_check_interval seconds. A read-only
+        ReplayDB without partitions switches to the DB file once the writer has created it.
+        """
+        if time.time() - self._last_partition_check < self.partition_check_interval:
+            return
+        self._last_partition_check = time.time()
+        if self.partition_ticks <= 0:
+            if self._partitions[0][1] == ':memory:' and os.path.exists(self.dbfile) and \
+               not self.conn.in_transaction:
+                self._partitions = [('main', self.dbfile)]
+                self._open_main(self.dbfile)
+            return
+        files = self._partition_files()[::-1][:len(self._partitions)]
+        if files and files != [filename for _, filename in self._partitions] and not self.conn.in_transaction:
+            self._open_partitions()
+
+    @staticmethod
+    def _create_tick_counts(c: sqlite3.Cursor):
+        """Create the tick_counts table, which keeps the number of PI entries of each ts
+
+        It is maintained by triggers on pis so writes by any connection keep it up to date.
+        DBs created before this table existed are backfilled.
+        """
+        c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'tick_counts'")
+        backfill = c.fetchone()[0] == 0
+        c.execute('''CREATE TABLE IF NOT EXISTS tick_counts (
+                        ts      INTEGER PRIMARY KEY,
+                        entries INTEGER NOT NULL)''')
+        # For looking up the last complete tick
+        c.execute('CREATE INDEX IF NOT EXISTS tick_counts_entries_ts_index ON tick_counts (entries, ts)')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS pis_tick_counts_insert AFTER INSERT ON pis BEGIN
+                        INSERT INTO tick_counts (ts, entries) VALUES (NEW.ts, 1)
+                            ON CONFLICT (ts) DO UPDATE SET entries = entries + 1;
+                     END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS pis_tick_counts_delete AFTER DELETE ON pis BEGIN
+                        UPDATE tick_counts SET entries = entries - 1 WHERE ts = OLD.ts;
+                        DELETE FROM tick_counts WHERE ts = OLD.ts AND entries <= 0;
+                     END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS pis_tick_counts_update AFTER UPDATE OF ts ON pis
+                     WHEN OLD.ts IS NOT NEW.ts BEGIN
+                        UPDATE tick_counts SET entries = entries - 1 WHERE ts = OLD.ts;
+                        DELETE FROM tick_counts WHERE ts = OLD.ts AND entries <= 0;
+                        INSERT INTO tick_counts (ts, entries) VALUES (NEW.ts, 1)
+                            ON CONFLICT (ts) DO UPDATE SET entries = entries + 1;
+                     END''')
+        if backfill:
+            c.execute('INSERT INTO tick_counts (ts, entries) SELECT ts, COUNT(*) FROM pis GROUP BY ts')
+
+    @staticmethod
+    def _create_ts_ranges(c: sqlite3.Cursor):
+        """Create the ts_ranges table, which keeps MIN(ts) and MAX(ts) of pis and actions
+
+        SQLite can't use an index for SELECT MIN(ts), MAX(ts), so the ranges are maintained
+        by triggers in the same transaction as the writes and readers only do a primary key
+        lookup. DBs created before this table existed are backfilled.
+        """
+        c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'ts_ranges'")
+        backfill = c.fetchone()[0] == 0
+        c.execute('''CREATE TABLE IF NOT EXISTS ts_ranges (
+                        name   TEXT PRIMARY KEY,
+                        min_ts INTEGER,
+                        max_ts INTEGER)''')
+        for table in ('pis', 'actions'):
+            c.execute('INSERT OR IGNORE INTO ts_ranges (name) VALUES (?)', (table,))
+            c.execute('''CREATE TRIGGER IF NOT EXISTS {0}_ts_ranges_insert AFTER INSERT ON {0} BEGIN
+                            UPDATE ts_ranges SET min_ts = MIN(IFNULL(min_ts, NEW.ts), NEW.ts),
+                                                 max_ts = MAX(IFNULL(max_ts, NEW.ts), NEW.ts)
+                                WHERE name = '{0}';
+                         END'''.format(table))
+            # Removing a row on the boundary needs a lookup of the new boundary, which uses the ts index
+            recompute = '''UPDATE ts_ranges SET min_ts = (SELECT MIN(ts) FROM {0}),
+                                                max_ts = (SELECT MAX(ts) FROM {0})
+                               WHERE name = '{0}';'''.format(table)
+            c.execute('''CREATE TRIGGER IF NOT EXISTS {0}_ts_ranges_delete AFTER DELETE ON {0}
+                         WHEN OLD.ts <= (SELECT min_ts FROM ts_ranges WHERE name = '{0}') OR
+                              OLD.ts >= (SELECT max_ts FROM ts_ranges WHERE name = '{0}') BEGIN
+                            {1}
+                         END'''.format(table, recompute))
+            c.execute('''CREATE TRIGGER IF NOT EXISTS {0}_ts_ranges_update AFTER UPDATE OF ts ON {0}
+                         WHEN OLD.ts IS NOT NEW.ts BEGIN
+                            {1}
+                         END'''.format(table, recompute))
+            if backfill:
+                c.execute(recompute)
+
+    def connect_db(self, opt, dbfile: str = None):
+        if dbfile is None:
+            dbfile = opt['dbfile']
+        self.conn = self._connect(dbfile, opt.get('disable_same_thread_check', False))
+
+    def _connect(self, dbfile: str, disable_same_thread_check: bool = True) -> sqlite3.Connection:
+        """Make a new connection to dbfile
+
+        In read-only mode the DB files are opened with mode=ro so they never take a write lock.
+
+        :param disable_same_thread_check: For supporting being created within DQLDaemon. Connections of
+                                          the read-only pool are closed by close() from any thread.
+        """
+        if self.read_only and dbfile != ':memory:':
+            dbfile = 'file:{0}?mode=ro'.format(urllib.parse.quote(dbfile))
+        # uri is needed for attaching partitions read-only
+        conn = sqlite3.connect(dbfile, timeout=120, check_same_thread=not disable_same_thread_check, uri=True,
+                               detect_types=sqlite3.PARSE_COLNAMES | sqlite3.PARSE_DECLTYPES)
+        c = conn.cursor()
+        if self.mmap_size > 0:
+            c.execute('PRAGMA mmap_size = {0:d}'.format(self.mmap_size))
+        if self.cache_size > 0:
+            # A negative value is in KiB
+            c.execute('PRAGMA cache_size = -{0:d}'.format(self.cache_size))
+        if self.synchronous and not self.read_only:
+            c.execute('PRAGMA synchronous = {0}'.format(self.synchronous))
+        if self.read_only and dbfile == ':memory:':
+            # An empty DB used before the first partition is created
+            self._create_schema(c, self.pi_format)
+            # Otherwise the open transaction keeps _refresh_partitions() from switching to the file
+            conn.commit()
         logger.info('Connected to database %s' % dbfile)
+        return conn
+
+    def close(self):
+        self.flush()
+        if self.read_only:
+            with self._pool_lock:
+                for conn in self._pool:
+                    conn.close()
+                self._pool = []
+            self._generation += 1
+        else:
+            self.conn.close()
+
+    @contextmanager
+    def snapshot(self):
+        """Do the reads in the with block on one consistent snapshot of the DB
+
+        Writes committed by others during the block are not seen. Nested snapshots share the
+        outermost one.
+        """
+        conn = self.conn
+        if conn.in_transaction:
+            yield
+            return
+        conn.execute('BEGIN')
+        try:
+            yield
+        finally:
+            conn.commit()
 
     def insert_pi(self, ma_id: int, ts: int, data):
-        c = self.conn.cursor()
-        c.arraysize = 2
+        """Store the PIs of an MA
+
+        The row may be buffered if write_batch_size is larger than 1. Buffered rows are
+        written to the DB by flush(). A duplicate of a row in an older partition raises
+        sqlite3.IntegrityError right away; other duplicates raise it in flush().
+        """
+        self._roll_over_if_needed(ts)
+        last_ts = self._last_pi_ts.get(ma_id)
+        if last_ts is None or last_ts < ts:
+            # The usual case of PIs arriving in order: nothing after last_ts has been stored
+            prev_ts = {last_ts} & {ts-2, ts-1}
+        else:
+            # A late arrival. Look up what's stored around it.
+            c = self.conn.cursor()
+            c.arraysize = 2
+            c.execute('SELECT ts FROM pis WHERE ma_id=? AND ts>=? AND ts<? ORDER BY ts', (ma_id, ts-2, ts))
+            prev_ts = {row[0] for row in c.fetchall()}
+            # Rows that are still in the write buffer count as well
+            prev_ts.update(x for x in (ts-2, ts-1) if (ma_id, x) in self._pending_pi_keys)
         # If there's a missing entry before ts, insert ts as ts-1
-        c.execute('SELECT ts FROM pis WHERE ma_id=? AND ts>=? AND ts<? ORDER BY ts', (ma_id, ts-2, ts))
-        prev_ts = c.fetchall()
-        if len(prev_ts) == 1 and prev_ts[0][0] == ts-2:
+        if prev_ts == {ts-2}:
             ts -= 1
             logger.debug("A previous missing entry detected, storing PI for ma_id " +
                          str(ma_id) + " at ts-1 " + str(ts))
         else:
             logger.debug("Storing PI for ma_id " + str(ma_id) + ", ts " + str(ts))
+        if self._in_older_partition(ts, 'SELECT 1 FROM pis WHERE ma_id = ? AND ts = ?', (ma_id, ts)):
+            raise sqlite3.IntegrityError('UNIQUE constraint failed: pis.ma_id, pis.ts (in an older partition)')
 
-        try:
-            c.execute('INSERT INTO pis VALUES (?,?,?)', (ma_id, ts, pickle.dumps(data)))
-            self.conn.commit()
-        except sqlite3.IntegrityError as e:
-            logger.warning('{type}: {msg}'.format(type=type(e).__name__, msg=str(e)))
-            if 'constraint failed' in str(e):
-                raise
+        self._pending_pis.append((ma_id, ts, self._pi_encoder.encode(ma_id, ts, data)))
+        self._pending_pi_keys.add((ma_id, ts))
+        if last_ts is None or last_ts < ts:
+            self._last_pi_ts[ma_id] = ts
+        self._flush_if_needed()
 
     def insert_action(self, ts: int, action: int):
+        """Store an action
+
+        The row may be buffered if write_batch_size is larger than 1. Buffered rows are
+        written to the DB by flush().
+        """
         assert isinstance(action, int)
+        self._roll_over_if_needed(ts)
+        if self._in_older_partition(ts, 'SELECT 1 FROM actions WHERE ts = ?', (ts,)):
+            raise sqlite3.IntegrityError('UNIQUE constraint failed: actions.ts (in an older partition)')
+        self._pending_actions.append((ts, action))
+        logger.debug('Stored action {action} at {ts}'.format(action=action, ts=ts))
+        self._flush_if_needed()
+
+    def _flush_if_needed(self):
+        if self._first_pending_time is None:
+            self._first_pending_time = time.time()
+        if len(self._pending_pis) + len(self._pending_actions) >= self.write_batch_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """Flush the write buffer if its oldest row has been waiting longer than write_batch_interval
+
+        The owner of the DB should call this regularly so buffered rows don't stay in memory
+        when no new data comes in.
+        """
+        if self._first_pending_time is not None and self.write_batch_interval > 0 and \
+           time.time() - self._first_pending_time >= self.write_batch_interval:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered rows to the DB in one transaction
+        """
+        size = len(self._pending_pis) + len(self._pending_actions)
+        if size == 0:
+            self._first_pending_time = None
+            return
+        start_time = time.time()
+        # Other errors, such as a timeout on a locked DB, leave the buffer untouched so the next
+        # flush retries it. The rows are already part of _last_pi_ts and the PIEncoder state.
         try:
+            with self.conn:
+                c = self.conn.cursor()
+                c.executemany('INSERT INTO main.pis VALUES (?,?,?)', self._pending_pis)
+                c.executemany('INSERT INTO main.actions VALUES (?,?)', self._pending_actions)
+        except sqlite3.IntegrityError:
+            # The whole transaction has been rolled back. Fall back to inserting one row
+            # at a time so we know which row is the culprit.
+            try:
+                self._flush_row_by_row()
+            except sqlite3.IntegrityError:
+                # The bad rows are dropped, so the next rows must not be repaired or encoded as
+                # deltas based on them
+                self._clear_pending()
+                self._pi_encoder.reset()
+                self._load_last_pi_ts()
+                raise
+        self._clear_pending()
+        self.last_flush_latency = time.time() - start_time
+        self.last_flush_size = size
+        logger.debug('Flushed {size} rows in {latency} seconds'.format(size=size, latency=self.last_flush_latency))
+
+    def enforce_retention(self) -> int:
+        """Age out one slice of PIs that are older than retention_ticks
+
+        Up to retention_step_ticks ticks (and about retention_step_rows rows) of the oldest PIs
+        are averaged per MA into buckets of retention_downsample_ticks ticks, which are stored in
+        pis_archive, and deleted from pis. Only buckets that are entirely older than
+        retention_ticks are aged out, but a bucket may take several steps. Then up to
+        vacuum_pages_per_step free pages are returned to the file system. Each step is kept
+        small so writers are not blocked for long.
+        When partitioning is used only the main partition is aged out; older partitions are
+        removed as whole files.
+
+        :return: number of PI rows aged out
+        """
+        if self.retention_ticks <= 0:
+            return 0
+        start_time = time.time()
+        self.flush()
+        c = self.conn.cursor()
+        c.execute('SELECT MIN(ts), MAX(ts) FROM main.tick_counts')
+        min_ts, max_ts = c.fetchone()
+        rows = 0
+        if min_ts is not None:
+            bucket_len = self.retention_downsample_ticks
+            step_ticks = min(self.retention_step_ticks, max(1, self.retention_step_rows // self.num_ma))
+            # Everything before end_ts will be aged out in this step
+            end_ts = min((max_ts - self.retention_ticks + 1) // bucket_len * bucket_len, min_ts + step_ticks)
+            if min_ts < end_ts:
+                rows = self._archive_pis(end_ts)
+                # Late arrivals don't move archived_until_ts backwards
+                self.retention_status['archived_until_ts'] = max(end_ts,
+                                                                 self.retention_status['archived_until_ts'] or end_ts)
+        self.retention_status['aged_out_rows'] += rows
+        freelist_count = c.execute('PRAGMA freelist_count').fetchone()[0]
+        # incremental_vacuum frees one page per step of the statement, so all rows must be fetched
+        c.execute('PRAGMA incremental_vacuum({0:d})'.format(self.vacuum_pages_per_step)).fetchall()
+        self.retention_status['vacuumed_pages'] += freelist_count - c.execute('PRAGMA freelist_count').fetchone()[0]
+        self.retention_status['last_step_latency'] = time.time() - start_time
+        if rows:
+            logger.info('Aged out {rows} PI rows before ts {ts} in {latency} seconds'.format(
+                rows=rows, ts=self.retention_status['archived_until_ts'],
+                latency=self.retention_status['last_step_latency']))
+        return rows
+
+    def _archive_pis(self, end_ts: int) -> int:
+        """Move PIs before end_ts to pis_archive in one transaction
+
+        :return: number of PI rows moved
+        """
+        bucket_len = self.retention_downsample_ticks
+        with self.conn:
             c = self.conn.cursor()
-            c.execute('INSERT INTO actions VALUES (?,?)', (ts, action))
-            logger.debug('Stored action {action} at {ts}'.format(action=action, ts=ts))
+            c.execute('SELECT ma_id, ts, pi_data FROM main.pis WHERE ts < ?', (end_ts,))
+            data = c.fetchall()
+            pis = self._decode_pis(data)
+            # (ma_id, bucket ts) -> [number of entries, sum of PIs]
+            buckets = dict()
+            for ma_id, ts, _ in data:
+                pi = pis.get((ma_id, ts))
+                if pi is None:
+                    # A delta that can't be decoded; it is deleted all the same
+                    continue
+                key = (ma_id, ts - ts % bucket_len)
+                if key in buckets:
+                    buckets[key][0] += 1
+                    buckets[key][1] = buckets[key][1] + pi
+                else:
+                    buckets[key] = [1, pi.astype(float)]
+            # Buckets may have been partly archived by the last step or before late arrivals came in
+            if buckets:
+                bucket_tss = [ts for _, ts in buckets]
+                c.execute('SELECT ma_id, ts, ticks, pi_data FROM main.pis_archive WHERE ts >= ? AND ts <= ?',
+                          (min(bucket_tss), max(bucket_tss)))
+                for ma_id, ts, ticks, blob in c.fetchall():
+                    bucket = buckets.get((ma_id, ts))
+                    if bucket:
+                        bucket[0] += ticks
+                        bucket[1] = bucket[1] + decode_pi(blob, PI_FORMAT_F64LE) * ticks
+            c.executemany('INSERT OR REPLACE INTO main.pis_archive VALUES (?,?,?,?)',
+                          [(ma_id, ts, ticks, encode_pi(pi_sum / ticks, PI_FORMAT_F64LE))
+                           for (ma_id, ts), (ticks, pi_sum) in buckets.items()])
+            if self.pi_format == PI_FORMAT_DELTA:
+                # Deltas at end_ts would refer to deleted ticks
+                c.execute('SELECT ma_id, ts, pi_data FROM main.pis WHERE ts = ?', (end_ts,))
+                deltas = [row for row in c.fetchall() if is_delta_pi(row[2], self.pi_format)]
+                c.executemany('UPDATE main.pis SET pi_data = ? WHERE ma_id = ? AND ts = ?',
+                              [(encode_pi(pi, self.pi_format), ma_id, ts)
+                               for (ma_id, ts), pi in self._decode_pis(deltas).items()])
+            c.execute('DELETE FROM main.pis WHERE ts < ?', (end_ts,))
+        self.retention_status['archived_buckets'] += len(buckets)
+        return len(data)
+
+    def enforce_retention_if_due(self):
+        if self.retention_ticks > 0 and time.time() - self._last_retention_time >= self.retention_interval:
+            self._last_retention_time = time.time()
+            self.enforce_retention()
+
+    def get_status(self) -> Dict[str, Any]:
+        result = ReplayDBBackend.get_status(self)
+        result.update(self.retention_status)
+        result['partitions'] = len(self._partitions)
+        c = self.conn.cursor()
+        for pragma in ('auto_vacuum', 'freelist_count', 'page_count'):
+            c.execute('PRAGMA ' + pragma)
+            result[pragma] = c.fetchone()[0]
+        return result
+
+    def _clear_pending(self):
+        self._pending_pis = []
+        self._pending_pi_keys = set()
+        self._pending_actions = []
+        self._first_pending_time = None
+
+    def _flush_row_by_row(self):
+        c = self.conn.cursor()
+        error = None
+        try:
+            for sql, rows in (('INSERT INTO main.pis VALUES (?,?,?)', self._pending_pis),
+                              ('INSERT INTO main.actions VALUES (?,?)', self._pending_actions)):
+                for row in rows:
+                    try:
+                        c.execute(sql, row)
+                    except sqlite3.IntegrityError as e:
+                        logger.warning('{type}: {msg}'.format(type=type(e).__name__, msg=str(e)))
+                        if 'constraint failed' in str(e) and not error:
+                            error = e
             self.conn.commit()
-        except sqlite3.IntegrityError as e:
-            logger.warning('{type}: {msg}'.format(type=type(e).__name__, msg=str(e)))
-            if 'constraint failed' in str(e):
-                raise
+        except Exception:
+            # Nothing is written so the whole buffer can be retried
+            self.conn.rollback()
+            raise
+        # Good rows are kept; the first error is raised after all of them have been written
+        if error:
+            raise error
+
+    def _decode_pis(self, rows: Sequence[Tuple[int, int, bytes]]) -> Dict[Tuple[int, int], np.ndarray]:
+        """Decode (ma_id, ts, pi_data) rows
+
+        The ticks that deltas of PI_FORMAT_DELTA refer to are read from the DB if they are not
+        in rows.
+
+        :return: a dict that maps (ma_id, ts) to PIs. Deltas that can't be decoded are left out.
+        """
+        if self.pi_format != PI_FORMAT_DELTA:
+            return {(ma_id, ts): decode_pi(blob, self.pi_format) for ma_id, ts, blob in rows}
+        rows = sorted(rows, key=lambda row: (row[0], row[1]))
+        keys = [(row[0], row[1]) for row in rows]
+        key_set = set(keys)
+        context = dict()
+        for ma_id, ts, blob in rows:
+            if is_delta_pi(blob, self.pi_format) and (ma_id, ts - 1) not in key_set and \
+               (ma_id, ts - 1) not in context:
+                context.update(self._read_pi_chain(ma_id, ts - 1))
+        return {key: pi for key, pi in zip(keys, decode_pi_rows(rows, self.pi_format, context)) if pi is not None}
+
+    def _read_pi_chain(self, ma_id: int, ts: int) -> Dict[Tuple[int, int], np.ndarray]:
+        """Decode the PIs of an MA from the last keyframe tick up to ts"""
+        c = self.conn.cursor()
+        c.execute('SELECT ma_id, ts, pi_data FROM pis WHERE ma_id = ? AND ts >= ? AND ts <= ? ORDER BY ts',
+                  (ma_id, ts - ts % PI_DELTA_KEYFRAME_TICKS, ts))
+        rows = c.fetchall()
+        return {(row[0], row[1]): pi for row, pi in zip(rows, decode_pi_rows(rows, self.pi_format)) if pi is not None}
 
     def get_pi(self, ma_id: int, ts: float) -> []:
         c = self.conn.cursor()
         c.execute('SELECT * FROM pis WHERE ma_id = ? AND ts = ?', (ma_id, int(ts)))
         data = c.fetchone()
-        if not data:
+        pi = self._decode_pis([data]).get((ma_id, int(ts))) if data else None
+        if pi is None:
             raise ValueError
-        return pickle.loads(data[2])
+        return pi.tolist()
 
     def get_action(self, ts: int) -> int:
         c = self.conn.cursor()
@@ -160,74 +1402,94 @@ class ReplayDB:
 
         :return: the last ts
         """
+        self._refresh_partitions()
         c = self.conn.cursor()
+        # An index lookup on tick_counts (entries, ts) of each partition
+        result = []
+        for schema, _ in self._partitions:
+            c.execute('SELECT MAX(ts) FROM {0} WHERE entries = ?'.format(self._tick_counts(schema)), (self.num_ma,))
+            result.append(c.fetchone()[0])
+        result = [x for x in result if x is not None]
+        if len(self._partitions) > 1:
+            # A tick can be split between partitions by a ts-1 repair or late arrivals after a
+            # rollover. Only the ticks after the last tick that is complete in one partition
+            # need to be summed across partitions.
+            c.execute('SELECT ts FROM tick_counts WHERE ts > ? GROUP BY ts HAVING SUM(entries) >= ? '
+                      'ORDER BY ts DESC LIMIT 1', (max(result) if result else -(1 << 63), self.num_ma))
+            data = c.fetchone()
+            if data:
+                result.append(data[0])
+        if not result:
+            raise NotEnoughDataError
+        return max(result)
 
-        # Getting the biggest ts of the database
-        c.execute('SELECT MIN(ts) as mints, MAX(ts) as maxts from pis')
-        min_ts, max_ts = c.fetchone()
-
-        while True:
-            # time to check if all the monitoring agents sent data at that time stamp
-            c.execute('SELECT COUNT(ma_id) from pis WHERE ts = ?', (int(max_ts),))
-            if self.num_ma == c.fetchone()[0]:
-                return max_ts
-            else:
-                if max_ts == min_ts:
-                    raise NotEnoughDataError
-                max_ts -= 1
-
-    def get_observation(self, ts: int) -> np.ndarray:
-        """Retrieve the PIs and CPVs for all MAs and return an observation
-
-        We retrieve self.ticks_per_observe entries of data before ts from the DB
-        for each MA, concatenate them into a list and return
-
-        :param ts: the timestamp
-        :param missing_entry_tolerance: how many missing entries are tolerated
-        :return:
-        """
+    def get_tick_entries(self, start_ts: int, end_ts: int) -> np.ndarray:
+        entries = np.zeros((end_ts - start_ts + 1,), dtype=int)
         c = self.conn.cursor()
-        c.arraysize = self.num_ma * self.ticks_per_observation + 10
-        result = np.zeros((len(self.ordered_client_list),
-                           self.ticks_per_observation,
-                           int(self.tick_data_size / len(self.ordered_client_list))), dtype=float)
+        c.execute('SELECT ts, entries FROM tick_counts WHERE ts >= ? AND ts <= ?', (start_ts, end_ts))
+        data = c.fetchall()
+        if data:
+            tss, counts = zip(*data)
+            # A tick may be split between two partitions
+            np.add.at(entries, np.array(tss) - start_ts, counts)
+        return entries
 
-        sql = 'SELECT ma_id, ts, pi_data from pis WHERE ts <= ? AND ts > ? ORDER BY ma_id ASC, ts ASC'
-        c.execute(sql, (ts, ts - self.ticks_per_observation))
+    def _read_block(self, start_ts: int, end_ts: int) -> Tuple[np.ndarray, np.ndarray]:
+        n = end_ts - start_ts + 1
+        pis = np.zeros((n, len(self.ordered_client_list), self.pi_per_ma), dtype=float)
+        # Deltas need the ticks back to the last keyframe, which are read in the same query
+        query_start = start_ts - start_ts % PI_DELTA_KEYFRAME_TICKS if self.pi_format == PI_FORMAT_DELTA \
+            else start_ts
+        c = self.conn.cursor()
+        c.arraysize = self.num_ma * (end_ts - query_start + 1) + 10
+        c.execute('SELECT ma_id, ts, pi_data FROM pis WHERE ts >= ? AND ts <= ?', (query_start, end_ts))
         data = c.fetchall()
-        if len(data) < self.num_ma * self.ticks_per_observation - self.missing_entry_tolerance:
-            raise NotEnoughDataError
-        elif len(data) != self.num_ma * self.ticks_per_observation:
-            logger.debug('Observation at ts {0} has {1} missing entries'.format(
-                ts, self.num_ma * self.ticks_per_observation - len(data)))
-        for row in data:
-            ma_id = row[0]
-            pi = row[2]
-            if ma_id not in self.ordered_client_list:
-                # non client MA should send in zero length data for now
-                assert len(pickle.loads(pi)) == 0
-                continue
-            ma_id_idx = self.ordered_client_list.index(ma_id)
-            ts_idx = row[1] - (ts - self.ticks_per_observation) - 1
-            # numpy assignments also check that pi is in right shape
-            result[ma_id_idx, ts_idx] = pickle.loads(pi)
-
-        return result.reshape((self.observation_size,))
+        if self.pi_format != PI_FORMAT_F64LE:
+            decoded = self._decode_pis(data)
+            # Deltas that can't be decoded are missing entries
+            data = [(ma_id, ts, decoded[ma_id, ts]) for ma_id, ts, _ in data
+                    if ts >= start_ts and (ma_id, ts) in decoded]
+        if not data:
+            return pis, np.zeros((n,), dtype=int)
+        ma_ids, tss, blobs = zip(*data)
+        tss = np.array(tss) - start_ts
+        entries = np.bincount(tss, minlength=n)
+        # Map MA IDs to client slots. Non client MAs and unknown IDs get -1.
+        ma_ids = np.array(ma_ids)
+        slots = self._client_slot_map[np.minimum(ma_ids, len(self._client_slot_map) - 1)]
+        slots[ma_ids >= len(self._client_slot_map)] = -1
+        is_client = slots >= 0
+        if self.pi_format == PI_FORMAT_F64LE:
+            # non client MA should send in zero length data for now
+            assert sum(len(blobs[i]) for i in np.flatnonzero(~is_client)) == 0
+            # Decode all rows at once. reshape() also checks that all PIs are in right shape.
+            client_data = np.frombuffer(b''.join([blobs[i] for i in np.flatnonzero(is_client)]),
+                                        dtype=PI_DTYPE).reshape((-1, self.pi_per_ma))
+        else:
+            # blobs have been decoded above
+            assert all(len(blobs[i]) == 0 for i in np.flatnonzero(~is_client))
+            client_data = np.array([blobs[i] for i in np.flatnonzero(is_client)],
+                                   dtype=float).reshape((-1, self.pi_per_ma))
+        pis[tss[is_client], slots[is_client]] = client_data
+        return pis, entries
 
-    def get_last_n_observation(self, n: int=1) -> List[np.ndarray]:
-        result = []
+    def _get_ts_range(self, table: str) -> Tuple[int, int]:
+        """Get MIN(ts) and MAX(ts) of table across all partitions from ts_ranges"""
+        self._refresh_partitions()
         c = self.conn.cursor()
-        c.execute('SELECT MIN(ts) as mints, MAX(ts) as maxts from pis')
-        min_ts, max_ts = c.fetchone()
-        while True:
-            try:
-                result.append(self.get_observation(max_ts))
-                if len(result) == n:
-                    return result
-            except NotEnoughDataError:
-                if max_ts == min_ts:
-                    raise
-            max_ts -= 1
+        min_ts = max_ts = None
+        for schema, filename in self._partitions:
+            if filename in self._legacy_files:
+                c.execute('SELECT MIN(ts), MAX(ts) FROM {0}.{1}'.format(schema, table))
+            else:
+                c.execute('SELECT min_ts, max_ts FROM {0}.ts_ranges WHERE name = ?'.format(schema), (table,))
+            data = c.fetchone()
+            if data[0] is not None:
+                min_ts = data[0] if min_ts is None else min(min_ts, data[0])
+                max_ts = data[1] if max_ts is None else max(max_ts, data[1])
+        if (not min_ts) or (not max_ts):
+            raise NotEnoughDataError('Not enough data')
+        return min_ts, max_ts
 
     def get_pi_ts_range(self) -> Tuple[int, int]:
         """Get the range of ts that has pi
@@ -236,13 +1498,7 @@ class ReplayDB:
 
         :return: mints, maxts
         """
-        c = self.conn.cursor()
-        sql = 'SELECT MIN(ts) AS mints, MAX(ts) AS maxts FROM pis'
-        c.execute(sql)
-        data = c.fetchone()
-        if (not data[0]) or (not data[1]):
-            raise NotEnoughDataError('Not enough data')
-        return data[0], data[1]
+        return self._get_ts_range('pis')
 
     def get_action_ts_range(self) -> Tuple[int, int]:
         """Get the range of ts that has actions
@@ -251,10 +1507,89 @@ class ReplayDB:
 
         :return: mints, maxts
         """
+        return self._get_ts_range('actions')
+
+    def read_tail(self, position, max_rows: int) -> Tuple[TailChunk, object]:
+        # position maps the file name of each partition to the largest rowid of its pis and the largest
+        # ts of its actions that have been read. Both are seeks on the table B-trees. Rows that are
+        # written later than others get larger rowids, so late arrivals are returned too. Partitions
+        # are read oldest first.
+        self._refresh_partitions()
+        position = dict(position) if position else dict()
+        rows = []
+        actions = []
+        with self.snapshot():
+            c = self.conn.cursor()
+            c.arraysize = max_rows
+            for schema, filename in reversed(self._partitions):
+                last_rowid, last_action_ts = position.get(filename, (0, None))
+                if len(rows) < max_rows:
+                    c.execute('SELECT rowid, ma_id, ts, pi_data FROM {0}.pis WHERE rowid > ? '
+                              'ORDER BY rowid LIMIT ?'.format(schema), (last_rowid, max_rows - len(rows)))
+                    data = c.fetchall()
+                    if data:
+                        last_rowid = data[-1][0]
+                        rows.extend(data)
+                if len(actions) < max_rows:
+                    c.execute('SELECT ts, action FROM {0}.actions WHERE ts > ? ORDER BY ts LIMIT ?'.format(schema),
+                              (-(1 << 63) if last_action_ts is None else last_action_ts, max_rows - len(actions)))
+                    data = c.fetchall()
+                    if data:
+                        last_action_ts = data[-1][0]
+                        actions.extend(data)
+                position[filename] = (last_rowid, last_action_ts)
+        # Forget the partitions that have been removed
+        files = {filename for _, filename in self._partitions}
+        position = {k: v for k, v in position.items() if k in files}
+
+        _, ma_ids, tss, blobs = zip(*rows) if rows else ((), (), (), ())
+        if self.pi_format == PI_FORMAT_F64LE:
+            pis = {i: np.frombuffer(blob, dtype=PI_DTYPE) for i, blob in enumerate(blobs) if blob}
+        else:
+            decoded = self._decode_pis(list(zip(ma_ids, tss, blobs)))
+            # Deltas that can't be decoded are treated as missing rows
+            keep = [i for i in range(len(rows)) if (ma_ids[i], tss[i]) in decoded]
+            ma_ids = [ma_ids[i] for i in keep]
+            tss = [tss[i] for i in keep]
+            pis = {j: decoded[ma_ids[j], tss[j]] for j in range(len(keep)) if len(decoded[ma_ids[j], tss[j]])}
+        action_ts, action_values = zip(*actions) if actions else ((), ())
+        return self._make_tail_chunk(tss, ma_ids, pis, action_ts, action_values), position
+
+    def read_pis_since(self, position) -> Tuple[List[Tuple[int, int, np.ndarray, int]], object]:
+        # position maps the file name of each partition to the largest rowid of its pis that has been read
+        self._refresh_partitions()
+        position = dict(position) if position else dict()
         c = self.conn.cursor()
-        sql = 'SELECT MIN(ts) AS mints, MAX(ts) AS maxts FROM actions'
-        c.execute(sql)
-        data = c.fetchone()
-        if (not data[0]) or (not data[1]):
-            raise NotEnoughDataError('Not enough data')
-        return data[0], data[1]
+        # Use a large arraysize to increase read speed; we don't care about memory usage
+        c.arraysize = 1000000
+        rows = []
+        for schema, filename in self._partitions:
+            c.execute('SELECT rowid, ts, ma_id, pi_data FROM {0}.pis WHERE rowid > ?'.format(schema),
+                      (position.get(filename, 0),))
+            data = c.fetchall()
+            if data:
+                position[filename] = max(row[0] for row in data)
+                rows.extend(data)
+        if not rows:
+            return [], position
+        rows.sort(key=lambda row: (row[1], row[2]))
+        c.execute('SELECT ts, action FROM actions WHERE ts >= ? AND ts <= ?', (rows[0][1], rows[-1][1]))
+        actions = dict(c.fetchall())
+        pis = self._decode_pis([(row[2], row[1], row[3]) for row in rows])
+        result = [(row[1], row[2], pis[row[2], row[1]], actions.get(row[1]) or 0) for row in rows
+                  if (row[2], row[1]) in pis]
+        return result, position
+
+
+def open_replay_db(opt: dict) -> ReplayDBBackend:
+    """Open a ReplayDB using the backend chosen by opt['replaydb_backend']
+
+    Supported backends are 'sqlite' (the default) and 'memmap'.
+    """
+    backend = opt.get('replaydb_backend', 'sqlite')
+    if backend == 'sqlite':
+        return ReplayDB(opt)
+    elif backend == 'memmap':
+        from .MemmapReplayDB import MemmapReplayDB
+        return MemmapReplayDB(opt)
+    raise ValueError('Unknown ReplayDB backend ' + backend)
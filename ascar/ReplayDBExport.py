@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""Bulk export/import between ReplayDB and chunked columnar .npy files
+
+An export is a directory holding manifest.json and, for each chunk of each table, one .npy
+file per column:
+    pis-NNNNN.ts.npy, pis-NNNNN.ma_id.npy: int64 arrays
+    pis-NNNNN.pi_data.npy:                 float64 array of all PIs of the chunk concatenated
+    pis-NNNNN.pi_offsets.npy:              int64 array; the PIs of row i are pi_data[offsets[i]:offsets[i+1]]
+    actions-NNNNN.ts.npy, actions-NNNNN.action.npy: int64 arrays
+
+Rows are sorted by ts (and ma_id). Plain .npy files are used so they can be loaded with
+np.load(mmap_mode='r').
+"""
+
+import json
+import numpy as np
+import os
+import sqlite3
+import time
+import urllib.parse
+from typing import *
+from .ReplayDB import ReplayDB, PIDecoder, PIEncoder, get_pi_format, PI_DTYPE, PI_FORMAT_LATEST
+from .ascar_logging import logger
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+EXPORT_FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+
+
+def _chunk_prefix(table: str, chunk_id: int) -> str:
+    return '{0}-{1:05d}'.format(table, chunk_id)
+
+
+def export_replay_db(dbfile: str, out_dir: str, chunk_rows: int = 100000) -> Dict[str, int]:
+    """Export a ReplayDB to out_dir
+
+    The DB is read in one snapshot using a read-only connection, and at most chunk_rows rows
+    are held in memory at a time. Each partition of a partitioned DB is exported on its own.
+
+    :return: number of exported rows of each table
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    start_time = time.time()
+    conn = sqlite3.connect('file:{0}?mode=ro'.format(urllib.parse.quote(dbfile)), uri=True)
+    manifest = {'version': EXPORT_FORMAT_VERSION, 'source': os.path.abspath(dbfile), 'tables': {}}
+    try:
+        pi_format = get_pi_format(conn)
+        c = conn.cursor()
+        c.arraysize = chunk_rows
+        # One read transaction for a consistent snapshot of both tables
+        c.execute('BEGIN')
+
+        chunks = []
+        decoder = PIDecoder(pi_format)
+        c.execute('SELECT ts, ma_id, pi_data FROM pis ORDER BY ts, ma_id')
+        while True:
+            rows = c.fetchmany()
+            if not rows:
+                break
+            # Deltas that can't be decoded are left out
+            rows = [row for row in ((ts, ma_id, decoder.decode(ma_id, ts, blob)) for ts, ma_id, blob in rows)
+                    if row[2] is not None]
+            if not rows:
+                continue
+            tss, ma_ids, pis = zip(*rows)
+            offsets = np.zeros((len(pis) + 1,), dtype=np.int64)
+            np.cumsum([len(pi) for pi in pis], out=offsets[1:])
+            prefix = _chunk_prefix('pis', len(chunks))
+            columns = {
+                'ts': np.array(tss, dtype=np.int64),
+                'ma_id': np.array(ma_ids, dtype=np.int64),
+                'pi_data': np.concatenate([np.zeros((0,), dtype=PI_DTYPE)] + list(pis)).astype(PI_DTYPE, copy=False),
+                'pi_offsets': offsets,
+            }
+            for name, column in columns.items():
+                np.save(os.path.join(out_dir, '{0}.{1}.npy'.format(prefix, name)), column)
+            chunks.append({'prefix': prefix, 'rows': len(rows), 'min_ts': tss[0], 'max_ts': tss[-1]})
+        manifest['tables']['pis'] = chunks
+
+        chunks = []
+        c.execute('SELECT ts, action FROM actions ORDER BY ts')
+        while True:
+            rows = c.fetchmany()
+            if not rows:
+                break
+            tss, actions = zip(*rows)
+            prefix = _chunk_prefix('actions', len(chunks))
+            np.save(os.path.join(out_dir, prefix + '.ts.npy'), np.array(tss, dtype=np.int64))
+            np.save(os.path.join(out_dir, prefix + '.action.npy'), np.array(actions, dtype=np.int64))
+            chunks.append({'prefix': prefix, 'rows': len(rows), 'min_ts': tss[0], 'max_ts': tss[-1]})
+        manifest['tables']['actions'] = chunks
+        conn.rollback()
+    finally:
+        conn.close()
+
+    with open(os.path.join(out_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    result = {table: sum(chunk['rows'] for chunk in chunks) for table, chunks in manifest['tables'].items()}
+    logger.info('Exported {0} to {1} in {2:.2f} seconds: {3}'.format(dbfile, out_dir, time.time() - start_time,
+                                                                      result))
+    return result
+
+
+def load_exported_chunks(in_dir: str, table: str = 'pis') -> Iterator[Dict[str, np.ndarray]]:
+    """Iterate over the chunks of a table of an export
+
+    :return: an iterator of dicts mapping column names to memory-mapped arrays
+    """
+    with open(os.path.join(in_dir, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest['version'] != EXPORT_FORMAT_VERSION:
+        raise ValueError('Unknown export format {0}'.format(manifest['version']))
+    columns = ('ts', 'ma_id', 'pi_data', 'pi_offsets') if table == 'pis' else ('ts', 'action')
+    for chunk in manifest['tables'][table]:
+        yield {name: np.load(os.path.join(in_dir, '{0}.{1}.npy'.format(chunk['prefix'], name)), mmap_mode='r')
+               for name in columns}
+
+
+def import_replay_db(in_dir: str, dbfile: str, pi_format: int = PI_FORMAT_LATEST) -> Dict[str, int]:
+    """Import an export into dbfile
+
+    dbfile is created if it doesn't exist. The rows must not already exist in dbfile. Each chunk
+    is written in one transaction so memory usage is bounded by the chunk size.
+
+    :param pi_format: the PI format of dbfile if it's created
+
+    :return: number of imported rows of each table
+    """
+    start_time = time.time()
+    # The options are only needed for constructing a ReplayDB; they don't affect storing
+    db = ReplayDB({'dbfile': dbfile, 'num_ma': 1, 'tick_data_size': 1, 'replaydb_pi_format': pi_format})
+    result = {'pis': 0, 'actions': 0}
+    encoder = PIEncoder(db.pi_format)
+    try:
+        for chunk in load_exported_chunks(in_dir, 'pis'):
+            offsets = chunk['pi_offsets']
+            pi_data = chunk['pi_data']
+            rows = ((ma_id, ts, encoder.encode(ma_id, ts, pi_data[offsets[i]:offsets[i + 1]]))
+                    for i, (ts, ma_id) in enumerate(zip(chunk['ts'].tolist(), chunk['ma_id'].tolist())))
+            with db.conn:
+                db.conn.executemany('INSERT INTO main.pis VALUES (?,?,?)', rows)
+            result['pis'] += len(chunk['ts'])
+        for chunk in load_exported_chunks(in_dir, 'actions'):
+            with db.conn:
+                db.conn.executemany('INSERT INTO main.actions VALUES (?,?)',
+                                    zip(chunk['ts'].tolist(), chunk['action'].tolist()))
+            result['actions'] += len(chunk['ts'])
+    finally:
+        db.close()
+    logger.info('Imported {0} into {1} in {2:.2f} seconds: {3}'.format(in_dir, dbfile, time.time() - start_time,
+                                                                       result))
+    return result
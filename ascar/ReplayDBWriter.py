@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""Background writer thread of ReplayDB"""
+
+import queue
+import threading
+import time
+from typing import *
+from .PipelineStage import StageMetrics
+from .ReplayDB import open_replay_db
+from .ascar_logging import logger
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+_STOP = object()
+# Kinds of queued items
+_PI = 0
+_TICK = 1
+_ACTION = 2
+
+
+class ReplayDBWriter:
+    """Write PIs and actions to a ReplayDB from a dedicated thread
+
+    insert_pi(), insert_tick() and insert_action() only put the rows into a bounded queue, so the caller
+    never waits for a lock or a checkpoint of the DB. When the queue is full the row is
+    dropped and counted. The ReplayDB is opened, flushed, aged out and closed in the writer
+    thread.
+
+    This is the persist stage of the IntfDaemon pipeline.
+
+    Attributes:
+        queue_size: maximum number of rows waiting in the queue
+        metrics: the StageMetrics of the writer, which also count dropped rows and write errors
+        status_interval: how often (in seconds) the status of the ReplayDB is refreshed for
+                         get_status()
+    """
+    queue_size = 10000
+    status_interval = 1
+
+    def __init__(self, opt: dict):
+        self.opt = opt
+        self.queue_size = opt.get('replaydb_writer_queue_size', self.queue_size)
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._thread = None
+        self._status_lock = threading.Lock()
+        self._db_status = {}
+        self.metrics = StageMetrics()
+
+    @property
+    def dropped_rows(self) -> int:
+        return self.metrics.dropped
+
+    @property
+    def written_rows(self) -> int:
+        return self.metrics.processed
+
+    @property
+    def write_errors(self) -> int:
+        return self.metrics.errors
+
+    def start(self):
+        """Open the ReplayDB and start the writer thread
+
+        Returns after the ReplayDB has been opened so errors of opening it are raised here.
+        """
+        assert not self._thread, 'Writer already started.'
+        opened = threading.Event()
+        error = []
+
+        def run():
+            try:
+                db = open_replay_db(self.opt)
+            except Exception as e:
+                error.append(e)
+                opened.set()
+                return
+            opened.set()
+            self._run(db)
+
+        self._thread = threading.Thread(target=run, name='ReplayDBWriter', daemon=True)
+        self._thread.start()
+        opened.wait()
+        if error:
+            self._thread = None
+            raise error[0]
+
+    def stop(self):
+        """Write out all queued rows, close the ReplayDB and wait for the writer thread to end"""
+        if not self._thread:
+            return
+        # Don't drop the stop request when the queue is full
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def _put(self, item, rows: int = 1):
+        try:
+            self._queue.put_nowait((time.time(), item))
+        except queue.Full:
+            self.metrics.dropped += rows
+            logger.warning('ReplayDB write queue is full, dropped {0} rows so far'.format(self.dropped_rows))
+            return
+        self.metrics.max_queue_depth = max(self.metrics.max_queue_depth, self._queue.qsize())
+
+    def insert_pi(self, ma_id: int, ts: int, data):
+        self._put((_PI, ma_id, ts, data))
+
+    def insert_tick(self, tick):
+        """Queue an AssembledTick, which takes one place in the queue however many MAs it has"""
+        self._put((_TICK, tick), int(tick.present.sum()))
+
+    def insert_action(self, ts: int, action: int):
+        assert isinstance(action, int)
+        self._put((_ACTION, ts, action))
+
+    def get_status(self) -> Dict[str, Any]:
+        """Metrics of the write queue and the latest status of the ReplayDB"""
+        with self._status_lock:
+            result = dict(self._db_status)
+        metrics = self.metrics.get_status('write')
+        result.update({
+            'write_queue_depth': self._queue.qsize(),
+            'write_queue_max_depth': self.metrics.max_queue_depth,
+            'dropped_rows': self.dropped_rows,
+            'written_rows': self.written_rows,
+            'write_errors': self.write_errors,
+        })
+        for key in ('write_throughput', 'write_avg_queue_latency', 'write_max_queue_latency',
+                    'write_avg_service_time'):
+            result[key] = metrics[key]
+        return result
+
+    def _refresh_status(self, db):
+        status = db.get_status()
+        with self._status_lock:
+            self._db_status = status
+
+    def _run(self, db):
+        # Wake up often enough to flush buffered rows in time
+        timeout = min(db.write_batch_interval, 1) if db.write_batch_interval > 0 else 1
+        last_status_time = 0
+        stopping = False
+        while not stopping:
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                stopping = True
+            elif item is not None:
+                enqueue_time, item = item
+                start_time = time.time()
+                try:
+                    rows = 1
+                    if item[0] == _PI:
+                        db.insert_pi(*item[1:])
+                    elif item[0] == _TICK:
+                        db.insert_tick(item[1])
+                        rows = int(item[1].present.sum())
+                    else:
+                        db.insert_action(*item[1:])
+                    self.metrics.record((start_time - enqueue_time) * rows, time.time() - start_time, rows)
+                except Exception as e:
+                    # A bad row must not stop the writer
+                    self.metrics.errors += 1
+                    logger.error('Failed to write to ReplayDB: {type}: {msg}'.format(type=type(e).__name__,
+                                                                                     msg=str(e)))
+            try:
+                if stopping:
+                    db.flush()
+                else:
+                    # Write out buffered DB rows that have been waiting for too long
+                    db.flush_if_due()
+                    # Age out old PIs in small steps
+                    db.enforce_retention_if_due()
+            except Exception as e:
+                self.metrics.errors += 1
+                logger.error('Failed to flush ReplayDB: {type}: {msg}'.format(type=type(e).__name__, msg=str(e)))
+            if stopping or time.time() - last_status_time >= self.status_interval:
+                self._refresh_status(db)
+                last_status_time = time.time()
+        try:
+            db.close()
+        except Exception as e:
+            self.metrics.errors += 1
+            logger.error('Failed to close ReplayDB: {type}: {msg}'.format(type=type(e).__name__, msg=str(e)))
+        logger.debug('ReplayDB writer stopped')
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""Assembly of the PIs of all MAs into complete ticks"""
+
+import numpy as np
+import time
+from typing import *
+from .ReplayDB import PI_DTYPE, pi_array
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+
+class AssembledTick(NamedTuple):
+    """The PIs of all MAs at a tick
+
+    Attributes:
+        ts: the tick
+        ma_ids: IDs of the expected MAs in ascending order, followed by other MAs that reported
+        present: whether each MA reported
+        pi_counts: number of PIs of each MA, which is 0 for an MA that didn't report and for MAs
+                   that don't collect PIs
+        pis: PIs of each MA, padded by zeros to the largest pi_count
+    """
+    ts: int
+    ma_ids: np.ndarray
+    present: np.ndarray
+    pi_counts: np.ndarray
+    pis: np.ndarray
+
+    def rows(self) -> Iterator[Tuple[int, np.ndarray]]:
+        """Iterate over (ma_id, PIs) of the MAs that reported"""
+        for i in np.flatnonzero(self.present):
+            yield int(self.ma_ids[i]), self.pis[i, :self.pi_counts[i]]
+
+    def is_complete(self) -> bool:
+        return bool(self.present.all())
+
+
+class TickAssembler:
+    """Buffer the PIs of each tick until all expected MAs have reported
+
+    A tick is emitted to on_tick as an AssembledTick when all expected MAs have reported, or when
+    max_delay seconds have passed since its first PI, in which case it is partial. If the expected
+    MAs are not given, they are not known until they have reported, so every tick is held for
+    max_delay seconds and is partial if an MA that has been seen before hasn't reported. Older ticks
+    are always emitted first, so ticks are emitted in order. PIs of a tick that has already been
+    emitted, and second PIs of an MA for the same tick, are passed to on_late one by one and
+    counted in late_rows.
+
+    add() does constant work per PI. check() has to be called regularly to emit the ticks whose
+    deadline has passed.
+
+    This class is not thread-safe.
+
+    Attributes:
+        max_delay: the longest time in seconds a tick is held back
+        assembled_ticks: number of ticks emitted
+        partial_ticks: number of ticks emitted without the PIs of all expected MAs
+        late_rows: number of PIs passed to on_late
+    """
+    max_delay = 1
+
+    def __init__(self, expected_mas: Iterable[int] = None, max_delay: float = None,
+                 on_tick: Callable[[AssembledTick], None] = None,
+                 on_late: Callable[[int, int, np.ndarray], None] = None):
+        """
+        :param expected_mas: the MAs a tick waits for. If None, all MAs that have reported so far
+                             are expected when the tick is emitted at its deadline.
+        """
+        if max_delay is not None:
+            self.max_delay = max_delay
+        self._on_tick = on_tick
+        self._on_late = on_late
+        self._fixed = expected_mas is not None
+        self._expected = set(expected_mas or ())
+        self._expected_order = sorted(self._expected)
+        # ts -> [deadline, {ma_id: PIs}, number of expected MAs that have reported]
+        self._pending = dict()
+        self._last_emitted_ts = None
+        self.assembled_ticks = 0
+        self.partial_ticks = 0
+        self.late_rows = 0
+
+    def add(self, ma_id: int, ts: int, pis):
+        """Add the PIs of an MA, given as a sequence or a float64 buffer
+
+        The tick is emitted right away if it is complete and the expected MAs are fixed.
+        """
+        if ma_id not in self._expected and not self._fixed:
+            self._expected.add(ma_id)
+            self._expected_order = sorted(self._expected)
+        entry = self._pending.get(ts)
+        if entry is None:
+            if self._last_emitted_ts is not None and ts <= self._last_emitted_ts:
+                self._late(ma_id, ts, pis)
+                return
+            entry = self._pending[ts] = [time.time() + self.max_delay, dict(), 0]
+        elif ma_id in entry[1]:
+            self._late(ma_id, ts, pis)
+            return
+        entry[1][ma_id] = pis
+        if ma_id in self._expected:
+            entry[2] += 1
+            # An MA that hasn't been seen yet may still report this tick
+            if self._fixed and entry[2] >= len(self._expected):
+                self._emit_until(ts)
+
+    def check(self, now: float = None):
+        """Emit the ticks whose deadline has passed"""
+        now = time.time() if now is None else now
+        due = [ts for ts, entry in self._pending.items() if entry[0] <= now]
+        if due:
+            self._emit_until(max(due))
+
+    def next_deadline(self) -> Optional[float]:
+        """When the earliest pending tick is due, or None if there is none"""
+        return min(entry[0] for entry in self._pending.values()) if self._pending else None
+
+    def flush(self):
+        """Emit all pending ticks"""
+        if self._pending:
+            self._emit_until(max(self._pending))
+
+    def get_status(self) -> Dict[str, int]:
+        return {
+            'assembled_ticks': self.assembled_ticks,
+            'partial_ticks': self.partial_ticks,
+            'late_rows': self.late_rows,
+            'pending_ticks': len(self._pending),
+        }
+
+    def _late(self, ma_id: int, ts: int, pis):
+        self.late_rows += 1
+        if self._on_late:
+            self._on_late(ma_id, ts, pi_array(pis))
+
+    def _emit_until(self, ts: int):
+        """Emit the pending ticks up to ts in order"""
+        for tick_ts in sorted(t for t in self._pending if t <= ts):
+            rows = self._pending.pop(tick_ts)[1]
+            tick = self._assemble(tick_ts, rows)
+            self._last_emitted_ts = tick_ts
+            self.assembled_ticks += 1
+            if not tick.is_complete():
+                self.partial_ticks += 1
+            if self._on_tick:
+                self._on_tick(tick)
+
+    def _assemble(self, ts: int, rows: Dict[int, Any]) -> AssembledTick:
+        ma_ids = self._expected_order + sorted(ma_id for ma_id in rows if ma_id not in self._expected)
+        arrays = [pi_array(rows[ma_id]) if ma_id in rows else None for ma_id in ma_ids]
+        pi_counts = np.array([len(a) if a is not None else 0 for a in arrays], dtype=np.int64)
+        pis = np.zeros((len(ma_ids), int(pi_counts.max()) if len(ma_ids) else 0), dtype=PI_DTYPE)
+        for i, a in enumerate(arrays):
+            if a is not None:
+                pis[i, :len(a)] = a
+        return AssembledTick(ts, np.array(ma_ids, dtype=np.int64),
+                             np.array([a is not None for a in arrays], dtype=bool), pi_counts, pis)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+"""ASCAR live tick ring in shared memory"""
+
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+from typing import *
+from .ReplayDB import NotEnoughDataError, PI_DTYPE
+from .ascar_logging import logger
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+TICK_RING_VERSION = 2
+# Fields of the header
+HDR_VERSION = 0
+HDR_CAPACITY = 1        # number of ticks in the ring
+HDR_NUM_SLOTS = 2       # number of client MAs
+HDR_PI_LEN = 3          # number of PIs per client MA per tick
+HDR_HEAD_TS = 4         # newest ts written, -1 if none
+HDR_CLOSED = 5          # set to 1 when the writer goes away
+HDR_NUM_MAS = 6         # number of MAs whose presence is tracked: the client MAs, then the others
+HDR_SIZE = 8
+NO_TS = -1
+# Names of the rings created by this process
+_created_rings = set()
+
+
+class TickRing:
+    """The newest ticks of PIs in a shared memory ring buffer
+
+    IntfDaemon writes every PI vector it receives into the ring as well as the ReplayDB, which
+    stays the durable log. DQLDaemon reads fresh ticks from the ring without a DB round trip.
+    Tick ts is kept in row ts % capacity, which has one PI vector per client MA slot. Whether the
+    other MAs have reported is tracked too, so missing entries are counted the same way as
+    ReplayDB.get_observation() does.
+
+    Each row has a sequence counter that is odd while the row is being written and grows every
+    time the row changes. Readers check the counters before and after reading, so they never use
+    a torn row and can tell when the ring has lapped them.
+
+    Use open_tick_ring() to create or attach a ring.
+    """
+    read_retries = 10
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        self._shm = shm
+        self.owner = owner
+        self._header = np.ndarray((HDR_SIZE,), dtype=np.int64, buffer=shm.buf)
+        if self._header[HDR_VERSION] != TICK_RING_VERSION:
+            raise ValueError('Unknown tick ring version {0}'.format(self._header[HDR_VERSION]))
+        self.capacity = int(self._header[HDR_CAPACITY])
+        self.num_slots = int(self._header[HDR_NUM_SLOTS])
+        self.pi_len = int(self._header[HDR_PI_LEN])
+        self.num_mas = int(self._header[HDR_NUM_MAS])
+        arrays = self._layout(self.capacity, self.num_slots, self.pi_len, self.num_mas)
+        offset = 0
+        views = []
+        for shape, dtype in arrays:
+            views.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset))
+            offset += self._aligned_size(shape, dtype)
+        _, self.ma_ids, self._seq, self._row_ts, self._present, self._pis = views
+        self._slots = {int(ma_id): slot for slot, ma_id in enumerate(self.ma_ids)}
+
+    @staticmethod
+    def _layout(capacity: int, num_slots: int, pi_len: int, num_mas: int) -> List[Tuple[tuple, np.dtype]]:
+        return [((HDR_SIZE,), np.dtype(np.int64)),
+                ((num_mas,), np.dtype(np.int64)),                   # MA ID of each slot, client MAs first
+                ((capacity,), np.dtype(np.int64)),                  # sequence counter of each row
+                ((capacity,), np.dtype(np.int64)),                  # ts of each row
+                ((capacity, num_mas), np.dtype(np.uint8)),          # whether a slot has been written
+                ((capacity, num_slots, pi_len), PI_DTYPE)]
+
+    @staticmethod
+    def _aligned_size(shape: tuple, dtype: np.dtype) -> int:
+        size = int(np.prod(shape)) * dtype.itemsize
+        return (size + 7) // 8 * 8
+
+    @classmethod
+    def create(cls, name: str, capacity: int, ma_ids: List[int], pi_len: int,
+               other_ma_ids: List[int] = ()) -> 'TickRing':
+        """Create a ring, replacing the one left behind by a writer that didn't exit cleanly
+
+        :param ma_ids: IDs of the client MAs, which have PIs
+        :param other_ma_ids: IDs of the other MAs, whose presence is tracked
+        """
+        num_mas = len(ma_ids) + len(other_ma_ids)
+        size = sum(cls._aligned_size(shape, dtype)
+                   for shape, dtype in cls._layout(capacity, len(ma_ids), pi_len, num_mas))
+        try:
+            stale = shared_memory.SharedMemory(name=name)
+            logger.warning('Removing stale tick ring ' + name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        _created_rings.add(name)
+        header = np.ndarray((HDR_SIZE,), dtype=np.int64, buffer=shm.buf)
+        header[:] = 0
+        header[HDR_CAPACITY] = capacity
+        header[HDR_NUM_SLOTS] = len(ma_ids)
+        header[HDR_PI_LEN] = pi_len
+        header[HDR_NUM_MAS] = num_mas
+        header[HDR_HEAD_TS] = NO_TS
+        header[HDR_VERSION] = TICK_RING_VERSION
+        ring = cls(shm, owner=True)
+        ring.ma_ids[:] = sorted(ma_ids) + sorted(other_ma_ids)
+        ring._slots = {int(ma_id): slot for slot, ma_id in enumerate(ring.ma_ids)}
+        ring._seq[:] = 0
+        ring._row_ts[:] = NO_TS
+        ring._present[:] = 0
+        logger.info('Created tick ring {0} of {1} ticks'.format(name, capacity))
+        return ring
+
+    @classmethod
+    def attach(cls, name: str) -> Optional['TickRing']:
+        """Attach to an existing ring
+
+        :return: None if the ring doesn't exist
+        """
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            return None
+        if name not in _created_rings:
+            # Only the writer should remove the ring. Python < 3.13 would remove it when the reader exits.
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return cls(shm, owner=False)
+
+    @property
+    def head_ts(self) -> int:
+        """The newest ts in the ring, -1 if the ring is empty"""
+        return int(self._header[HDR_HEAD_TS])
+
+    @property
+    def closed(self) -> bool:
+        """Whether the writer has closed the ring, after which it's never updated again"""
+        return bool(self._header[HDR_CLOSED])
+
+    def close(self):
+        if self.owner:
+            self._header[HDR_CLOSED] = 1
+        # Drop the views before closing the buffer
+        self._header = self.ma_ids = self._seq = self._row_ts = self._present = self._pis = None
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+            _created_rings.discard(self._shm.name)
+
+    def _is_present(self, slot: int, ts: int) -> bool:
+        row = ts % self.capacity
+        return self._row_ts[row] == ts and bool(self._present[row, slot])
+
+    def put_tick(self, tick) -> int:
+        """Write the PIs of the MAs that are present in an AssembledTick
+
+        :return: number of PI vectors written
+        """
+        return sum(self.put(ma_id, tick.ts, pis) for ma_id, pis in tick.rows())
+
+    def put(self, ma_id: int, ts: int, data) -> bool:
+        """Write the PIs of an MA at ts
+
+        The same missing entry repair as ReplayDB is done so the ring agrees with the DB. Only
+        the presence of a non client MA is kept. Unknown MAs and ticks that are too old for the
+        ring are ignored.
+
+        :return: whether data has been written
+        """
+        slot = self._slots.get(ma_id)
+        if slot is None or (slot < self.num_slots and len(data) != self.pi_len):
+            return False
+        # If there's a missing entry before ts, store ts as ts-1
+        if self._is_present(slot, ts - 2) and not self._is_present(slot, ts - 1):
+            ts -= 1
+        head_ts = self.head_ts
+        if head_ts != NO_TS and ts <= head_ts - self.capacity:
+            return False
+        row = ts % self.capacity
+        self._seq[row] += 1
+        if self._row_ts[row] != ts:
+            # The row is taken over by a new tick
+            self._present[row] = 0
+            self._row_ts[row] = ts
+        if slot < self.num_slots:
+            self._pis[row, slot] = data
+        self._present[row, slot] = 1
+        self._seq[row] += 1
+        if ts > head_ts:
+            self._header[HDR_HEAD_TS] = ts
+        return True
+
+    def view(self, ts: int) -> Tuple[np.ndarray, np.ndarray, int]:
+        """Zero-copy read-only views of a tick
+
+        The views change when the row is overwritten. Use is_unchanged() after using them.
+
+        :return: PIs of shape (num_slots, pi_len), presence of each client MA slot, sequence counter of
+                 the row
+        """
+        row = ts % self.capacity
+        seq = int(self._seq[row])
+        if seq % 2 == 1 or self._row_ts[row] != ts:
+            raise NotEnoughDataError('Tick {0} is not in the tick ring'.format(ts))
+        pis = self._pis[row]
+        present = self._present[row, :self.num_slots]
+        pis.flags.writeable = False
+        present.flags.writeable = False
+        return pis, present, seq
+
+    def is_unchanged(self, ts: int, seq: int) -> bool:
+        """Whether the row of ts is still the one returned by view() with seq"""
+        row = ts % self.capacity
+        return self._seq[row] == seq and self._row_ts[row] == ts
+
+    def read_ticks(self, start_ts: int, end_ts: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Copy the ticks from start_ts to end_ts (inclusive) out of the ring
+
+        NotEnoughDataError is raised if any of the ticks has been lapped or is not written yet.
+
+        :return: PIs of shape (n, num_slots, pi_len), presence of shape (n, num_mas)
+        """
+        tss = np.arange(start_ts, end_ts + 1)
+        rows = tss % self.capacity
+        for _ in range(self.read_retries):
+            seq = self._seq[rows].copy()
+            if np.any(seq % 2 == 1):
+                continue
+            if np.any(self._row_ts[rows] != tss):
+                raise NotEnoughDataError('Ticks {0}-{1} are not in the tick ring'.format(start_ts, end_ts))
+            pis = self._pis[rows]
+            present = self._present[rows].astype(bool)
+            if np.array_equal(seq, self._seq[rows]):
+                return pis, present
+        raise NotEnoughDataError('Ticks {0}-{1} kept changing while being read'.format(start_ts, end_ts))
+
+    def get_observation(self, ts: int, ticks_per_observation: int, missing_entry_tolerance: int) -> np.ndarray:
+        """The observation at ts in the same layout as ReplayDB.get_observation()
+
+        Like ReplayDB, missing entries of all MAs, not only the client MAs, count against
+        missing_entry_tolerance.
+        """
+        pis, present = self.read_ticks(ts - ticks_per_observation + 1, ts)
+        if np.count_nonzero(~present) > missing_entry_tolerance:
+            raise NotEnoughDataError('Too many missing entries')
+        pis[~present[:, :self.num_slots]] = 0
+        return pis.transpose((1, 0, 2)).reshape((-1,))
+
+    def get_last_observation(self, ticks_per_observation: int, missing_entry_tolerance: int,
+                             tries: int = 3) -> np.ndarray:
+        """The newest valid observation among the last tries ticks"""
+        head_ts = self.head_ts
+        if head_ts == NO_TS:
+            raise NotEnoughDataError('The tick ring is empty')
+        for ts in range(head_ts, head_ts - tries, -1):
+            try:
+                return self.get_observation(ts, ticks_per_observation, missing_entry_tolerance)
+            except NotEnoughDataError:
+                pass
+        raise NotEnoughDataError('No valid observation in the tick ring')
+
+
+def open_tick_ring(opt: dict, create: bool = False) -> Optional[TickRing]:
+    """Create or attach the tick ring named by opt['tick_ring_name']
+
+    :param create: create the ring for writing; otherwise attach to an existing one
+    :return: None if the ring is disabled, can't be created because the client MAs are unknown,
+             or doesn't exist when attaching
+    """
+    name = opt.get('tick_ring_name')
+    if not name:
+        return None
+    if not create:
+        return TickRing.attach(name)
+    if 'nodeid_map' not in opt:
+        logger.warning('Tick ring disabled because nodeid_map is missing')
+        return None
+    if 'clients' in opt:
+        ma_ids = [opt['nodeid_map'][host] for host in opt['clients']]
+    else:
+        ma_ids = list(opt['nodeid_map'].values())
+    other_ma_ids = [ma_id for ma_id in opt['nodeid_map'].values() if ma_id not in ma_ids]
+    return TickRing.create(name, opt.get('tick_ring_ticks', 600), ma_ids, opt['tick_data_size'] // len(ma_ids),
+                           other_ma_ids)
@@ -1,6 +1,7 @@
 from .ascar_logging import *
 from .LustreGame import Lustre
 from .ReplayDB import *
+from .ReplayDBExport import export_replay_db, import_replay_db, load_exported_chunks
 
 __author__ = 'Yan Li'
 __copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
@@ -34,6 +34,7 @@ OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 from ascar import common
 from ascar import LustreCommon
+from ascar.ReplayDB import PI_FORMAT_LATEST
 import glob
 import logging
 import os
@@ -216,6 +217,57 @@ opt = {
     'ma_debugging_level': 0,
     'dqldaemon_debugging_level': 0,
     'dbfile': '/data/ascar/ascar_replay_db.sqlite',
+    # 'sqlite' or 'memmap'. The memmap backend stores ticks in memory-mapped files next to dbfile.
+    'replaydb_backend': 'sqlite',
+    # IntfDaemon writes PIs to the DB in batches of up to write_batch_size rows, and
+    # no row waits longer than write_batch_interval seconds
+    'write_batch_size': 100,
+    'write_batch_interval': 0.5,
+    # PIs older than retention_ticks are averaged into buckets of retention_downsample_ticks
+    # and moved to the pis_archive table, retention_step_ticks (but no more than about
+    # retention_step_rows rows) at a time every retention_interval seconds. 0 keeps all raw PIs.
+    'retention_ticks': 0,
+    'retention_downsample_ticks': 60,
+    'retention_step_ticks': 600,
+    'retention_step_rows': 50000,
+    'retention_interval': 10,
+    # If larger than 0, the SQLite ReplayDB starts a new partition file every partition_ticks
+    # ticks (e.g. 86400 for one per day). Older partitions are read-only. Only the newest 10 old
+    # partitions can be attached by SQLite; the data in partitions older than them are not
+    # visible to readers, so archive or remove old partition files, or use larger partitions.
+    'partition_ticks': 0,
+    # PRAGMA mmap_size (bytes) and cache_size (KiB) of ReplayDB connections. The game opens
+    # its connections read-only, one per thread, and waits up to replaydb_open_timeout
+    # seconds for IntfDaemon to create the DB.
+    'replaydb_open_timeout': 60,
+    'replaydb_mmap_size': 256 * 1024 * 1024,
+    'replaydb_cache_size': 64 * 1024,
+    # Maximum number of rows read at a time when the game loads new ticks into its memory cache
+    'replaydb_tail_rows': 10000,
+    # IntfDaemon writes to the ReplayDB from a background thread. Rows are dropped when more than
+    # replaydb_writer_queue_size of them are waiting. PRAGMA synchronous of the writer.
+    'replaydb_writer_queue_size': 10000,
+    # Messages pass through the decode and broadcast stages of IntfDaemon, each in its own thread.
+    # A stage drops messages when more than intf_daemon_queue_size items are waiting. The receive
+    # thread passes up to intf_daemon_recv_batch messages at a time to the decode stage as one item.
+    'intf_daemon_queue_size': 10000,
+    'intf_daemon_recv_batch': 1000,
+    # IntfDaemon reports an MA as unresponsive after this many seconds without a message from it
+    'ma_timeout': 20,
+    # IntfDaemon waits up to tick_max_delay seconds for all MAs of nodeid_map to report a tick
+    # before it stores the tick without the missing ones. PIs that come later are stored as well.
+    'tick_max_delay': 1,
+    # Wait for IntfDaemon to acknowledge each action, which reports the broadcast time but
+    # blocks the game for a round trip.
+    'action_ack': False,
+    'replaydb_synchronous': 'NORMAL',
+    # PI format of new SQLite ReplayDBs. PI_FORMAT_DELTA stores deltas between the ticks of each
+    # MA and is about 3x smaller for long runs, but decodes slower.
+    'replaydb_pi_format': PI_FORMAT_LATEST,
+    # IntfDaemon also publishes the newest tick_ring_ticks ticks in a shared memory ring of this
+    # name, from which DQLDaemon reads fresh observations. An empty name disables the ring.
+    'tick_ring_name': 'ascar_tick_ring',
+    'tick_ring_ticks': 600,
     'tick_len': TICK_LEN,                   # duration of a tick in second
     'ticks_per_observation': 10,            # how many ticks are in an observation
     'nodeid_map': nodeid_map,
@@ -232,6 +284,19 @@ opt = {
     'collectors': [lustre_collect_pi],
     'controller': lustre_controller,
     'intf_daemon_loc': '128.114.59.20:9123',
+    # IntfDaemon publishes heartbeats and actions on this port, which defaults to the port of
+    # intf_daemon_loc plus one
+    # 'intf_daemon_pub_port': 9124,
+    # On large clusters an Aggregator (./aggregator_service.sh) per rack collects the PIs of the
+    # MAs of the rack and sends them to IntfDaemon in one message per tick. The MAs of a rack use
+    # the aggregator_loc of their rack as their intf_daemon_loc. The aggregator waits for
+    # aggregator_mas, or all MAs it has seen if it isn't set, up to aggregator_max_delay seconds.
+    # It publishes on the port its MAs derive from aggregator_loc the same way as above, unless
+    # aggregator_pub_port is set, in which case the MAs must set it as their intf_daemon_pub_port.
+    # 'aggregator_loc': '128.114.59.21:9133',
+    # 'aggregator_mas': [1, 2, 3, 4],
+    # 'aggregator_max_delay': 0.5,
+    'ascar.Aggregator.Aggregator_logfile': '/data/ascar/aggregator_log.txt',
     'ascar.MonitorAgent.MonitorAgent_logfile': '/root/log/ma_log.txt',
     'ascar.IntfDaemon.IntfDaemon_logfile': '/data/ascar/intfdaemon_log.txt',
     'ascar.DQLDaemon.DQLDaemon_logfile': '/data/ascar/dqldaemon_log.txt',
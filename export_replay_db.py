@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""Export a replay DB to chunked columnar .npy files
+
+Copyright (c) 2016, 2017 The Regents of the University of California. All
+rights reserved.
+
+Created by Yan Li <yanli@tuneup.ai>, Kenneth Chang <kchang44@ucsc.edu>,
+Oceane Bel <obel@ucsc.edu>. Storage Systems Research Center, Baskin School
+of Engineering.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of the Storage Systems Research Center, the
+      University of California, nor the names of its contributors
+      may be used to endorse or promote products derived from this
+      software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+REGENTS OF THE UNIVERSITY OF CALIFORNIA BE LIABLE FOR ANY DIRECT,
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import logging
+import sys
+from ascar import ascar_logging
+from ascar.ReplayDBExport import export_replay_db
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+if len(sys.argv) not in (3, 4):
+    print("""Usage: {bin} replay_db out_dir [chunk_rows]
+Export replay_db to out_dir. Each table is written as chunks of at most chunk_rows
+(default 100000) rows, one .npy file per column, which can be loaded with
+ascar.ReplayDBExport.load_exported_chunks() or np.load(mmap_mode='r').""".format(bin=sys.argv[0]))
+    exit(2)
+
+ascar_logging.set_log_level(logging.INFO)
+export_replay_db(sys.argv[1], sys.argv[2], *[int(x) for x in sys.argv[3:]])
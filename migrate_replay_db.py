@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""Convert the PIs of a replay DB to the latest format in place
+
+Copyright (c) 2016, 2017 The Regents of the University of California. All
+rights reserved.
+
+Created by Yan Li <yanli@tuneup.ai>, Kenneth Chang <kchang44@ucsc.edu>,
+Oceane Bel <obel@ucsc.edu>. Storage Systems Research Center, Baskin School
+of Engineering.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of the Storage Systems Research Center, the
+      University of California, nor the names of its contributors
+      may be used to endorse or promote products derived from this
+      software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+REGENTS OF THE UNIVERSITY OF CALIFORNIA BE LIABLE FOR ANY DIRECT,
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import logging
+import sys
+from ascar import ascar_logging
+from ascar.ReplayDB import migrate_pi_format, PI_FORMAT_DELTA, PI_FORMAT_LATEST
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+pi_format = PI_FORMAT_LATEST
+db_names = sys.argv[1:]
+if db_names and db_names[0] == '--delta':
+    pi_format = PI_FORMAT_DELTA
+    db_names = db_names[1:]
+if not db_names:
+    print("""Usage: {bin} [--delta] replay_db...
+Convert the PIs in each replay_db to the latest format in place, or to the delta-encoded
+compressed format if --delta is given. Stop all daemons that are using the DB before
+running this.""".format(bin=sys.argv[0]))
+    exit(2)
+
+ascar_logging.set_log_level(logging.INFO)
+for db_name in db_names:
+    migrate_pi_format(db_name, pi_format)
@@ -39,7 +39,8 @@ import sys
 import numpy as np
 import matplotlib
 import sqlite3
-import pickle
+import urllib.parse
+from ascar.ReplayDB import PIDecoder, get_pi_format, PI_DELTA_KEYFRAME_TICKS, PI_FORMAT_DELTA
 
 # This line has to be here before we do the following
 matplotlib.use('PDF')
@@ -53,8 +54,13 @@ pi_per_client_obd = 11
 number_of_point_plot = 70
 
 
+def connect_db(db_name: str) -> sqlite3.Connection:
+    """Open the DB read-only so plotting never blocks the IntfDaemon"""
+    return sqlite3.connect('file:{0}?mode=ro'.format(urllib.parse.quote(db_name)), uri=True)
+
+
 def find_gap(db_name: str):
-    c = sqlite3.connect(db_name).cursor()
+    c = connect_db(db_name).cursor()
     c.execute('SELECT ts from pis ORDER BY ts DESC')
 
     last_ts = None
@@ -80,9 +86,15 @@ def find_gap(db_name: str):
 
 
 def read_db_data(db_name, start_ts=0):
-    conn = sqlite3.connect(db_name)
-    data = conn.cursor().execute('SELECT ma_id, ts, pi_data FROM pis WHERE ts >= ? ORDER BY ts, ma_id',
-                                 (start_ts,)).fetchall()
+    conn = connect_db(db_name)
+    pi_format = get_pi_format(conn)
+    # Deltas need the ticks back to the last keyframe
+    query_start = start_ts - start_ts % PI_DELTA_KEYFRAME_TICKS if pi_format == PI_FORMAT_DELTA else start_ts
+    decoder = PIDecoder(pi_format)
+    data = [(ma_id, ts, decoder.decode(ma_id, ts, blob)) for ma_id, ts, blob in
+            conn.cursor().execute('SELECT ma_id, ts, pi_data FROM pis WHERE ts >= ? ORDER BY ts, ma_id',
+                                  (query_start,))]
+    data = [row for row in data if row[1] >= start_ts and row[2] is not None]
 
     if debug >= 2:
         print('Total row: {0}'.format(len(data)))
@@ -94,7 +106,7 @@ def read_db_data(db_name, start_ts=0):
     for row in data:
         ma_id = row[0]
         ts = row[1]
-        pis = pickle.loads(row[2])
+        pis = row[2]
         try:
             if ts != prev_ts:
                 if mrif is not None and tau is not None:
@@ -4,7 +4,15 @@ cd `dirname $0`
 
 python -m unittest tests.test_common.TestCommon
 python -m unittest tests.test_intf_daemon.TestIntfDaemon
+python -m unittest tests.test_Aggregator.TestAggregator
+python -m unittest tests.test_PipelineStage.TestPipelineStage
+python -m unittest tests.test_HealthTracker.TestHealthTracker
+python -m unittest tests.test_TickAssembler.TestTickAssembler
 python -m unittest tests.test_ReplayDB.TestReplayDB
+python -m unittest tests.test_MemmapReplayDB.TestMemmapReplayDB
+python -m unittest tests.test_ReplayDBExport.TestReplayDBExport
+python -m unittest tests.test_ReplayDBWriter.TestReplayDBWriter
+python -m unittest tests.test_TickRing.TestTickRing
 python -m unittest tests.test_dql_daemon.TestDQLDaemon
 python -m unittest tests.test_lustre.TestLustre
 tests/test_ma_service.sh
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+"""ASCAR ReplayDB Benchmark
+
+Copyright (c) 2016, 2017 The Regents of the University of California. All
+rights reserved.
+
+Created by Yan Li <yanli@tuneup.ai>, Kenneth Chang <kchang44@ucsc.edu>,
+Oceane Bel <obel@ucsc.edu>. Storage Systems Research Center, Baskin School
+of Engineering.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of the Storage Systems Research Center, the
+      University of California, nor the names of its contributors
+      may be used to endorse or promote products derived from this
+      software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+REGENTS OF THE UNIVERSITY OF CALIFORNIA BE LIABLE FOR ANY DIRECT,
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import glob
+import json
+import numpy as np
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from typing import *
+from ascar.ReplayDB import *
+from ascar.ReplayDBExport import export_replay_db, import_replay_db
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+homedir = os.path.dirname(os.path.abspath(__file__))
+long_run_db = os.path.join(homedir, '../datasets/long_run_test/ascar_replay_db.sqlite')
+test_db_file = '/tmp/ascar-benchmark-replaydb.sqlite'
+export_dir = '/tmp/ascar-benchmark-replaydb-export'
+
+
+def benchmark_decode(dbfile: str, repeat: int = 5) -> Tuple[float, int]:
+    """Read and decode all PIs in dbfile into ndarrays
+
+    :return: decoded rows per second, total size of pi_data in bytes
+    """
+    conn = sqlite3.connect(dbfile)
+    pi_format = get_pi_format(conn)
+    data = conn.execute('SELECT ma_id, ts, pi_data FROM pis ORDER BY ma_id, ts').fetchall()
+    conn.close()
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        decode_pi_rows(data, pi_format)
+    return len(data) * repeat / (time.perf_counter() - start_time), sum(len(row[2]) for row in data)
+
+
+def db_files(dbfile: str) -> List[str]:
+    """All files of a DB, including the WAL, partitions and the files of the memmap backend"""
+    return [f for f in glob.glob(glob.escape(dbfile) + '*') if os.path.isfile(f)]
+
+
+def create_synthetic_db(dbfile: str, num_ma: int, num_ticks: int, pi_per_ma: int = 24,
+                        ticks_per_observation: int = 4, backend: str = 'sqlite') -> ReplayDBBackend:
+    """Create a DB filled with random PIs from num_ma client MAs"""
+    for f in db_files(dbfile):
+        os.remove(f)
+    opt = {
+        'dbfile': dbfile,
+        'nodeid_map': {'host{0}'.format(i): i for i in range(1, num_ma + 1)},
+        'tick_data_size': num_ma * pi_per_ma,
+        'ticks_per_observation': ticks_per_observation,
+        'write_batch_size': 10000,
+        'replaydb_backend': backend,
+    }
+    db = open_replay_db(opt)
+    rand = np.random.RandomState(0)
+    for ts in range(1, num_ticks + 1):
+        for ma_id in range(1, num_ma + 1):
+            db.insert_pi(ma_id, ts, rand.random_sample(pi_per_ma))
+    db.flush()
+    return db
+
+
+def get_observation_row_by_row(db: ReplayDB, ts: int) -> np.ndarray:
+    """The old implementation of get_observation(), which handles one row at a time in Python"""
+    c = db.conn.cursor()
+    result = np.zeros((len(db.ordered_client_list), db.ticks_per_observation, db.pi_per_ma), dtype=float)
+    c.execute('SELECT ma_id, ts, pi_data from pis WHERE ts <= ? AND ts > ? ORDER BY ma_id ASC, ts ASC',
+              (ts, ts - db.ticks_per_observation))
+    for row in c.fetchall():
+        ma_id_idx = db.ordered_client_list.index(row[0])
+        ts_idx = row[1] - (ts - db.ticks_per_observation) - 1
+        result[ma_id_idx, ts_idx] = decode_pi(row[2], db.pi_format)
+    return result.reshape((db.observation_size,))
+
+
+def time_it(func, repeat: int) -> float:
+    """:return: average seconds per call"""
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start_time) / repeat
+
+
+def benchmark_get_observation(num_ma_list=(5, 50, 200, 1000), num_ticks: int = 20):
+    print('{0:>6} {1:>16} {2:>16} {3:>8}'.format('MAs', 'row-by-row (ms)', 'vectorized (ms)', 'speedup'))
+    for num_ma in num_ma_list:
+        db = create_synthetic_db(test_db_file, num_ma, num_ticks)
+        ts = num_ticks
+        assert np.array_equal(get_observation_row_by_row(db, ts), db.get_observation(ts))
+        repeat = max(3, 2000 // num_ma)
+        old_time = time_it(lambda: get_observation_row_by_row(db, ts), repeat)
+        new_time = time_it(lambda: db.get_observation(ts), repeat)
+        print('{0:>6} {1:>16.3f} {2:>16.3f} {3:>7.1f}x'.format(num_ma, old_time * 1000, new_time * 1000,
+                                                               old_time / new_time))
+        db.close()
+
+
+def benchmark_pi_format():
+    shutil.copy(long_run_db, test_db_file)
+    pickle_speed, pickle_size = benchmark_decode(test_db_file)
+    migrate_pi_format(test_db_file)
+    f64_speed, f64_size = benchmark_decode(test_db_file)
+    migrate_pi_format(test_db_file, PI_FORMAT_DELTA)
+    delta_speed, delta_size = benchmark_decode(test_db_file)
+    print('Decoding {db}'.format(db=long_run_db))
+    print('PI_FORMAT_PICKLE: {0:,.0f} rows/s, {1:,} bytes'.format(pickle_speed, pickle_size))
+    print('PI_FORMAT_F64LE:  {0:,.0f} rows/s ({1:.1f}x), {2:,} bytes'.format(f64_speed, f64_speed / pickle_speed,
+                                                                             f64_size))
+    print('PI_FORMAT_DELTA:  {0:,.0f} rows/s ({1:.1f}x), {2:,} bytes ({3:.0%} of F64LE)'.format(
+        delta_speed, delta_speed / pickle_speed, delta_size, delta_size / f64_size))
+
+
+def benchmark_insert_pi(num_ma: int = 50, num_ticks: int = 2000):
+    start_time = time.perf_counter()
+    create_synthetic_db(test_db_file, num_ma, num_ticks).close()
+    print('insert_pi: {0:,.0f} rows/s'.format(num_ma * num_ticks / (time.perf_counter() - start_time)))
+
+
+def select_row_by_row(dbfile: str) -> int:
+    """The old way of dumping a DB: SELECT and decode everything in one go"""
+    conn = sqlite3.connect(dbfile)
+    pi_format = get_pi_format(conn)
+    rows = [(ma_id, ts, decode_pi(blob, pi_format))
+            for ma_id, ts, blob in conn.execute('SELECT ma_id, ts, pi_data FROM pis ORDER BY ts, ma_id')]
+    conn.close()
+    return len(rows)
+
+
+def benchmark_export(num_ma: int = 50, num_ticks: int = 2000):
+    create_synthetic_db(test_db_file, num_ma, num_ticks).close()
+    rows = num_ma * num_ticks
+    shutil.rmtree(export_dir, ignore_errors=True)
+    select_time = time_it(lambda: select_row_by_row(test_db_file), 1)
+    export_time = time_it(lambda: export_replay_db(test_db_file, export_dir), 1)
+    import_file = test_db_file + '.import'
+    for f in (import_file, import_file + '-wal', import_file + '-shm'):
+        if os.path.exists(f):
+            os.remove(f)
+    import_time = time_it(lambda: import_replay_db(export_dir, import_file), 1)
+    print('Exporting/importing {0:,} rows from {1} MAs'.format(rows, num_ma))
+    print('SELECT all:  {0:,.0f} rows/s'.format(rows / select_time))
+    print('Export:      {0:,.0f} rows/s'.format(rows / export_time))
+    print('Import:      {0:,.0f} rows/s'.format(rows / import_time))
+
+
+def latency_ms(func, samples: int) -> np.ndarray:
+    """Call func samples times
+
+    :return: the latency of each call in milliseconds
+    """
+    result = np.zeros((samples,))
+    for i in range(samples):
+        start_time = time.perf_counter()
+        func(i)
+        result[i] = (time.perf_counter() - start_time) * 1000
+    return result
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=homedir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_scale(num_ma: int, num_ticks: int, backend: str = 'sqlite', pi_per_ma: int = 24,
+                    samples: int = 1000) -> Dict[str, Any]:
+    """Measure one synthetic DB of num_ma MAs and num_ticks ticks"""
+    start_time = time.perf_counter()
+    db = create_synthetic_db(test_db_file, num_ma, num_ticks, pi_per_ma, backend=backend)
+    insert_time = time.perf_counter() - start_time
+    rand = np.random.RandomState(0)
+    obs_ts = rand.randint(db.ticks_per_observation, num_ticks + 1, size=samples)
+    obs_latency = latency_ms(lambda i: db.get_observation(int(obs_ts[i])), samples)
+    last_ts_latency = latency_ms(lambda i: db.get_last_ts(), samples)
+    db.close()
+    return {
+        'backend': backend,
+        'num_ma': num_ma,
+        'num_ticks': num_ticks,
+        'pi_per_ma': pi_per_ma,
+        'insert_rows_per_s': num_ma * num_ticks / insert_time,
+        'get_observation_p50_ms': float(np.percentile(obs_latency, 50)),
+        'get_observation_p99_ms': float(np.percentile(obs_latency, 99)),
+        'get_last_ts_p50_ms': float(np.percentile(last_ts_latency, 50)),
+        'get_last_ts_p99_ms': float(np.percentile(last_ts_latency, 99)),
+        'db_size_bytes': sum(os.path.getsize(f) for f in db_files(test_db_file)),
+    }
+
+
+def benchmark_scalability(output: str, num_ma_list=(10, 100, 500, 2000), num_ticks_list=(1000, 10000),
+                          backend: str = 'sqlite') -> List[Dict[str, Any]]:
+    """Run benchmark_scale() on every combination of num_ma_list and num_ticks_list
+
+    The results are written to output as JSON together with the current git commit, so that
+    the results of two commits can be compared with compare_results().
+    """
+    results = []
+    print('{0:>6} {1:>9} {2:>12} {3:>10} {4:>10} {5:>12} {6:>10}'.format(
+        'MAs', 'ticks', 'insert/s', 'obs p50', 'obs p99', 'last_ts p50', 'size (MB)'))
+    for num_ma in num_ma_list:
+        for num_ticks in num_ticks_list:
+            r = benchmark_scale(num_ma, num_ticks, backend)
+            results.append(r)
+            print('{0:>6} {1:>9} {2:>12,.0f} {3:>8.3f}ms {4:>8.3f}ms {5:>10.3f}ms {6:>10.1f}'.format(
+                num_ma, num_ticks, r['insert_rows_per_s'], r['get_observation_p50_ms'],
+                r['get_observation_p99_ms'], r['get_last_ts_p50_ms'], r['db_size_bytes'] / 1024 / 1024))
+    with open(output, 'w') as f:
+        json.dump({'commit': git_commit(), 'time': time.time(), 'results': results}, f, indent=2)
+    return results
+
+
+def compare_results(old_file: str, new_file: str):
+    """Print the ratio new/old of every metric of the runs that appear in both result files"""
+    def load(filename):
+        with open(filename) as f:
+            data = json.load(f)
+        return data, {(r['backend'], r['num_ma'], r['num_ticks']): r for r in data['results']}
+    old, old_results = load(old_file)
+    new, new_results = load(new_file)
+    print('new/old ratios, {0} vs. {1}'.format(new['commit'], old['commit']))
+    for key in sorted(old_results.keys() & new_results.keys()):
+        ratios = ['{0}: {1:.2f}'.format(metric, new_results[key][metric] / old_results[key][metric])
+                  for metric in sorted(old_results[key])
+                  if metric.endswith(('_ms', '_per_s', '_bytes')) and old_results[key][metric]]
+        print('{0} {1} MAs {2} ticks: {3}'.format(*key, ', '.join(ratios)))
+
+
+def _int_list(arg: str) -> List[int]:
+    return [int(x) for x in arg.split(',')]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        benchmark_pi_format()
+        benchmark_get_observation()
+        benchmark_insert_pi()
+        benchmark_export()
+    elif sys.argv[1] == 'scalability' and 3 <= len(sys.argv) <= 6:
+        benchmark_scalability(sys.argv[2], *[_int_list(x) for x in sys.argv[3:5]], *sys.argv[5:])
+    elif sys.argv[1] == 'compare' and len(sys.argv) == 4:
+        compare_results(sys.argv[2], sys.argv[3])
+    else:
+        print("""Usage: python -m tests.benchmark_replaydb
+       python -m tests.benchmark_replaydb scalability output.json [num_ma,...] [num_ticks,...] [backend]
+       python -m tests.benchmark_replaydb compare old.json new.json
+Without arguments, run the micro benchmarks. scalability measures insert rows/s, get_observation
+and get_last_ts latencies and the DB size of synthetic DBs of every combination of num_ma
+(default 10,100,500,2000) and num_ticks (default 1000,10000). backend is sqlite (default) or
+memmap. compare prints the new/old ratios of two scalability results.""")
+        exit(2)
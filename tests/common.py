@@ -35,7 +35,7 @@ OF THE POSSIBILITY OF SUCH DAMAGE.
 import csv
 import os
 import time
-from ascar import ReplayDB
+from ascar import ReplayDBBackend, open_replay_db
 
 __author__ = 'Yan Li'
 __copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
@@ -56,20 +56,27 @@ first_ts = None
 last_ts = None
 
 
-def populate_testdb(test_db_file: str) -> ReplayDB:
+def populate_testdb(test_db_file: str, backend: str = 'sqlite', cur_ts: int = None) -> ReplayDBBackend:
+    """Create a test DB whose data end one tick before cur_ts
+
+    :param cur_ts: defaults to now. Pass the same value to fill several DBs with the same ts.
+    """
     global first_ts, last_ts
     dbopt['dbfile'] = test_db_file
-    try:
-        os.remove(test_db_file)
-    except FileNotFoundError:
-        pass
-    db = ReplayDB(dbopt)
+    dbopt['replaydb_backend'] = backend
+    for f in [test_db_file] + [test_db_file + ext for ext in ('.idx', '.pis', '.present', '.actions')]:
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
+    db = open_replay_db(dbopt)
 
     homedir = os.path.dirname(os.path.abspath(__file__))
     dsdir = os.path.join(homedir, '../datasets/iorcp_2013-11-30_N5-b4g_a0.999_b100tau_472/'
                                   'iorcp_2013-11-28_07-11-54_MPIIO_w_N5_d0_i1_s1_F_b4g_t256m_s1_stat_log/')
     # map hostname to ma_id
-    cur_ts = int(time.time())
+    if cur_ts is None:
+        cur_ts = int(time.time())
     last_ts = cur_ts - 1
     first_ts = last_ts - num_ticks + 1
     for host in testdb_nodeid_map.keys():
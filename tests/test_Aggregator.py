@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+"""Test cases for the Aggregator
+
+Copyright (c) 2016, 2017 The Regents of the University of California. All
+rights reserved.
+
+Created by Yan Li <yanli@tuneup.ai>, Kenneth Chang <kchang44@ucsc.edu>,
+Oceane Bel <obel@ucsc.edu>. Storage Systems Research Center, Baskin School
+of Engineering.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of the Storage Systems Research Center, the
+      University of California, nor the names of its contributors
+      may be used to endorse or promote products derived from this
+      software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+REGENTS OF THE UNIVERSITY OF CALIFORNIA BE LIABLE FOR ANY DIRECT,
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Callable
+import unittest
+from ascar import ascar_logging
+from ascar.ActionClient import ActionClient
+from ascar.Aggregator import Aggregator
+from ascar.IntfDaemon import IntfDaemon
+from ascar.MonitorAgent import MonitorAgent
+from ascar import LustreCommon
+from ascar import ReplayDB
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+ascar_logging.set_log_level(logging.WARNING)
+
+
+class TestAggregator(unittest.TestCase):
+    # IntfDaemon listens on port and each aggregator on port + 10 * i, with their PUB sockets on the next port
+    port = 9223
+    test_db_file = '/tmp/ascar-drl-testdb-aggregator'
+
+    def wait_for(self, condition: Callable[[], bool], timeout: float = 5):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+
+    def test_aggregators(self):
+        self.check_aggregators(self.port)
+
+    def test_pub_port(self):
+        # A config shared by IntfDaemon, an aggregator and its MAs
+        opt = {
+            'intf_daemon_loc': '127.0.0.1:{port}'.format(port=self.port),
+            'intf_daemon_pub_port': self.port + 5,
+            'aggregator_loc': '127.0.0.1:{port}'.format(port=self.port + 10),
+        }
+        ma = MonitorAgent(dict(opt, ma_id=1, intf_daemon_loc=opt['aggregator_loc']))
+        self.assertEqual('tcp://127.0.0.1:{port}'.format(port=Aggregator(opt).pub_port), ma.pub_loc)
+        # IntfDaemon, the aggregators and the MAs on one host need their own non-default pub ports
+        self.check_aggregators(self.port + 100, pub_port_offset=5)
+
+    def check_aggregators(self, port: int, pub_port_offset: int = None):
+        """Run IntfDaemon on port with two aggregators of two MAs each
+
+        :param pub_port_offset: if set, each daemon publishes on its port plus pub_port_offset
+                                instead of the default pub port
+        """
+        def pub_port(daemon_port: int) -> dict:
+            return {} if pub_port_offset is None else {'intf_daemon_pub_port': daemon_port + pub_port_offset}
+
+        opt = {
+            'intf_daemon_loc': '127.0.0.1:{port}'.format(port=port),
+            'dbfile': self.test_db_file,
+            'tick_data_size': 2 * 4,
+            'num_ma': 4,
+            'nodeid_map': {'a1': 1, 'a2': 2, 'b1': 3, 'b2': 4},
+        }
+        try:
+            os.remove(opt['dbfile'])
+        except FileNotFoundError:
+            pass
+        opt.update(pub_port(port))
+        intf_daemon = IntfDaemon(opt, store_action=False)
+        threads = [threading.Thread(target=intf_daemon.start)]
+        # Two racks of two MAs on localhost
+        aggregators = []
+        for i in range(2):
+            aggregator_port = port + 10 * (i + 1)
+            aggregator_opt = dict(opt, aggregator_loc='127.0.0.1:{0}'.format(aggregator_port), aggregator_id=str(i),
+                                  aggregator_mas=[2 * i + 1, 2 * i + 2], aggregator_max_delay=0.2)
+            if pub_port_offset is not None:
+                aggregator_opt['aggregator_pub_port'] = aggregator_port + pub_port_offset
+            aggregators.append(Aggregator(aggregator_opt))
+        threads += [threading.Thread(target=a.start) for a in aggregators]
+        for t in threads:
+            t.start()
+        mas = []
+        for ma_id in range(1, 5):
+            aggregator_port = port + 10 * ((ma_id + 1) // 2)
+            mas.append(MonitorAgent(dict(opt, ma_id=ma_id, intf_daemon_loc='127.0.0.1:{0}'.format(aggregator_port),
+                                         **pub_port(aggregator_port))))
+        client = ActionClient('tcp://127.0.0.1:{port}'.format(port=port))
+        try:
+            for ma in mas:
+                ma.connect()
+            ts = int(time.time())
+            for ma in mas:
+                ma.send_obj([ts, ma.id, 0.5])
+            # MA 4 misses a tick, which is sent when its deadline passes
+            for ma in mas[:3]:
+                ma.send_obj([ts + 1, ma.id, 1.5])
+            self.wait_for(lambda: intf_daemon.get_status().get('written_rows', 0) == 7)
+            # One message per rack per tick
+            self.assertListEqual([2, 2], [a.sent_batches for a in aggregators])
+            self.assertEqual(4, intf_daemon.get_status()['ma_ok'])
+            self.assertEqual(4, intf_daemon.get_status()['decode_processed'])
+
+            # Actions published by IntfDaemon reach the MAs through the aggregators
+            def receive(ma: MonitorAgent, kind: int):
+                while True:
+                    self.assertTrue(ma.subscriber.poll(5000))
+                    frames = ma.subscriber.recv_multipart()
+                    if LustreCommon.decode_message(frames[1:]).kind == kind:
+                        return frames
+
+            for ma in mas:
+                ma.handle_broadcast(receive(ma, LustreCommon.KIND_HB))
+            self.assertIsNotNone(client.send([5, 10], ack=True))
+            for ma in mas:
+                frames = receive(ma, LustreCommon.KIND_ACTION)
+                self.assertListEqual([5, 10], LustreCommon.decode_message(frames[1:]).body)
+                self.assertEqual(1, LustreCommon.BROADCAST_SEQ.unpack(frames[0])[0])
+            # An aggregator resends the latest action to its MAs
+            mas[0].socket.send_multipart(LustreCommon.encode_message(LustreCommon.KIND_RESEND))
+            self.assertTrue(mas[0].socket.poll(5000))
+            self.assertListEqual([5, 10], LustreCommon.decode_message(mas[0].socket.recv_multipart()[1:]).body)
+        finally:
+            client.close()
+            for ma in mas:
+                if ma.socket:
+                    ma.disconnect()
+            for a in aggregators:
+                a.stop()
+            intf_daemon.stop()
+            for t in threads:
+                t.join()
+        db = ReplayDB(opt)
+        for ma_id in range(1, 5):
+            self.assertListEqual([ma_id, 0.5], db.get_pi(ma_id, ts))
+        for ma_id in range(1, 4):
+            self.assertListEqual([ma_id, 1.5], db.get_pi(ma_id, ts + 1))
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""Test cases for the health tracking of MAs
+
+Copyright (c) 2016, 2017 The Regents of the University of California. All
+rights reserved.
+
+Created by Yan Li <yanli@tuneup.ai>, Kenneth Chang <kchang44@ucsc.edu>,
+Oceane Bel <obel@ucsc.edu>. Storage Systems Research Center, Baskin School
+of Engineering.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of the Storage Systems Research Center, the
+      University of California, nor the names of its contributors
+      may be used to endorse or promote products derived from this
+      software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+REGENTS OF THE UNIVERSITY OF CALIFORNIA BE LIABLE FOR ANY DIRECT,
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from ascar.HealthTracker import *
+import unittest
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+
+class TestHealthTracker(unittest.TestCase):
+    def test_transitions(self):
+        events = []
+        tracker = HealthTracker([1, 2], timeout=10, on_event=events.append)
+        self.assertEqual(MA_NOT_SEEN, tracker.state(1))
+        self.assertIsNone(tracker.state(3))
+        self.assertEqual('0 MAs ok. 2 MAs not seen: 1, 2. ', tracker.summary())
+
+        tracker.seen(1, 100)
+        tracker.seen(2, 100)
+        # An MA that isn't expected is tracked as well
+        tracker.seen(3, 101)
+        self.assertListEqual([(1, MA_NOT_SEEN, MA_OK), (2, MA_NOT_SEEN, MA_OK), (3, MA_NOT_SEEN, MA_OK)],
+                             [(e.ma_id, e.old_state, e.new_state) for e in events])
+        self.assertTrue(tracker.all_healthy())
+        self.assertEqual('All 3 MAs healthy. ', tracker.summary())
+
+        # Further messages don't produce events
+        for now in range(101, 110):
+            tracker.seen(1, now)
+            tracker.seen(3, now)
+            self.assertListEqual([], tracker.check(now))
+        self.assertEqual(3, len(events))
+
+        events.clear()
+        self.assertListEqual([HealthEvent(2, MA_OK, MA_UNRESPONSIVE, 110, 100)], tracker.check(110))
+        self.assertListEqual([HealthEvent(2, MA_OK, MA_UNRESPONSIVE, 110, 100)], events)
+        self.assertEqual({'ma_ok': 2, 'ma_unresponsive': 1, 'ma_not_seen': 0}, tracker.get_status())
+        self.assertEqual('2 MAs ok. 1 MAs unresponsive: 2. ', tracker.summary())
+        # The deadlines of the other MAs have been moved on
+        self.assertListEqual([], tracker.check(118))
+        self.assertEqual([1, 3], [e.ma_id for e in tracker.check(119)])
+
+        # An MA that comes back is ok again
+        tracker.seen(2, 130)
+        self.assertEqual(MA_OK, tracker.state(2))
+        self.assertEqual(130, tracker.last_seen(2))
+        self.assertEqual((MA_UNRESPONSIVE, MA_OK), events[-1][1:3])
+        self.assertListEqual([1, 3], tracker.mas(MA_UNRESPONSIVE))
+
+    def test_many_mas(self):
+        tracker = HealthTracker(range(2000), timeout=10)
+        for ma_id in range(2000):
+            tracker.seen(ma_id, 0)
+        for now in range(1, 10):
+            for ma_id in range(2000):
+                tracker.seen(ma_id, now)
+            tracker.check(now)
+        # Only one deadline per MA is kept no matter how many messages came
+        self.assertEqual(2000, len(tracker._deadlines))
+        self.assertEqual(0, len(tracker.check(18)))
+        self.assertEqual(2000, len(tracker.check(19)))
+        self.assertEqual(0, len(tracker._deadlines))
+        self.assertIn('2000 MAs unresponsive: 0, 1, 2', tracker.summary())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""Test cases for the memmap ReplayDB backend
+
+Copyright (c) 2016, 2017 The Regents of the University of California. All
+rights reserved.
+
+Created by Yan Li <yanli@tuneup.ai>, Kenneth Chang <kchang44@ucsc.edu>,
+Oceane Bel <obel@ucsc.edu>. Storage Systems Research Center, Baskin School
+of Engineering.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of the Storage Systems Research Center, the
+      University of California, nor the names of its contributors
+      may be used to endorse or promote products derived from this
+      software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+REGENTS OF THE UNIVERSITY OF CALIFORNIA BE LIABLE FOR ANY DIRECT,
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from copy import deepcopy
+import numpy as np
+import unittest
+from ascar import NotEnoughDataError
+from ascar import LustreGame
+from ascar.MemmapReplayDB import MemmapReplayDB
+from . import common
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+
+class TestMemmapReplayDB(unittest.TestCase):
+    """ Test cases for the memmap ReplayDB backend
+
+    We load the same data into both backends and compare the results.
+
+    :type db: MemmapReplayDB
+    """
+    db = None
+    sqlite_db = None
+    test_db_file = '/tmp/ascar-drl-testdb'
+    test_memmap_db_file = '/tmp/ascar-drl-testdb-memmap'
+
+    def setUp(self):
+        self.sqlite_db = common.populate_testdb(self.test_db_file)
+        self.sqlite_opt = deepcopy(common.dbopt)
+        # Both DBs must have the same ts even if a second boundary passes in between
+        self.db = common.populate_testdb(self.test_memmap_db_file, backend='memmap', cur_ts=common.last_ts + 1)
+        self.opt = deepcopy(common.dbopt)
+        common.dbopt.update(self.sqlite_opt)
+
+    def tearDown(self):
+        self.db.close()
+        self.sqlite_db.close()
+
+    def test_compare_with_sqlite(self):
+        self.assertIsInstance(self.db, MemmapReplayDB)
+        self.assertEqual(self.sqlite_db.get_last_ts(), self.db.get_last_ts())
+        self.assertEqual(self.sqlite_db.get_pi_ts_range(), self.db.get_pi_ts_range())
+        self.assertEqual(self.sqlite_db.get_action_ts_range(), self.db.get_action_ts_range())
+        self.assertEqual(self.sqlite_db.get_action_row_count(), self.db.get_action_row_count())
+        for ts in range(common.first_ts - 1, common.last_ts + 2):
+            self.assertEqual(self.sqlite_db.get_action(ts), self.db.get_action(ts))
+            if common.first_ts <= ts <= common.last_ts:
+                self.assertListEqual(self.sqlite_db.get_pi(3, ts), self.db.get_pi(3, ts))
+            else:
+                with self.assertRaises(ValueError):
+                    self.db.get_pi(3, ts)
+            try:
+                exp_obs = self.sqlite_db.get_observation(ts)
+            except NotEnoughDataError:
+                with self.assertRaises(NotEnoughDataError):
+                    self.db.get_observation(ts)
+                continue
+            self.assertTrue(np.array_equal(exp_obs, self.db.get_observation(ts)))
+        for exp_obs, obs in zip(self.sqlite_db.get_last_n_observation(3), self.db.get_last_n_observation(3)):
+            self.assertTrue(np.array_equal(exp_obs, obs))
+
+    def test_missing_entry(self):
+        # Reopen the DB
+        self.db.close()
+        self.db = MemmapReplayDB(self.opt)
+        db = self.db
+        db.insert_pi(3, common.last_ts + 2, [1] * db.pi_per_ma)
+        # The PI should be stored at last_ts+1 because last_ts+1 is missing
+        self.assertListEqual([1] * db.pi_per_ma, db.get_pi(3, common.last_ts + 1))
+        with self.assertRaises(ValueError):
+            db.get_pi(3, common.last_ts + 2)
+        self.assertEqual(common.last_ts, db.get_last_ts())
+        # PIs may also come as the raw float64 buffer of a protocol v2 message
+        db.insert_pi(4, common.last_ts + 1, np.full(db.pi_per_ma, 2.5).tobytes())
+        self.assertListEqual([2.5] * db.pi_per_ma, db.get_pi(4, common.last_ts + 1))
+
+    def test_tail(self):
+        self.sqlite_db.flush()
+        cursor = self.db.tail(max_rows=9)
+        exp_rows = [row for chunk in self.sqlite_db.tail() for row in zip(
+            chunk.ts.tolist(), chunk.ma_id.tolist(), chunk.pis.tolist(), chunk.has_pi.tolist())]
+        exp_actions = [row for chunk in self.sqlite_db.tail() for row in zip(chunk.action_ts.tolist(),
+                                                                             chunk.actions.tolist())]
+        rows = [row for chunk in cursor for row in zip(chunk.ts.tolist(), chunk.ma_id.tolist(),
+                                                       chunk.pis.tolist(), chunk.has_pi.tolist())]
+        self.assertListEqual(sorted(exp_rows), sorted(rows))
+        self.assertEqual(0, cursor.read().num_rows())
+        actions = [row for chunk in self.db.tail(max_rows=2)
+                   for row in zip(chunk.action_ts.tolist(), chunk.actions.tolist())]
+        self.assertListEqual(exp_actions, actions)
+
+        # PIs that come in for the last ts read are returned, the ones read before are not
+        self.db.insert_pi(1, common.last_ts + 1, [1] * self.db.pi_per_ma)
+        chunk = cursor.read()
+        self.assertListEqual([(common.last_ts + 1, 1)], list(zip(chunk.ts.tolist(), chunk.ma_id.tolist())))
+        self.db.insert_pi(2, common.last_ts + 1, [2] * self.db.pi_per_ma)
+        self.db.insert_action(common.last_ts + 1, 1)
+        chunk = self.db.tail(cursor.position).read()
+        self.assertListEqual([(common.last_ts + 1, 2)], list(zip(chunk.ts.tolist(), chunk.ma_id.tolist())))
+        self.assertListEqual([2] * self.db.pi_per_ma, chunk.pis[0].tolist())
+        self.assertListEqual([(common.last_ts + 1, 1)], list(zip(chunk.action_ts.tolist(), chunk.actions.tolist())))
+
+    def test_memcache(self):
+        l = LustreGame.Lustre(self.opt)
+        sqlite_l = LustreGame.Lustre(self.sqlite_opt)
+        self.assertEqual(len(sqlite_l.memcache), len(l.memcache))
+        for i in range(l.ticks_per_observation - 1, len(l.memcache)):
+            self.assertTrue(np.array_equal(sqlite_l.get_observation_by_cache_idx(i),
+                                           l.get_observation_by_cache_idx(i)))
+        # New data should be picked up by refresh_memcache
+        self.db.insert_pi(1, common.last_ts + 1, [1] * self.db.pi_per_ma)
+        l.refresh_memcache()
+        self.assertEqual(len(sqlite_l.memcache) + 1, len(l.memcache))
+
+
+if __name__ == '__main__':
+    unittest.main()
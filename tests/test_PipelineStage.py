@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""Test cases for the stages of the IntfDaemon pipeline
+
+Copyright (c) 2016, 2017 The Regents of the University of California. All
+rights reserved.
+
+Created by Yan Li <yanli@tuneup.ai>, Kenneth Chang <kchang44@ucsc.edu>,
+Oceane Bel <obel@ucsc.edu>. Storage Systems Research Center, Baskin School
+of Engineering.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of the Storage Systems Research Center, the
+      University of California, nor the names of its contributors
+      may be used to endorse or promote products derived from this
+      software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+REGENTS OF THE UNIVERSITY OF CALIFORNIA BE LIABLE FOR ANY DIRECT,
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import threading
+import time
+import unittest
+from ascar.PipelineStage import PipelineStage
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+
+class TestPipelineStage(unittest.TestCase):
+    def test_stages(self):
+        results = []
+        last = PipelineStage('last', results.append, queue_size=3)
+        first = PipelineStage('first', lambda item: last.put(item * 2))
+        # The first stage is not blocked by the last one, which hasn't been started and drops what
+        # doesn't fit in its queue
+        first.start()
+        for i in range(5):
+            first.put(i)
+        while first.metrics.processed < 5:
+            time.sleep(0.01)
+        last.start()
+        first.stop()
+        last.stop()
+        self.assertListEqual([0, 2, 4], results)
+        self.assertEqual(2, last.metrics.dropped)
+        status = last.get_status()
+        self.assertEqual(3, status['last_processed'])
+        self.assertEqual(0, status['last_queue_depth'])
+        self.assertGreater(status['last_max_queue_latency'], 0)
+        self.assertGreaterEqual(status['last_max_queue_latency'], status['last_avg_queue_latency'])
+
+    def test_error(self):
+        errors = []
+        idle = threading.Event()
+
+        def handler(item):
+            if item == 'bad':
+                raise ValueError(item)
+
+        stage = PipelineStage('stage', handler, on_idle=idle.set, idle_interval=0.01, on_error=errors.append)
+        stage.start()
+        self.assertTrue(idle.wait(5))
+        stage.put('good')
+        stage.put('bad')
+        stage.put('good')
+        stage.stop()
+        self.assertIsInstance(stage.error, ValueError)
+        self.assertListEqual([stage.error], errors)
+        # Nothing is processed after the error
+        self.assertEqual(1, stage.metrics.processed)
+        self.assertEqual(1, stage.metrics.errors)
+
+    def test_batches(self):
+        results = []
+        stage = PipelineStage('stage', results.extend, queue_size=1, item_size=len)
+        stage.put([1, 2, 3])
+        # Messages of a batch that doesn't fit in the queue are all counted as dropped
+        stage.put([4, 5])
+        stage.start()
+        stage.put([6])
+        stage.stop()
+        self.assertListEqual([1, 2, 3, 6], results)
+        status = stage.get_status()
+        self.assertEqual(4, status['stage_processed'])
+        self.assertEqual(2, status['stage_dropped'])
+
+
+if __name__ == '__main__':
+    unittest.main()
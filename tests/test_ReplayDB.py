@@ -35,10 +35,18 @@ ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
 OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import glob
 import numpy as np
+import os
+import random
+import shutil
+import sqlite3
+import threading
 import unittest
 from ascar import NotEnoughDataError
 from ascar import ReplayDB
+from ascar import PI_DELTA_KEYFRAME_TICKS, PI_FORMAT_DELTA, PI_FORMAT_F64LE, PI_FORMAT_LATEST, PI_FORMAT_PICKLE
+from ascar import migrate_pi_format
 from ascar import LustreGame
 from . import common
 
@@ -179,5 +187,581 @@ class TestReplayDB(unittest.TestCase):
         self.assertTrue(np.array_equal(exp_obs, l.get_observation_by_cache_idx(25 + common.num_ticks)))
         del l
 
+    def test_get_observations(self):
+        min_ts, max_ts = self.db.get_pi_ts_range()
+        ts_list = list(range(min_ts, max_ts + 1)) + [max_ts, min_ts + 5, max_ts + 2]
+        random.shuffle(ts_list)
+        # Use a small block size to exercise reading in multiple blocks
+        for max_block_rows in (1, 30, 1 << 18):
+            observs, valid = self.db.get_observations(ts_list, max_block_rows=max_block_rows)
+            self.assertEqual((len(ts_list), self.db.observation_size), observs.shape)
+            for i, ts in enumerate(ts_list):
+                try:
+                    exp_obs = self.db.get_observation(ts)
+                    self.assertTrue(valid[i])
+                    self.assertTrue(np.array_equal(exp_obs, observs[i]))
+                except NotEnoughDataError:
+                    self.assertFalse(valid[i])
+
+        # Only the windows of sparse samples are read
+        blocks = []
+        read_block = self.db._read_block
+        self.db._read_block = lambda start_ts, end_ts: blocks.append((start_ts, end_ts)) or read_block(start_ts, end_ts)
+        tpo = self.db.ticks_per_observation
+        # The window of min_ts + 11 + tpo touches that of min_ts + 11, the next one doesn't
+        observs, valid = self.db.get_observations([min_ts + 30, min_ts + 10, min_ts + 11, min_ts + 11 + tpo,
+                                                   min_ts + 12 + 2 * tpo])
+        del self.db._read_block
+        self.assertEqual([(min_ts + 11 - tpo, min_ts + 11 + tpo), (min_ts + 13 + tpo, min_ts + 12 + 2 * tpo),
+                          (min_ts + 31 - tpo, min_ts + 30)], blocks)
+        self.assertTrue(np.array_equal(self.db.get_observation(min_ts + 30), observs[0]))
+
+        # A hole within missing_entry_tolerance
+        c = self.db.conn.cursor()
+        c.execute('DELETE FROM pis WHERE ts = ? AND ma_id=3', (min_ts + 10,))
+        self.db.conn.commit()
+        observs, valid = self.db.get_observations([min_ts + 10, min_ts + 11])
+        self.assertTrue(valid.all())
+        self.assertTrue(np.array_equal(self.db.get_observation(min_ts + 10), observs[0]))
+        self.db.missing_entry_tolerance = 0
+        observs, valid = self.db.get_observations([min_ts + 9, min_ts + 10, min_ts + 14])
+        self.assertEqual([True, False, True], valid.tolist())
+
+        observs, valid = self.db.get_observations([])
+        self.assertEqual((0, self.db.observation_size), observs.shape)
+
+    def test_batched_write(self):
+        opt = dict(self.opt)
+        opt['dbfile'] = self.test_db_file + '-batched'
+        opt['write_batch_size'] = 5
+        try:
+            os.remove(opt['dbfile'])
+        except FileNotFoundError:
+            pass
+        db = ReplayDB(opt)
+        db.insert_pi(1, 100, [1, 2, 3])
+        # ts 101 is missing, so the PI of ts 102 should be stored at ts 101 even
+        # though ts 100 is still in the write buffer
+        db.insert_pi(1, 102, [4, 5, 6])
+        db.insert_action(100, 2)
+        with self.assertRaises(ValueError):
+            db.get_pi(1, 100)
+        self.assertEqual(0, db.get_action(100))
+
+        db.insert_pi(2, 100, [7, 8, 9])
+        # A protocol v2 buffer is stored as is
+        db.insert_pi(2, 101, np.array([10, 11, 12], '<f8').tobytes())
+        # The fifth row triggers a flush
+        self.assertListEqual([1, 2, 3], db.get_pi(1, 100))
+        self.assertListEqual([4, 5, 6], db.get_pi(1, 101))
+        self.assertListEqual([10, 11, 12], db.get_pi(2, 101))
+        self.assertEqual(2, db.get_action(100))
+        self.assertEqual(5, db.last_flush_size)
+
+        db.insert_pi(2, 102, [13, 14, 15])
+        db.flush()
+        self.assertListEqual([13, 14, 15], db.get_pi(2, 102))
+        self.assertEqual(1, db.last_flush_size)
+
+        # A flush that fails because the DB is locked keeps the rows for the next flush
+        db.insert_pi(1, 105, [16, 17, 18])
+        db.insert_pi(1, 106, [19, 20, 21])
+        db.conn.execute('PRAGMA busy_timeout = 0')
+        locker = sqlite3.connect(opt['dbfile'])
+        locker.execute('BEGIN EXCLUSIVE')
+        with self.assertRaises(sqlite3.OperationalError):
+            db.flush()
+        locker.rollback()
+        locker.close()
+        db.insert_pi(1, 108, [22, 23, 24])
+        db.flush()
+        self.assertListEqual([19, 20, 21], db.get_pi(1, 106))
+        # The missing entry at ts 107 is repaired using the rows of the failed flush
+        self.assertListEqual([22, 23, 24], db.get_pi(1, 107))
+        db.close()
+
+    def test_missing_entry_after_reopen(self):
+        for ma_id in self.nodeid_map.values():
+            self.db.insert_pi(ma_id, common.last_ts + 1, [0] * common.num_obd * common.pi_per_obd)
+        self.db.flush()
+        self.db.close()
+        # The last ts of each MA is rebuilt from the DB, so the missing entry at last_ts+2 is detected
+        self.db = ReplayDB(self.opt)
+        self.db.insert_pi(1, common.last_ts + 3, [1] * common.num_obd * common.pi_per_obd)
+        self.db.flush()
+        self.assertListEqual([1] * common.num_obd * common.pi_per_obd, self.db.get_pi(1, common.last_ts + 2))
+        # A late arrival is checked against the DB
+        c = self.db.conn.cursor()
+        c.execute('DELETE FROM pis WHERE ts = ? AND ma_id=2', (common.last_ts,))
+        self.db.conn.commit()
+        self.db.insert_pi(2, common.last_ts + 1, [2] * common.num_obd * common.pi_per_obd)
+        self.db.flush()
+        self.assertListEqual([2] * common.num_obd * common.pi_per_obd, self.db.get_pi(2, common.last_ts))
+
+    def test_migrate_pi_format(self):
+        self.assertEqual(PI_FORMAT_LATEST, self.db.pi_format)
+
+        # Make a copy of a DB that was created with pickled PIs
+        homedir = os.path.dirname(os.path.abspath(__file__))
+        old_db_file = self.test_db_file + '-migrate'
+        shutil.copy(os.path.join(homedir, '../datasets/filebench_2016-09-05_18-14-07/ascar_replay_db.sqlite'),
+                    old_db_file)
+        opt = {
+            'dbfile': old_db_file,
+            'nodeid_map': {'ryu': 1, 'sagat': 2, 'zangief': 3, 'guile': 4, 'blanka': 5, 'ken': 6, 'vega': 7,
+                           'abel': 8},
+            'clients': ['ryu', 'sagat', 'zangief', 'guile'],
+            'tick_data_size': 8 * 4 * 4,
+        }
+        db = ReplayDB(opt)
+        self.assertEqual(PI_FORMAT_PICKLE, db.pi_format)
+        exp_obs = db.get_observation(1473124606)
+        exp_pi = db.get_pi(1, 1473124606)
+        db.conn.close()
+
+        self.assertEqual(1095, migrate_pi_format(old_db_file))
+        # Migrating again is a no-op
+        self.assertEqual(0, migrate_pi_format(old_db_file))
+        db = ReplayDB(opt)
+        self.assertEqual(PI_FORMAT_F64LE, db.pi_format)
+        self.assertTrue(np.array_equal(exp_obs, db.get_observation(1473124606)))
+        self.assertListEqual(exp_pi, db.get_pi(1, 1473124606))
+        db.conn.close()
+
+    def test_delta_pi_format(self):
+        def pi_data_size(db):
+            return db.conn.execute('SELECT SUM(LENGTH(pi_data)) FROM pis').fetchone()[0]
+
+        self.db.flush()
+        self.db.close()
+        delta_db_file = self.test_db_file + '-delta'
+        shutil.copy(self.test_db_file, delta_db_file)
+        self.assertEqual(len(self.nodeid_map) * common.num_ticks, migrate_pi_format(delta_db_file, PI_FORMAT_DELTA))
+        self.db = ReplayDB(self.opt)
+        delta_db = ReplayDB(dict(self.opt, dbfile=delta_db_file))
+        self.assertEqual(PI_FORMAT_DELTA, delta_db.pi_format)
+        self.assertLess(pi_data_size(delta_db), pi_data_size(self.db) / 2)
+        # Any tick can be read no matter where its keyframe is
+        for ts in range(common.first_ts + 3, common.last_ts + 1):
+            self.assertTrue(np.array_equal(self.db.get_observation(ts), delta_db.get_observation(ts)))
+            self.assertListEqual(self.db.get_pi(4, ts), delta_db.get_pi(4, ts))
+        self.assertEqual(self.db.read_pis_since(None)[0][-1][2].tolist(),
+                         delta_db.read_pis_since(None)[0][-1][2].tolist())
+        # Deltas read by a tail cursor in small chunks are decoded using the rows of earlier chunks
+        for exp_chunk, chunk in zip(self.db.tail(max_rows=5), delta_db.tail(max_rows=5)):
+            self.assertTrue(np.array_equal(exp_chunk.pis, chunk.pis))
+        delta_db.close()
+
+        # A new DB in PI_FORMAT_DELTA written by insert_pi, with gaps and a late arrival
+        opt = dict(self.opt, dbfile=self.test_db_file + '-delta-new', replaydb_pi_format=PI_FORMAT_DELTA,
+                   retention_ticks=20, retention_downsample_ticks=1, retention_step_ticks=7)
+        for f in glob.glob(opt['dbfile'] + '*'):
+            os.remove(f)
+        delta_db = ReplayDB(opt)
+        pi_len = common.num_obd * common.pi_per_obd
+        expected = dict()
+        for ts in range(1, 100):
+            for ma_id in self.nodeid_map.values():
+                # Two missing ticks in a row so the gap isn't repaired
+                if (ts + ma_id) % 17 > 1:
+                    expected[ma_id, ts] = [ts * ma_id + i % 3 for i in range(pi_len)]
+                    # PIs may also come as the raw float64 buffer of a protocol v2 message
+                    data = expected[ma_id, ts] if ma_id != 2 else np.asarray(expected[ma_id, ts], '<f8').tobytes()
+                    delta_db.insert_pi(ma_id, ts, data)
+        expected[1, 16] = [-1] * pi_len
+        delta_db.insert_pi(1, 16, expected[1, 16])
+        delta_db.flush()
+        for (ma_id, ts), pi in expected.items():
+            self.assertListEqual(pi, delta_db.get_pi(ma_id, ts))
+
+        # Deltas that refer to aged out ticks are turned into keyframes
+        self.assertGreater(delta_db.enforce_retention(), 0)
+        min_ts = delta_db.get_pi_ts_range()[0]
+        self.assertNotEqual(0, min_ts % PI_DELTA_KEYFRAME_TICKS)
+        for (ma_id, ts), pi in expected.items():
+            if ts >= min_ts:
+                self.assertListEqual(pi, delta_db.get_pi(ma_id, ts))
+
+        # A lost row makes the deltas after it up to the next keyframe missing entries
+        lost_ts = next(ts for ts in range(min_ts + 2, 99) if ts % PI_DELTA_KEYFRAME_TICKS < 14 and
+                       all((1, x) in expected for x in range(ts - 1, ts + 3)))
+        delta_db.conn.execute('DELETE FROM pis WHERE ma_id = 1 AND ts = ?', (lost_ts,))
+        delta_db.conn.commit()
+        for ts in (lost_ts + 1, lost_ts + 2):
+            with self.assertRaises(ValueError):
+                delta_db.get_pi(1, ts)
+            self.assertListEqual(expected[2, ts], delta_db.get_pi(2, ts))
+        self.assertEqual(sum((ma_id, lost_ts + 2) in expected for ma_id in self.nodeid_map.values()) - 1,
+                         delta_db._read_block(lost_ts + 2, lost_ts + 2)[1][0])
+        # Reading doesn't fail, and the ticks around the lost chain are intact
+        delta_db.get_observations([lost_ts + 2, lost_ts + 6])
+        self.assertListEqual(expected[1, lost_ts - 1], delta_db.get_pi(1, lost_ts - 1))
+        keyframe_ts = lost_ts - lost_ts % PI_DELTA_KEYFRAME_TICKS + PI_DELTA_KEYFRAME_TICKS
+        for ts in range(keyframe_ts, keyframe_ts + 3):
+            if (1, ts) in expected:
+                self.assertListEqual(expected[1, ts], delta_db.get_pi(1, ts))
+        while delta_db.enforce_retention():
+            pass
+        self.assertGreater(delta_db.get_pi_ts_range()[0], lost_ts)
+        delta_db.close()
+
+    def test_tail(self):
+        self.db.flush()
+        exp_rows, _ = self.db.read_pis_since(0)
+        action_ts = [row[0] for row in self.db.conn.execute('SELECT ts FROM actions ORDER BY ts')]
+        cursor = self.db.tail(max_rows=7)
+        chunks = list(cursor)
+        self.assertTrue(all(len(chunk.ts) <= 7 and len(chunk.action_ts) <= 7 for chunk in chunks))
+        rows = sorted((ts, ma_id, pi.tolist() if has_pi else []) for chunk in chunks
+                      for ts, ma_id, pi, has_pi in zip(chunk.ts.tolist(), chunk.ma_id.tolist(), chunk.pis,
+                                                       chunk.has_pi))
+        self.assertListEqual([(row[0], row[1], row[2].tolist()) for row in exp_rows], rows)
+        self.assertListEqual(action_ts, [ts for chunk in chunks for ts in chunk.action_ts.tolist()])
+        self.assertEqual(0, cursor.read().num_rows())
+
+        # Only the new rows are read, and a new cursor can resume from the position of the old one
+        position = cursor.position
+        self.db.insert_pi(2, common.last_ts + 1, [1] * self.db.pi_per_ma)
+        self.db.insert_action(common.last_ts + 1, 3)
+        self.db.flush()
+        for chunk in (cursor.read(), self.db.tail(position).read()):
+            self.assertListEqual([common.last_ts + 1], chunk.ts.tolist())
+            self.assertListEqual([2], chunk.ma_id.tolist())
+            self.assertListEqual([1] * self.db.pi_per_ma, chunk.pis[0].tolist())
+            self.assertListEqual([(common.last_ts + 1, 3)], list(zip(chunk.action_ts.tolist(),
+                                                                       chunk.actions.tolist())))
+
+        # Reading from a position is a seek, not a scan
+        for table, query in (('pis', 'SELECT rowid, ma_id, ts, pi_data FROM main.pis WHERE rowid > ? '
+                                     'ORDER BY rowid LIMIT ?'),
+                             ('actions', 'SELECT ts, action FROM main.actions WHERE ts > ? ORDER BY ts LIMIT ?')):
+            plan = self.db.conn.execute('EXPLAIN QUERY PLAN ' + query, (0, 1)).fetchall()
+            self.assertEqual(['SEARCH main.{0} USING INTEGER PRIMARY KEY (rowid>?)'.format(table)],
+                             [row[3] for row in plan])
+
+    def test_tick_counts(self):
+        def assert_tick_counts_match(db):
+            c = db.conn.cursor()
+            c.execute('SELECT ts, COUNT(*) FROM pis GROUP BY ts ORDER BY ts')
+            exp = c.fetchall()
+            c.execute('SELECT ts, entries FROM tick_counts ORDER BY ts')
+            self.assertListEqual(exp, c.fetchall())
+
+        assert_tick_counts_match(self.db)
+        c = self.db.conn.cursor()
+        c.execute('DELETE FROM pis WHERE ts = ? AND ma_id=3', (common.last_ts,))
+        c.execute('DELETE FROM pis WHERE ts = ?', (common.last_ts - 5,))
+        c.execute('UPDATE pis SET ts = ts + 100 WHERE ts = ?', (common.last_ts - 1,))
+        self.db.conn.commit()
+        assert_tick_counts_match(self.db)
+        self.assertEqual(common.last_ts + 99, self.db.get_last_ts())
+
+        # Tick counts are backfilled for DBs that were created without them
+        c.execute('DROP TABLE tick_counts')
+        for trigger in ('insert', 'delete', 'update'):
+            c.execute('DROP TRIGGER pis_tick_counts_' + trigger)
+        self.db.conn.commit()
+        self.db.conn.close()
+        db = ReplayDB(self.opt)
+        assert_tick_counts_match(db)
+        self.assertEqual(common.last_ts + 99, db.get_last_ts())
+        db.conn.close()
+
+    def test_ts_ranges(self):
+        def assert_ts_ranges_match(db):
+            c = db.conn.cursor()
+            for table, get_range in (('pis', db.get_pi_ts_range), ('actions', db.get_action_ts_range)):
+                c.execute('SELECT MIN(ts) FROM ' + table)
+                min_ts = c.fetchone()[0]
+                c.execute('SELECT MAX(ts) FROM ' + table)
+                self.assertEqual((min_ts, c.fetchone()[0]), get_range())
+
+        assert_ts_ranges_match(self.db)
+        min_ts, max_ts = self.db.get_pi_ts_range()
+        c = self.db.conn.cursor()
+        c.execute('DELETE FROM pis WHERE ts = ?', (min_ts,))
+        c.execute('DELETE FROM pis WHERE ts = ? AND ma_id = 1', (max_ts,))
+        c.execute('DELETE FROM actions WHERE ts >= ?', (max_ts - 3,))
+        c.execute('UPDATE pis SET ts = ts + 100 WHERE ts = ?', (min_ts + 1,))
+        self.db.conn.commit()
+        assert_ts_ranges_match(self.db)
+        self.assertEqual((min_ts + 2, min_ts + 101), self.db.get_pi_ts_range())
+        self.db.insert_pi(1, min_ts - 10, [0] * common.num_obd * common.pi_per_obd)
+        self.db.insert_action(max_ts + 200, 1)
+        self.db.flush()
+        assert_ts_ranges_match(self.db)
+
+        # Ranges are backfilled for DBs that were created without them
+        c.execute('DROP TABLE ts_ranges')
+        for trigger in ('insert', 'delete', 'update'):
+            for table in ('pis', 'actions'):
+                c.execute('DROP TRIGGER {0}_ts_ranges_{1}'.format(table, trigger))
+        self.db.conn.commit()
+        self.db.conn.close()
+        self.db = ReplayDB(self.opt)
+        assert_ts_ranges_match(self.db)
+
+    def test_read_only(self):
+        ro_db = ReplayDB(dict(self.opt, replaydb_read_only=True))
+        ts = common.last_ts - 3
+        self.assertTrue(np.array_equal(self.db.get_observation(ts), ro_db.get_observation(ts)))
+        with self.assertRaises(sqlite3.OperationalError):
+            ro_db.conn.execute('DELETE FROM pis')
+        ro_db.conn.rollback()
+
+        # A reader never creates a DB. It reads an empty DB until the writer creates it.
+        missing_db_file = self.test_db_file + '-missing'
+        if os.path.exists(missing_db_file):
+            os.remove(missing_db_file)
+        early_reader = ReplayDB(dict(self.opt, dbfile=missing_db_file, replaydb_read_only=True,
+                                     replaydb_open_timeout=0, partition_check_interval=0))
+        with self.assertRaises(NotEnoughDataError):
+            early_reader.get_pi_ts_range()
+        self.assertFalse(os.path.exists(missing_db_file))
+        late_writer = ReplayDB(dict(self.opt, dbfile=missing_db_file))
+        for ma_id in self.nodeid_map.values():
+            late_writer.insert_pi(ma_id, 1, [0] * common.num_obd * common.pi_per_obd)
+        late_writer.flush()
+        self.assertEqual((1, 1), early_reader.get_pi_ts_range())
+        self.assertEqual(1, early_reader.get_last_ts())
+
+        # A DB that hasn't been upgraded by its writer is read without tick_counts and ts_ranges
+        c = late_writer.conn.cursor()
+        c.execute('DROP TABLE tick_counts')
+        c.execute('DROP TABLE ts_ranges')
+        for trigger in ('insert', 'delete', 'update'):
+            for table in ('pis', 'actions'):
+                c.execute('DROP TRIGGER IF EXISTS {0}_ts_ranges_{1}'.format(table, trigger))
+            c.execute('DROP TRIGGER pis_tick_counts_{0}'.format(trigger))
+        late_writer.conn.commit()
+        late_writer.close()
+        legacy_reader = ReplayDB(dict(self.opt, dbfile=missing_db_file, replaydb_read_only=True))
+        self.assertEqual((1, 1), legacy_reader.get_pi_ts_range())
+        self.assertEqual(1, legacy_reader.get_last_ts())
+        legacy_reader.close()
+        early_reader.close()
+        os.remove(missing_db_file)
+
+        # Each thread has its own connection
+        thread_result = []
+
+        def read():
+            thread_result.append((id(ro_db.conn), ro_db.get_observation(ts)))
+
+        t = threading.Thread(target=read)
+        t.start()
+        t.join()
+        self.assertNotEqual(id(ro_db.conn), thread_result[0][0])
+        self.assertTrue(np.array_equal(self.db.get_observation(ts), thread_result[0][1]))
+
+        # Writes committed during a snapshot are not seen until it ends
+        pi_ts_range = ro_db.get_pi_ts_range()
+        with ro_db.snapshot():
+            self.assertEqual(pi_ts_range, ro_db.get_pi_ts_range())
+            for ma_id in self.nodeid_map.values():
+                self.db.insert_pi(ma_id, common.last_ts + 1, [0] * common.num_obd * common.pi_per_obd)
+            self.db.flush()
+            self.assertEqual(pi_ts_range, ro_db.get_pi_ts_range())
+            self.assertEqual(common.last_ts, ro_db.get_last_ts())
+        self.assertEqual(common.last_ts + 1, ro_db.get_pi_ts_range()[1])
+        self.assertEqual(common.last_ts + 1, ro_db.get_last_ts())
+        ro_db.close()
+
+    def test_retention(self):
+        db_file = self.test_db_file + '-retention'
+        for f in (db_file, db_file + '-wal', db_file + '-shm'):
+            if os.path.exists(f):
+                os.remove(f)
+        pi_len = 500
+        opt = {
+            'dbfile': db_file,
+            'nodeid_map': {'a': 1, 'b': 2},
+            'tick_data_size': 2 * pi_len,
+            'retention_ticks': 10,
+            'retention_downsample_ticks': 5,
+            'retention_step_ticks': 10,
+        }
+        db = ReplayDB(opt)
+        for ts in range(40):
+            for ma_id in (1, 2):
+                db.insert_pi(ma_id, ts, [ts * ma_id] * pi_len)
+        page_count = db.get_status()['page_count']
+
+        self.assertEqual(20, db.enforce_retention())
+        self.assertEqual((10, 39), db.get_pi_ts_range())
+        self.assertEqual(20, db.enforce_retention())
+        self.assertEqual(20, db.enforce_retention())
+        self.assertEqual(0, db.enforce_retention())
+        self.assertEqual((30, 39), db.get_pi_ts_range())
+        c = db.conn.cursor()
+        c.execute('SELECT ts, ticks, pi_data FROM pis_archive WHERE ma_id = 2 ORDER BY ts')
+        archive = c.fetchall()
+        self.assertListEqual([0, 5, 10, 15, 20, 25], [row[0] for row in archive])
+        self.assertTrue(all(row[1] == 5 for row in archive))
+        self.assertListEqual([4.0] * pi_len, np.frombuffer(archive[0][2]).tolist())
+        self.assertListEqual([54.0] * pi_len, np.frombuffer(archive[5][2]).tolist())
+
+        # A late arrival is merged into its archived bucket
+        db.insert_pi(1, 3, [100] * pi_len)
+        self.assertEqual(1, db.enforce_retention())
+        c.execute('SELECT ticks, pi_data FROM pis_archive WHERE ma_id = 1 AND ts = 0')
+        ticks, pi_data = c.fetchone()
+        self.assertEqual(6, ticks)
+        self.assertListEqual([110 / 6] * pi_len, np.frombuffer(pi_data).tolist())
+
+        status = db.get_status()
+        self.assertEqual(2, status['auto_vacuum'])
+        self.assertEqual(30, status['archived_until_ts'])
+        self.assertEqual(61, status['aged_out_rows'])
+        self.assertGreater(status['vacuumed_pages'], 0)
+        self.assertLess(status['page_count'], page_count)
+        db.close()
+
+        # Steps limited by rows age out a bucket in several steps
+        os.remove(db_file)
+        db = ReplayDB(dict(opt, retention_step_rows=6))
+        for ts in range(40):
+            for ma_id in (1, 2):
+                db.insert_pi(ma_id, ts, [ts * ma_id] * pi_len)
+        self.assertEqual(6, db.enforce_retention())
+        self.assertEqual((3, 39), db.get_pi_ts_range())
+        while db.enforce_retention():
+            pass
+        self.assertEqual((30, 39), db.get_pi_ts_range())
+        c = db.conn.cursor()
+        c.execute('SELECT ts, ticks, pi_data FROM pis_archive WHERE ma_id = 2 ORDER BY ts')
+        archive = c.fetchall()
+        self.assertListEqual([0, 5, 10, 15, 20, 25], [row[0] for row in archive])
+        self.assertTrue(all(row[1] == 5 for row in archive))
+        self.assertListEqual([4.0] * pi_len, np.frombuffer(archive[0][2]).tolist())
+        self.assertListEqual([54.0] * pi_len, np.frombuffer(archive[5][2]).tolist())
+        db.close()
+
+    def test_partitions(self):
+        opt = {
+            'nodeid_map': {'a': 1, 'b': 2},
+            'tick_data_size': 2 * 3,
+            'ticks_per_observation': 2,
+            'partition_check_interval': 0,
+        }
+        db_file = self.test_db_file + '-partitions'
+        ref_db_file = self.test_db_file + '-partitions-ref'
+        for f in glob.glob(db_file + '*'):
+            os.remove(f)
+        dbs = [ReplayDB(dict(opt, dbfile=db_file, partition_ticks=10)),
+               ReplayDB(dict(opt, dbfile=ref_db_file))]
+
+        def insert(start_ts, end_ts):
+            for db in dbs:
+                for ts in range(start_ts, end_ts):
+                    db.insert_pi(1, ts, [ts] * 3)
+                    db.insert_pi(2, ts, [ts * 2] * 3)
+                    db.insert_action(ts, ts % 3)
+                db.flush()
+
+        def assert_same_as_ref(db):
+            ref_db = dbs[1]
+            self.assertEqual(ref_db.get_pi_ts_range(), db.get_pi_ts_range())
+            self.assertEqual(ref_db.get_action_ts_range(), db.get_action_ts_range())
+            self.assertEqual(ref_db.get_last_ts(), db.get_last_ts())
+            self.assertEqual(ref_db.get_action_row_count(), db.get_action_row_count())
+            min_ts, max_ts = ref_db.get_pi_ts_range()
+            for ts in range(min_ts + db.ticks_per_observation - 1, max_ts + 1):
+                self.assertTrue(np.array_equal(ref_db.get_observation(ts), db.get_observation(ts)))
+                self.assertEqual(ref_db.get_action(ts), db.get_action(ts))
+            exp_rows, _ = ref_db.read_pis_since(0)
+            rows, _ = db.read_pis_since(0)
+            self.assertEqual(len(exp_rows), len(rows))
+            for exp_row, row in zip(exp_rows, rows):
+                self.assertEqual((exp_row[0], exp_row[1], exp_row[3]), (row[0], row[1], row[3]))
+                self.assertTrue(np.array_equal(exp_row[2], row[2]))
+
+        insert(1, 35)
+        self.assertListEqual([db_file + '.' + str(x) for x in (0, 10, 20, 30)],
+                             sorted(f for f in glob.glob(db_file + '.*') if f[-1].isdigit()))
+        self.assertEqual(4, dbs[0].get_status()['partitions'])
+        assert_same_as_ref(dbs[0])
+
+        # Another ReplayDB follows the writer to new partitions
+        reader = ReplayDB(dict(opt, dbfile=db_file, partition_ticks=10))
+        ro_reader = ReplayDB(dict(opt, dbfile=db_file, partition_ticks=10, replaydb_read_only=True))
+        assert_same_as_ref(reader)
+        assert_same_as_ref(ro_reader)
+        _, position = reader.read_pis_since(0)
+        insert(35, 45)
+        assert_same_as_ref(reader)
+        assert_same_as_ref(ro_reader)
+        rows, _ = reader.read_pis_since(position)
+        self.assertListEqual([(ts, ma_id) for ts in range(35, 45) for ma_id in (1, 2)],
+                             [(row[0], row[1]) for row in rows])
+        # A tail cursor reads the partitions oldest first
+        cursor = ro_reader.tail(max_rows=3)
+        self.assertListEqual([(ts, ma_id) for ts in range(1, 45) for ma_id in (1, 2)],
+                             [row for chunk in cursor for row in zip(chunk.ts.tolist(), chunk.ma_id.tolist())])
+
+        # Old partitions are read-only
+        with self.assertRaises(sqlite3.OperationalError):
+            reader.conn.execute('DELETE FROM p0.pis')
+        reader.conn.rollback()
+
+        # Dropping an old partition
+        for f in glob.glob(db_file + '.0*'):
+            os.remove(f)
+        for db in (reader, ro_reader, dbs[0]):
+            self.assertEqual((10, 44), db.get_pi_ts_range())
+            self.assertTrue(np.array_equal(dbs[1].get_observation(20), db.get_observation(20)))
+
+        # A late arrival after a rollover completes a tick whose other entry is in the old partition
+        insert(45, 49)
+        for db in dbs:
+            db.insert_pi(2, 49, [49 * 2] * 3)
+            db.insert_pi(2, 50, [50 * 2] * 3)
+            db.insert_pi(1, 49, [49] * 3)
+            db.flush()
+        self.assertEqual(49, dbs[1].get_last_ts())
+        for db in (reader, ro_reader, dbs[0]):
+            self.assertEqual(49, db.get_last_ts())
+        reader.close()
+        ro_reader.close()
+        for db in dbs:
+            db.close()
+
+    def test_partition_duplicates(self):
+        opt = {
+            'nodeid_map': {'a': 1, 'b': 2},
+            'tick_data_size': 2 * 3,
+            'ticks_per_observation': 1,
+            'partition_ticks': 10,
+        }
+        db_file = self.test_db_file + '-partition-duplicates'
+        for f in glob.glob(db_file + '*'):
+            os.remove(f)
+        db = ReplayDB(dict(opt, dbfile=db_file))
+        db.insert_pi(1, 9, [9] * 3)
+        db.insert_action(9, 1)
+        db.insert_pi(1, 10, [10] * 3)
+        # The originals of these rows are in the partition before the main one
+        with self.assertRaises(sqlite3.IntegrityError):
+            db.insert_pi(1, 9, [90] * 3)
+        with self.assertRaises(sqlite3.IntegrityError):
+            db.insert_action(9, 2)
+        db.flush()
+        self.assertEqual(2, db.get_status()['partitions'])
+        self.assertEqual(1, db.get_tick_entries(9, 9)[0])
+        self.assertListEqual([9] * 3, db.get_pi(1, 9))
+        self.assertEqual(1, db.get_action(9))
+        # Tick 9 misses MA 2
+        with self.assertRaises(NotEnoughDataError):
+            db.get_last_ts()
+        with self.assertRaises(NotEnoughDataError):
+            db.get_observation(9)
+        # A late row that isn't a duplicate is still stored across the boundary
+        db.insert_pi(2, 9, [18] * 3)
+        db.flush()
+        self.assertEqual(9, db.get_last_ts())
+        db.close()
+        for f in glob.glob(db_file + '*'):
+            os.remove(f)
+
 if __name__ == '__main__':
     unittest.main()
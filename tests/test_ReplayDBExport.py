@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""Test cases for ReplayDB bulk export/import
+
+Copyright (c) 2016, 2017 The Regents of the University of California. All
+rights reserved.
+
+Created by Yan Li <yanli@tuneup.ai>, Kenneth Chang <kchang44@ucsc.edu>,
+Oceane Bel <obel@ucsc.edu>. Storage Systems Research Center, Baskin School
+of Engineering.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of the Storage Systems Research Center, the
+      University of California, nor the names of its contributors
+      may be used to endorse or promote products derived from this
+      software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+REGENTS OF THE UNIVERSITY OF CALIFORNIA BE LIABLE FOR ANY DIRECT,
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import numpy as np
+import os
+import shutil
+import unittest
+from ascar import PI_FORMAT_DELTA, ReplayDB, export_replay_db, import_replay_db, load_exported_chunks
+from . import common
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+
+class TestReplayDBExport(unittest.TestCase):
+    test_db_file = '/tmp/ascar-drl-testdb'
+    export_dir = '/tmp/ascar-drl-testdb-export'
+    import_db_file = '/tmp/ascar-drl-testdb-import'
+
+    def setUp(self):
+        self.db = common.populate_testdb(self.test_db_file)
+        self.db.flush()
+        self.opt = common.dbopt
+        self.tearDown()
+
+    def tearDown(self):
+        shutil.rmtree(self.export_dir, ignore_errors=True)
+        for ext in ('', '-wal', '-shm'):
+            for f in (self.import_db_file, self.import_db_file + '-delta', self.import_db_file + '-f64'):
+                try:
+                    os.remove(f + ext)
+                except FileNotFoundError:
+                    pass
+
+    def test_export_import(self):
+        # Small chunks so that both tables span multiple chunks
+        counts = export_replay_db(self.test_db_file, self.export_dir, chunk_rows=50)
+        self.assertEqual(len(common.testdb_nodeid_map) * common.num_ticks, counts['pis'])
+        self.assertEqual(self.db.get_action_row_count(), counts['actions'])
+
+        chunks = list(load_exported_chunks(self.export_dir, 'pis'))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(counts['pis'], sum(len(chunk['ts']) for chunk in chunks))
+        self.assertIsInstance(chunks[0]['pi_data'], np.memmap)
+        all_ts = np.concatenate([chunk['ts'] for chunk in chunks])
+        self.assertTrue(np.all(np.diff(all_ts) >= 0))
+        first = chunks[0]
+        pi = first['pi_data'][first['pi_offsets'][0]:first['pi_offsets'][1]]
+        self.assertTrue(np.array_equal(self.db.get_pi(int(first['ma_id'][0]), int(first['ts'][0])), pi))
+
+        self.assertEqual(counts, import_replay_db(self.export_dir, self.import_db_file))
+        imported = ReplayDB(dict(self.opt, dbfile=self.import_db_file))
+        self.assertEqual(self.db.get_last_ts(), imported.get_last_ts())
+        self.assertEqual(self.db.get_pi_ts_range(), imported.get_pi_ts_range())
+        self.assertEqual(self.db.get_action_ts_range(), imported.get_action_ts_range())
+        self.assertEqual(self.db.get_action_row_count(), imported.get_action_row_count())
+        ts = common.last_ts - common.num_ticks + 26
+        self.assertTrue(np.array_equal(self.db.get_observation(ts), imported.get_observation(ts)))
+        for ts in range(common.first_ts, common.last_ts + 1):
+            self.assertEqual(self.db.get_action(ts), imported.get_action(ts))
+        imported.close()
+
+        # Exporting and importing a DB in PI_FORMAT_DELTA
+        import_replay_db(self.export_dir, self.import_db_file + '-delta', PI_FORMAT_DELTA)
+        shutil.rmtree(self.export_dir)
+        self.assertEqual(counts, export_replay_db(self.import_db_file + '-delta', self.export_dir, chunk_rows=50))
+        self.assertEqual(counts, import_replay_db(self.export_dir, self.import_db_file + '-f64'))
+        imported = ReplayDB(dict(self.opt, dbfile=self.import_db_file + '-f64'))
+        for ts in range(common.first_ts + 3, common.last_ts + 1):
+            self.assertTrue(np.array_equal(self.db.get_observation(ts), imported.get_observation(ts)))
+        imported.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""Test cases for ReplayDBWriter
+
+Copyright (c) 2016, 2017 The Regents of the University of California. All
+rights reserved.
+
+Created by Yan Li <yanli@tuneup.ai>, Kenneth Chang <kchang44@ucsc.edu>,
+Oceane Bel <obel@ucsc.edu>. Storage Systems Research Center, Baskin School
+of Engineering.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of the Storage Systems Research Center, the
+      University of California, nor the names of its contributors
+      may be used to endorse or promote products derived from this
+      software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+REGENTS OF THE UNIVERSITY OF CALIFORNIA BE LIABLE FOR ANY DIRECT,
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import os
+import unittest
+from ascar import ReplayDB
+from ascar.ReplayDBWriter import ReplayDBWriter
+from ascar.TickAssembler import TickAssembler
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+
+class TestReplayDBWriter(unittest.TestCase):
+    test_db_file = '/tmp/ascar-drl-testdb-writer'
+
+    def setUp(self):
+        for ext in ('', '-wal', '-shm'):
+            try:
+                os.remove(self.test_db_file + ext)
+            except FileNotFoundError:
+                pass
+        self.opt = {
+            'dbfile': self.test_db_file,
+            'tick_data_size': 3,
+            'num_ma': 1,
+            'write_batch_size': 100,
+            'write_batch_interval': 0.1,
+            'replaydb_synchronous': 'NORMAL',
+            'replaydb_writer_queue_size': 3,
+        }
+
+    def test_write(self):
+        writer = ReplayDBWriter(self.opt)
+        # Nothing consumes the queue before the writer is started
+        writer.insert_pi(1, 100, [1, 2, 3])
+        writer.insert_pi(1, 101, [4, 5, 6])
+        writer.insert_action(100, 2)
+        writer.insert_action(101, 3)
+        status = writer.get_status()
+        self.assertEqual(3, status['write_queue_depth'])
+        self.assertEqual(1, status['dropped_rows'])
+
+        writer.start()
+        # A duplicate row is logged and counted but doesn't stop the writer
+        writer.insert_pi(1, 100, [7, 8, 9])
+        writer.stop()
+        status = writer.get_status()
+        self.assertEqual(0, status['write_queue_depth'])
+        self.assertEqual(1, status['write_errors'])
+        self.assertIn('last_flush_latency', status)
+
+        db = ReplayDB(self.opt)
+        self.assertListEqual([1, 2, 3], db.get_pi(1, 100))
+        self.assertListEqual([4, 5, 6], db.get_pi(1, 101))
+        self.assertEqual(2, db.get_action(100))
+        self.assertEqual(0, db.get_action(101))
+        self.assertEqual(1, db.conn.execute('PRAGMA synchronous').fetchone()[0])
+        db.close()
+
+    def test_insert_tick(self):
+        self.opt['num_ma'] = 2
+        ticks = []
+        assembler = TickAssembler([1, 2], on_tick=ticks.append)
+        assembler.add(1, 100, [1, 2, 3])
+        assembler.flush()
+        writer = ReplayDBWriter(self.opt)
+        writer.start()
+        writer.insert_tick(ticks[0])
+        writer.stop()
+        # Only the MAs that are present are stored, and rows are counted
+        self.assertEqual(1, writer.get_status()['written_rows'])
+        db = ReplayDB(self.opt)
+        self.assertListEqual([1, 2, 3], db.get_pi(1, 100))
+        self.assertEqual(1, db.conn.execute('SELECT COUNT(*) FROM pis').fetchone()[0])
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
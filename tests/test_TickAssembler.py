@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+"""Test cases for the assembly of ticks
+
+Copyright (c) 2016, 2017 The Regents of the University of California. All
+rights reserved.
+
+Created by Yan Li <yanli@tuneup.ai>, Kenneth Chang <kchang44@ucsc.edu>,
+Oceane Bel <obel@ucsc.edu>. Storage Systems Research Center, Baskin School
+of Engineering.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of the Storage Systems Research Center, the
+      University of California, nor the names of its contributors
+      may be used to endorse or promote products derived from this
+      software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+REGENTS OF THE UNIVERSITY OF CALIFORNIA BE LIABLE FOR ANY DIRECT,
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from ascar.TickAssembler import *
+import numpy as np
+import unittest
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+
+class TestTickAssembler(unittest.TestCase):
+    def setUp(self):
+        self.ticks = []
+        self.late = []
+        self.assembler = TickAssembler([1, 2, 3], max_delay=10, on_tick=self.ticks.append,
+                                       on_late=lambda ma_id, ts, pis: self.late.append((ma_id, ts, pis.tolist())))
+
+    def test_complete_tick(self):
+        self.assembler.add(3, 100, [7, 8])
+        self.assembler.add(1, 100, np.array([1, 2, 3], dtype=np.float64).tobytes())
+        self.assertListEqual([], self.ticks)
+        self.assertEqual(1, self.assembler.get_status()['pending_ticks'])
+        self.assembler.add(2, 100, [4, 5, 6])
+        self.assertEqual(1, len(self.ticks))
+        tick = self.ticks[0]
+        self.assertEqual(100, tick.ts)
+        self.assertTrue(tick.is_complete())
+        self.assertListEqual([1, 2, 3], tick.ma_ids.tolist())
+        self.assertListEqual([3, 3, 2], tick.pi_counts.tolist())
+        self.assertListEqual([[1, 2, 3], [4, 5, 6], [7, 8, 0]], tick.pis.tolist())
+        self.assertListEqual([(1, [1, 2, 3]), (2, [4, 5, 6]), (3, [7, 8])],
+                             [(ma_id, pis.tolist()) for ma_id, pis in tick.rows()])
+        self.assertEqual({'assembled_ticks': 1, 'partial_ticks': 0, 'late_rows': 0, 'pending_ticks': 0},
+                         self.assembler.get_status())
+
+    def test_deadline(self):
+        self.assembler.add(1, 100, [1])
+        self.assembler.add(2, 101, [2])
+        deadline = self.assembler.next_deadline()
+        self.assembler.check(deadline - 0.001)
+        self.assertListEqual([], self.ticks)
+        self.assembler.check(deadline)
+        self.assertEqual(1, len(self.ticks))
+        tick = self.ticks[0]
+        self.assertFalse(tick.is_complete())
+        self.assertListEqual([True, False, False], tick.present.tolist())
+        self.assertListEqual([(1, [1])], [(ma_id, pis.tolist()) for ma_id, pis in tick.rows()])
+        self.assertEqual(1, self.assembler.partial_ticks)
+
+        # PIs of a tick that has been emitted are late, and so are second PIs of an MA
+        self.assembler.add(2, 100, [3])
+        self.assembler.add(2, 101, [4])
+        self.assertListEqual([(2, 100, [3]), (2, 101, [4])], self.late)
+        self.assertEqual(2, self.assembler.late_rows)
+        self.assembler.flush()
+        self.assertListEqual([100, 101], [t.ts for t in self.ticks])
+        self.assertIsNone(self.assembler.next_deadline())
+
+    def test_order(self):
+        # A tick that completes first still waits for older ticks to be emitted
+        self.assembler.add(1, 100, [1])
+        for ma_id in (1, 2, 3):
+            self.assembler.add(ma_id, 101, [ma_id])
+        self.assertListEqual([100, 101], [t.ts for t in self.ticks])
+        self.assertFalse(self.ticks[0].is_complete())
+        self.assertTrue(self.ticks[1].is_complete())
+        # An MA that isn't expected is added after the expected ones and doesn't complete a tick
+        self.assembler.add(5, 102, [5])
+        for ma_id in (1, 2):
+            self.assembler.add(ma_id, 102, [ma_id])
+        self.assertEqual(2, len(self.ticks))
+        self.assembler.add(3, 102, [3])
+        self.assertListEqual([1, 2, 3, 5], self.ticks[2].ma_ids.tolist())
+        self.assertTrue(self.ticks[2].is_complete())
+
+    def test_dynamic_expected_mas(self):
+        assembler = TickAssembler(max_delay=10, on_tick=self.ticks.append,
+                                  on_late=lambda ma_id, ts, pis: self.late.append((ma_id, ts, pis.tolist())))
+        # Without a fixed set of MAs every tick waits for its deadline, so no MA is left out
+        assembler.add(1, 100, [1])
+        assembler.add(2, 100, [2])
+        assembler.add(1, 101, [1])
+        assembler.add(2, 101, [2])
+        assembler.add(3, 101, [3])
+        self.assertListEqual([], self.ticks)
+        assembler.check(assembler.next_deadline())
+        self.assertListEqual([100], [t.ts for t in self.ticks])
+        self.assertListEqual([1, 2], self.ticks[0].ma_ids.tolist())
+        self.assertTrue(self.ticks[0].is_complete())
+        assembler.flush()
+        self.assertListEqual([1, 2, 3], self.ticks[1].ma_ids.tolist())
+        self.assertTrue(self.ticks[1].is_complete())
+        # MAs seen so far are expected, so a tick without one of them is partial
+        assembler.add(1, 102, [1])
+        assembler.add(3, 102, [3])
+        assembler.flush()
+        self.assertListEqual([True, False, True], self.ticks[2].present.tolist())
+        self.assertEqual({'assembled_ticks': 3, 'partial_ticks': 1, 'late_rows': 0, 'pending_ticks': 0},
+                         assembler.get_status())
+        self.assertListEqual([], self.late)
+
+if __name__ == '__main__':
+    unittest.main()
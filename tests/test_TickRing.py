@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""Test cases for TickRing
+
+Copyright (c) 2016, 2017 The Regents of the University of California. All
+rights reserved.
+
+Created by Yan Li <yanli@tuneup.ai>, Kenneth Chang <kchang44@ucsc.edu>,
+Oceane Bel <obel@ucsc.edu>. Storage Systems Research Center, Baskin School
+of Engineering.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of the Storage Systems Research Center, the
+      University of California, nor the names of its contributors
+      may be used to endorse or promote products derived from this
+      software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+REGENTS OF THE UNIVERSITY OF CALIFORNIA BE LIABLE FOR ANY DIRECT,
+INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import numpy as np
+import os
+import unittest
+from ascar import NotEnoughDataError
+from ascar.ReplayDB import ReplayDB
+from ascar.TickRing import open_tick_ring
+from . import common
+
+__author__ = 'Yan Li'
+__copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of California. All rights reserved.'
+
+
+class TestTickRing(unittest.TestCase):
+    test_db_file = '/tmp/ascar-drl-testdb'
+
+    def setUp(self):
+        self.db = common.populate_testdb(self.test_db_file)
+        self.opt = dict(common.dbopt, tick_ring_name='ascar_test_tick_ring', tick_ring_ticks=16)
+        self.ring = open_tick_ring(self.opt, create=True)
+        self.reader = open_tick_ring(self.opt)
+
+    def tearDown(self):
+        self.reader.close()
+        self.ring.close()
+        self.assertIsNone(open_tick_ring(self.opt))
+
+    def test_observation(self):
+        pi_len = common.num_obd * common.pi_per_obd
+        self.assertEqual(len(common.testdb_nodeid_map), self.reader.num_slots)
+        self.assertEqual(pi_len, self.reader.pi_len)
+        with self.assertRaises(NotEnoughDataError):
+            self.reader.get_last_observation(self.db.ticks_per_observation, 0)
+
+        for ts, ma_id, pi, _ in self.db.read_pis_since(None)[0]:
+            self.assertTrue(self.ring.put(ma_id, ts, pi))
+        self.assertEqual(common.last_ts, self.reader.head_ts)
+        for ts in range(common.last_ts - 12, common.last_ts + 1):
+            self.assertTrue(np.array_equal(self.db.get_observation(ts),
+                                           self.reader.get_observation(ts, self.db.ticks_per_observation, 0)))
+        self.assertTrue(np.array_equal(self.db.get_last_n_observation()[0],
+                                       self.reader.get_last_observation(self.db.ticks_per_observation, 0)))
+        # Older ticks have been lapped
+        with self.assertRaises(NotEnoughDataError):
+            self.reader.get_observation(common.last_ts - 13, self.db.ticks_per_observation, 0)
+        self.assertFalse(self.ring.put(1, common.last_ts - 16, [0] * pi_len))
+
+        # A view stays valid until its row is overwritten
+        pis, present, seq = self.reader.view(common.last_ts)
+        self.assertTrue(np.array_equal(self.db.get_pi(3, common.last_ts), pis[2]))
+        self.assertTrue(self.reader.is_unchanged(common.last_ts, seq))
+        # A missing entry is repaired like ReplayDB does: the PI of last_ts+2 goes to last_ts+1
+        self.ring.put(3, common.last_ts + 2, [1] * pi_len)
+        pis, present, seq = self.reader.view(common.last_ts + 1)
+        self.assertListEqual([0, 0, 1, 0, 0], present.tolist())
+        self.assertListEqual([1] * pi_len, pis[2].tolist())
+        # Tolerating missing entries
+        obs = self.reader.get_observation(common.last_ts + 1, self.db.ticks_per_observation, 4)
+        self.assertEqual(0, obs.reshape((5, self.db.ticks_per_observation, pi_len))[0, -1].max())
+        with self.assertRaises(NotEnoughDataError):
+            self.reader.get_observation(common.last_ts + 1, self.db.ticks_per_observation, 3)
+        # The reader is lapped
+        self.ring.put(3, common.last_ts + 1 + 16, [2] * pi_len)
+        self.assertFalse(self.reader.is_unchanged(common.last_ts + 1, seq))
+        with self.assertRaises(NotEnoughDataError):
+            self.reader.view(common.last_ts + 1)
+
+        self.assertFalse(self.reader.closed)
+        self.ring.close()
+        self.assertTrue(self.reader.closed)
+        self.ring = open_tick_ring(self.opt, create=True)
+
+    def test_missing_entry_tolerance(self):
+        # seth is not a client but its missing entries count against the tolerance in both the DB and the ring
+        clients = ['blanka', 'dhalsim', 'gouken', 'ryu']
+        pi_len = common.num_obd * common.pi_per_obd
+        opt = dict(common.dbopt, dbfile=self.test_db_file + '-clients', replaydb_backend='sqlite', clients=clients,
+                   tick_data_size=pi_len * len(clients), tick_ring_name='ascar_test_tick_ring_clients',
+                   missing_entry_tolerance=2)
+        if os.path.exists(opt['dbfile']):
+            os.remove(opt['dbfile'])
+        db = ReplayDB(opt)
+        ring = open_tick_ring(opt, create=True)
+        self.assertEqual(len(clients), ring.num_slots)
+        tpo = db.ticks_per_observation
+        first_ts = 1000
+        last_ts = first_ts + tpo + 1
+        for ts in range(first_ts, last_ts + 1):
+            for host, ma_id in common.testdb_nodeid_map.items():
+                # seth misses the last two ticks and blanka the last one
+                if (host == 'seth' and ts >= last_ts - 1) or (host == 'blanka' and ts == last_ts):
+                    continue
+                pis = [ts + ma_id] * pi_len if host in clients else []
+                db.insert_pi(ma_id, ts, pis)
+                self.assertTrue(ring.put(ma_id, ts, pis))
+        db.flush()
+        try:
+            accepted = []
+            for ts in range(last_ts - 2, last_ts + 1):
+                try:
+                    exp_obs = db.get_observation(ts)
+                except NotEnoughDataError:
+                    with self.assertRaises(NotEnoughDataError):
+                        ring.get_observation(ts, tpo, db.missing_entry_tolerance)
+                    continue
+                self.assertTrue(np.array_equal(exp_obs, ring.get_observation(ts, tpo, db.missing_entry_tolerance)))
+                accepted.append(ts)
+            self.assertListEqual([last_ts - 2, last_ts - 1], accepted)
+        finally:
+            ring.close()
+            db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -38,13 +38,19 @@ OF THE POSSIBILITY OF SUCH DAMAGE.
 import numpy as np
 import logging
 import os
+import pickle
+import sqlite3
 import threading
 import time
 from typing import List
 import unittest
+import zlib
+import zmq
 from ascar import ascar_logging
+from ascar.ActionClient import ActionClient
 from ascar.IntfDaemon import IntfDaemon
 from ascar.MonitorAgent import MonitorAgent
+from ascar import LustreCommon
 from ascar import ReplayDB
 from ascar.LustreGame import Lustre
 
@@ -54,18 +60,15 @@ __copyright__ = 'Copyright (c) 2016, 2017 The Regents of the University of Calif
 ascar_logging.set_log_level(logging.WARNING)
 
 _total_actions = 0
-_expected_controller_action_data = None
 
 
 def _controller_action(data: List[float]):
     global _total_actions
     _total_actions += 1
-    if _expected_controller_action_data:
-        assert isinstance(data, list)
-        assert _expected_controller_action_data == data
 
 
 class TestIntfDaemon(unittest.TestCase):
+    # Each test uses its own ports: port + 10 * i for ROUTER and the one after it for PUB
     port = 9123
     test_db_file = '/tmp/ascar-drl-testdb'
     intf_daemon = None              # type: IntfDaemon
@@ -80,6 +83,8 @@ class TestIntfDaemon(unittest.TestCase):
         self.ma_daemon.start()
 
     def test_start_stop(self):
+        global _total_actions
+        _total_actions = 0
         try:
             ma_id = 1
             opt = {
@@ -118,6 +123,13 @@ class TestIntfDaemon(unittest.TestCase):
             time.sleep(1)
             self.assertEqual(_total_actions, 3)
             self.assertEqual(42, db.get_action(ts))
+
+            # IntfDaemon tells how long the broadcast took
+            client = ActionClient('tcp://127.0.0.1:{port}'.format(port=self.port))
+            fan_out_time = client.send([0], ack=True)
+            self.assertIsNotNone(fan_out_time)
+            self.assertLess(fan_out_time, client.ack_timeout)
+            client.close()
         finally:
             # stop() function is thread-safe
             self.intf_daemon.stop()
@@ -126,7 +138,7 @@ class TestIntfDaemon(unittest.TestCase):
             self.ma_daemon_thread.join()
 
     def test_calculating_cpvs(self):
-        global _expected_controller_action_data
+        performed = []
         try:
             ma_id = 1
             nodeid_map = {
@@ -137,7 +149,7 @@ class TestIntfDaemon(unittest.TestCase):
                 'ma_id': ma_id,
                 'intf_daemon_loc': 'localhost:{port}'.format(port=self.port),
                 'dbfile': self.test_db_file,
-                'controller': _controller_action,
+                'controller': performed.append,
                 'tick_data_size': 3,
                 'nodeid_map': nodeid_map,
                 'cpvs': cpvs,
@@ -160,51 +172,287 @@ class TestIntfDaemon(unittest.TestCase):
 
             # check the action is correctly handled
             l = Lustre(opt)
-            # default CPV values
-            _expected_controller_action_data = [0, 8, 12345]
+            # Each action is sent with the new CPV values. MAs ignore action 0, which keeps the default
+            # CPV values.
+            expected = []
             l.perform_action(0)
-            time.sleep(0.1)
-
-            _expected_controller_action_data = [0, 8, 12345]
             l.perform_action(0)
-            time.sleep(0.1)
-
-            _expected_controller_action_data = [0, 9, 12345]
+            expected.append([1, 9, 12345])
             l.perform_action(1)
-            time.sleep(0.1)
-
-            _expected_controller_action_data = [0, 10, 12345]
+            expected.append([1, 10, 12345])
             l.perform_action(1)
-            time.sleep(0.1)
-
             # First CPV shouldn't go over 10
-            _expected_controller_action_data = [0, 10, 12345]
+            expected.append([1, 10, 12345])
             l.perform_action(1)
-            time.sleep(0.1)
-
-            _expected_controller_action_data = [0, 9, 12345]
+            expected.append([2, 9, 12345])
             l.perform_action(2)
-            time.sleep(0.1)
-
-            _expected_controller_action_data = [0, 9, 11345]
+            expected.append([4, 9, 11345])
             l.perform_action(4)
-            time.sleep(0.1)
-
             # CPV2 can't go lower than 11000 and should stay at 11345
-            _expected_controller_action_data = [0, 9, 11345]
+            expected.append([4, 9, 11345])
             l.perform_action(4)
-            time.sleep(0.1)
-
-            _expected_controller_action_data = [0, 9, 12345]
+            expected.append([3, 9, 12345])
             l.perform_action(3)
-            time.sleep(0.1)
+            deadline = time.time() + 5
+            while len(performed) < len(expected) and time.time() < deadline:
+                time.sleep(0.1)
+            self.assertListEqual(expected, performed)
+            self.assertEqual(0, self.ma_daemon.missed_actions)
         finally:
             # stop() function is thread-safe
             self.intf_daemon.stop()
             self.ma_daemon.stop()
             self.intf_daemon_thread.join()
             self.ma_daemon_thread.join()
-            _expected_controller_action_data = None
+
+    def test_shutdown_on_error(self):
+        opt = {
+            'ma_id': 1,
+            'intf_daemon_loc': 'localhost:{port}'.format(port=self.port + 10),
+            'dbfile': self.test_db_file + '-error',
+            'tick_data_size': 3,
+            'num_ma': 1,
+            # Rows stay in the write buffer until the writer is stopped
+            'write_batch_size': 100,
+        }
+        try:
+            os.remove(opt['dbfile'])
+        except FileNotFoundError:
+            pass
+        self.intf_daemon = IntfDaemon(opt)
+        errors = []
+
+        def fail(tick):
+            if tick.ts == ts + 2:
+                raise sqlite3.OperationalError('disk I/O error')
+
+        self.intf_daemon.tick_listeners.append(fail)
+
+        def run():
+            try:
+                self.intf_daemon.start()
+            except Exception as e:
+                errors.append(e)
+
+        intf_daemon_thread = threading.Thread(target=run)
+        intf_daemon_thread.start()
+        ma = MonitorAgent(opt)
+        ts = int(time.time())
+        ma.send_obj([ts, 1, 2, 3])
+        # Messages of an unknown protocol version are dropped
+        ma.socket.send(zlib.compress(pickle.dumps([-1, ts + 1, 4, 5, 6])))
+        ma.socket.send_multipart([LustreCommon.MESSAGE_HEADER.pack(9, LustreCommon.KIND_PI, 0, ts + 1), b''])
+        # So are messages that can't be decoded
+        ma.socket.send(b'\x78 corrupted')
+        ma.socket.send(zlib.compress(b'not a pickle'))
+        ma.socket.send_multipart([LustreCommon.MESSAGE_HEADER.pack(LustreCommon.PROTOCOL_V2, LustreCommon.KIND_ACTION,
+                                                                   LustreCommon.FLAG_DEFLATED, ts + 1), b'corrupted'])
+        ma.socket.send_multipart(LustreCommon.encode_message(LustreCommon.KIND_BATCH, b'truncated', ts + 1))
+        # or have a ts that is not a finite number, or an action that is not an int
+        ma.socket.send_multipart(LustreCommon.encode_pi_message([4, 5, 6], float('nan')))
+        ma.socket.send(zlib.compress(pickle.dumps([LustreCommon.PROTOCOL_V1, 'now', 4, 5, 6])))
+        ma.socket.send_multipart(LustreCommon.encode_batch_message([(1, float('inf'), b'')], ts + 1))
+        ma.socket.send_multipart(LustreCommon.encode_action_message(['up', 1], ts + 1))
+        # and PIs from a socket that is not an MA
+        stranger = ma.context.socket(zmq.DEALER)
+        stranger.setsockopt(zmq.IDENTITY, b'stranger')
+        stranger.connect('tcp://' + opt['intf_daemon_loc'])
+        stranger.send_multipart(LustreCommon.encode_pi_message([4, 5, 6], ts + 1))
+        deadline = time.time() + 10
+        while self.intf_daemon.rejected_messages < 11 and time.time() < deadline:
+            time.sleep(0.1)
+        stranger.close(linger=0)
+        self.assertTrue(intf_daemon_thread.is_alive())
+        self.assertEqual(11, self.intf_daemon.rejected_messages)
+        # A fault of a stage stops the daemon
+        ma.send_obj([ts + 2, 4, 5, 6])
+        intf_daemon_thread.join(10)
+        self.assertFalse(intf_daemon_thread.is_alive())
+        self.assertIsInstance(errors[0], sqlite3.OperationalError)
+        # The PIs received before the error have been written out
+        db = ReplayDB(opt)
+        self.assertListEqual([1, 2, 3], db.get_pi(1, ts))
+        db.close()
+        ma.disconnect()
+
+    def test_pipeline_status(self):
+        opt = {
+            'ma_id': 1,
+            'intf_daemon_loc': 'localhost:{port}'.format(port=self.port + 20),
+            'dbfile': self.test_db_file + '-status',
+            'tick_data_size': 3,
+            'num_ma': 1,
+        }
+        try:
+            os.remove(opt['dbfile'])
+        except FileNotFoundError:
+            pass
+        self.intf_daemon = IntfDaemon(opt)
+        intf_daemon_thread = threading.Thread(target=self._start_intf_daemon_func)
+        intf_daemon_thread.start()
+        ma = MonitorAgent(opt)
+        try:
+            ts = int(time.time())
+            for i in range(10):
+                ma.send_obj([ts + i, 1, 2, 3])
+            ma.send_obj([ts, b'STATUS'])
+            # Skip the heartbeats
+            status = ''
+            while 'ReplayDB: ' not in status:
+                self.assertTrue(ma.socket.poll(5000))
+                status = ma.socket.recv_multipart()[0].decode(errors='replace')
+            # Every stage reports its metrics
+            for key in ('receive_processed', 'decode_processed', 'decode_avg_queue_latency', 'broadcast_throughput',
+                        'written_rows', 'write_avg_queue_latency'):
+                self.assertIn(key + ':', status)
+            self.assertIn('receive_processed: 11;', status)
+            self.assertIn('receive_avg_batch_time:', status)
+            self.assertIn('All 1 MAs healthy.', status)
+        finally:
+            self.intf_daemon.stop()
+            intf_daemon_thread.join()
+            ma.disconnect()
+        status = self.intf_daemon.get_status()
+        self.assertEqual(11, status['decode_processed'])
+        # Messages that arrived together were received in batches
+        self.assertGreaterEqual(status['receive_batches'], 1)
+        self.assertLessEqual(status['receive_batches'], 11)
+        self.assertEqual(11 / status['receive_batches'], status['receive_avg_batch_size'])
+        self.assertEqual(0, status['decode_dropped'])
+        self.assertEqual(1, status['ma_ok'])
+        db = ReplayDB(opt)
+        self.assertListEqual([1, 2, 3], db.get_pi(1, ts + 9))
+        db.close()
+
+    def test_protocol_versions(self):
+        opt = {
+            'ma_id': 1,
+            'intf_daemon_loc': 'localhost:{port}'.format(port=self.port + 40),
+            'dbfile': self.test_db_file + '-protocol',
+            'tick_data_size': 3,
+            'num_ma': 1,
+        }
+        try:
+            os.remove(opt['dbfile'])
+        except FileNotFoundError:
+            pass
+        self.intf_daemon = IntfDaemon(opt)
+        intf_daemon_thread = threading.Thread(target=self._start_intf_daemon_func)
+        intf_daemon_thread.start()
+        ma = MonitorAgent(opt)
+        try:
+            ts = int(time.time())
+            # MAs of both protocol versions can report to the same daemon
+            ma.send_obj([ts, 1.5, 2, 3])
+            ma.socket.send(zlib.compress(pickle.dumps([LustreCommon.PROTOCOL_V1, ts + 1, 4, 5, 6.5])))
+            while self.intf_daemon.get_status().get('written_rows', 0) < 2:
+                time.sleep(0.05)
+        finally:
+            self.intf_daemon.stop()
+            intf_daemon_thread.join()
+            ma.disconnect()
+        db = ReplayDB(opt)
+        self.assertListEqual([1.5, 2, 3], db.get_pi(1, ts))
+        self.assertListEqual([4, 5, 6.5], db.get_pi(1, ts + 1))
+        db.close()
+
+    def test_message_encoding(self):
+        frames = LustreCommon.encode_pi_message([1.0, 2.5], 42.5)
+        self.assertEqual(16, len(frames[1]))
+        msg = LustreCommon.decode_message(frames + [b'token'])
+        self.assertEqual((LustreCommon.PROTOCOL_V2, LustreCommon.KIND_PI, 42.5, 2),
+                         (msg.ver, msg.kind, msg.ts, msg.frames))
+        self.assertListEqual([1.0, 2.5], LustreCommon.decode_pis(msg.body))
+        # Only bodies that shrink enough are deflated
+        pis = [0.0] * 1000
+        frames = LustreCommon.encode_pi_message(pis)
+        self.assertTrue(LustreCommon.MESSAGE_HEADER.unpack(frames[0])[2] & LustreCommon.FLAG_DEFLATED)
+        self.assertListEqual(pis, LustreCommon.decode_pis(LustreCommon.decode_message(frames).body))
+        pis = list(np.random.random(1000))
+        frames = LustreCommon.encode_pi_message(pis)
+        self.assertFalse(LustreCommon.MESSAGE_HEADER.unpack(frames[0])[2] & LustreCommon.FLAG_DEFLATED)
+        self.assertEqual(8000, len(frames[1]))
+        msg = LustreCommon.decode_message(LustreCommon.encode_action_message([3, 8, 12345]))
+        self.assertEqual(LustreCommon.KIND_ACTION, msg.kind)
+        self.assertListEqual([3, 8, 12345], msg.body)
+        msg = LustreCommon.decode_message([zlib.compress(pickle.dumps([LustreCommon.PROTOCOL_V1, 7, b'ACTION', 3]))])
+        self.assertEqual((LustreCommon.PROTOCOL_V1, LustreCommon.KIND_ACTION, [3], 1),
+                         (msg.ver, msg.kind, msg.body, msg.frames))
+        with self.assertRaises(LustreCommon.ProtocolError):
+            LustreCommon.decode_message([zlib.compress(pickle.dumps([3, 7, 1.0]))])
+        for frames in ([b'\x78 corrupted'], [zlib.compress(b'not a pickle')],
+                       [zlib.compress(pickle.dumps([LustreCommon.PROTOCOL_V1, 7, 'x']))],
+                       [zlib.compress(pickle.dumps([LustreCommon.PROTOCOL_V1, 7, b'ACTION']))],
+                       [zlib.compress(pickle.dumps([LustreCommon.PROTOCOL_V1, 7, b'ACTION', 'up']))],
+                       [zlib.compress(pickle.dumps([LustreCommon.PROTOCOL_V1, 'now', 1.0]))],
+                       LustreCommon.encode_pi_message([1.0], float('nan')),
+                       LustreCommon.encode_action_message([1.5], 7)):
+            with self.assertRaises(LustreCommon.ProtocolError):
+                LustreCommon.decode_message(frames)
+        with self.assertRaises(LustreCommon.ProtocolError):
+            list(LustreCommon.decode_batch(b'truncated'))
+        with self.assertRaises(LustreCommon.ProtocolError):
+            list(LustreCommon.decode_batch(LustreCommon.BATCH_ENTRY.pack(1, float('inf'), 0)))
+        with self.assertRaises(LustreCommon.ProtocolError):
+            LustreCommon.decode_ma_id(b'stranger')
+
+    def test_missed_action(self):
+        performed = []
+        opt = {
+            'ma_id': 1,
+            'intf_daemon_loc': 'localhost:{port}'.format(port=self.port + 50),
+            'dbfile': self.test_db_file + '-missed',
+            'controller': performed.append,
+            'tick_data_size': 3,
+            'num_ma': 1,
+        }
+        self.intf_daemon = IntfDaemon(opt, store_action=False)
+        intf_daemon_thread = threading.Thread(target=self._start_intf_daemon_func)
+        intf_daemon_thread.start()
+        ma = MonitorAgent(opt)
+        client = ActionClient('tcp://127.0.0.1:{port}'.format(port=self.port + 50))
+        try:
+            ma.connect()
+
+            def receive(kind: int):
+                while True:
+                    self.assertTrue(ma.subscriber.poll(5000))
+                    frames = ma.subscriber.recv_multipart()
+                    if LustreCommon.decode_message(frames[1:]).kind == kind:
+                        return frames
+
+            ma.handle_broadcast(receive(LustreCommon.KIND_HB))
+            self.assertIsNotNone(client.send([1, 8], ack=True))
+            ma.handle_broadcast(receive(LustreCommon.KIND_ACTION))
+            self.assertListEqual([[1, 8]], performed)
+            # Lose two actions
+            self.assertIsNotNone(client.send([2, 9], ack=True))
+            self.assertIsNotNone(client.send([3, 10], ack=True))
+            receive(LustreCommon.KIND_ACTION)
+            receive(LustreCommon.KIND_ACTION)
+            self.assertEqual(3, self.intf_daemon.get_status()['action_seq'])
+            # The next heartbeat tells that the MA is behind, and it asks for the latest action again
+            ma.handle_broadcast(receive(LustreCommon.KIND_HB))
+            self.assertTrue(ma.socket.poll(5000))
+            ma.handle_broadcast(ma.socket.recv_multipart())
+            self.assertListEqual([[1, 8], [3, 10]], performed)
+            self.assertEqual(1, ma.missed_actions)
+            # Another copy of the same action is ignored
+            ma.handle_broadcast(self.intf_daemon._last_action)
+            self.assertEqual(2, len(performed))
+        finally:
+            client.close()
+            self.intf_daemon.stop()
+            intf_daemon_thread.join()
+            ma.disconnect()
+
+    def test_action_client_without_daemon(self):
+        client = ActionClient('tcp://127.0.0.1:{port}'.format(port=self.port + 30), ack_timeout=0.1)
+        # Sending never blocks, and an acknowledgement that doesn't come is reported as None
+        client.send([1])
+        self.assertIsNone(client.send([1], ack=True))
+        client.close()
+
 
 if __name__ == '__main__':
     unittest.main()
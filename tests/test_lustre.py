@@ -40,6 +40,7 @@ import logging
 import numpy as np
 import os
 import random
+import shutil
 import unittest
 from ascar import ascar_logging
 from ascar import ReplayDB, NotEnoughDataError
@@ -82,6 +83,20 @@ class TestLustre(unittest.TestCase):
             l.get_next_observation_by_cache_idx(common.num_ticks - 1)
 
         l.get_next_observation_by_cache_idx(common.num_ticks - 2)
+        for ts, action, _ in l.memcache:
+            self.assertEqual(self.db.get_action(ts), action)
+
+        # An action stored after the PIs of its tick have been loaded is picked up by the next refresh
+        ts = common.last_ts + 1
+        for ma_id in self.nodeid_map.values():
+            self.db.insert_pi(ma_id, ts, [0] * self.db.pi_per_ma)
+        self.db.flush()
+        l.refresh_memcache()
+        self.assertEqual((ts, 0), l.memcache[-1][:2])
+        self.db.insert_action(ts, 2)
+        self.db.flush()
+        l.refresh_memcache()
+        self.assertEqual((ts, 2), l.memcache[-1][:2])
 
     def test_get_minibatch_32(self):
         l = LustreGame.Lustre(self.opt)
@@ -201,9 +216,12 @@ write_throughput: 888.999
             'vega.soe.ucsc.edu': 7,
             'abel.soe.ucsc.edu': 8
         }
+        # The game opens the DB read-only, so the old DB needs to be upgraded by a writer first
+        db_file = self.test_db_file + '-filebench'
+        shutil.copy(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                 '../datasets/filebench_2016-09-05_18-14-07/ascar_replay_db.sqlite'), db_file)
         opt = {
-            'dbfile': os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                                   '../datasets/filebench_2016-09-05_18-14-07/ascar_replay_db.sqlite'),
+            'dbfile': db_file,
             'nodeid_map': nodeid_map,
             'clients': [
                 'ryu.soe.ucsc.edu',
@@ -216,6 +234,7 @@ write_throughput: 888.999
             'num_actions': 1,              # unused
             'missing_entry_tolerance': 0,
         }
+        ReplayDB(opt).close()
         l = LustreGame.Lustre(opt)
         self.assertAlmostEqual(1.21978880e+07 + 5.42585720e+07 + 1.57655040e+07 + 6.11041280e+07,
                                l.cumulative_reward)